@@ -1,13 +1,78 @@
 import base64
+import io
 import json
 import math
+import time
+from functools import partial
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
+import numpy as np
+import pandas as pd
 import streamlit as st
-import streamlit.components.v1 as components
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import plotly.graph_objects as go
+from PIL import Image
+
+from ceph_cases import SEXES, CaseRecord, default_archive
+from ceph_cohort import (
+    AGE_BANDS,
+    ALL,
+    SIGMA_EDGES,
+    SigmaHistogram,
+    age_band,
+    default_cohort_store,
+    default_density_store,
+)
+from ceph_component import html_component, load_frontend_script
+from ceph_dicom import DICOM_EXTENSIONS, DicomImage, is_dicom
+from ceph_contours import (
+    CONTOUR_DEFINITIONS,
+    CONTOUR_IDS,
+    CONTOUR_RESULT_ORDER,
+    CONTOUR_UNITS,
+    compute_contour_measurements,
+    contour_units,
+    normalize_contour,
+)
+from ceph_history import DeltaHistory, diff_states
+from ceph_memory import (
+    DEFAULT_PROCESS_BUDGET_MB,
+    DEFAULT_SESSION_BUDGET_MB,
+    IDLE_GRACE,
+    MB,
+    MEMORY_REGISTRY,
+    PROCESS_BUDGET_ENV,
+    SESSION_BUDGET_ENV,
+    budget_bytes,
+    current_rss_mb,
+    default_spill_store,
+    measure_items,
+    start_idle_reaper,
+)
+from ceph_reliability import LOA_Z, RATER_COUNTS, default_reliability_store, rater_pairs
+from ceph_report import REPORT_FORMATS, ReportLayout, default_report_renderer
+from ceph_similar import default_similarity_index
+from ceph_state_store import (
+    default_state_store,
+    image_key,
+    new_session_id,
+    state_key as session_state_key,
+    valid_session_id,
+)
+from ceph_thumbnails import default_image_store
+from ceph_tiles import content_key, data_url_to_bytes
+from ceph_telemetry import BUCKET_EDGES_MS, METRICS_SINK
+from ceph_superimposition import REGISTRATIONS, displacements, load_serial_csv, points_to_array, register_batch
+from ceph_uncertainty import (
+    DEFAULT_PX_PER_MM,
+    DEFAULT_SAMPLES,
+    IntervalEstimate,
+    monte_carlo_intervals,
+    state_key,
+)
 
 
 st.set_page_config(page_title="Cephalo Analyzer (Streamlit版)", layout="wide")
@@ -16,6 +81,41 @@ st.set_page_config(page_title="Cephalo Analyzer (Streamlit版)", layout="wide")
 
 BASE_CANVAS_WIDTH = 800
 BASE_CANVAS_HEIGHT = 750
+RATIO_EPSILON = 1e-6
+# ドラッグ中に逐次送られる値。状態には反映するがバージョンは確定イベントまで据え置く。
+LIVE_SYNC_EVENTS = ("drag",)
+COMPONENT_KEY = "ceph-main"
+SESSION_PARAM = "sid"
+PAGE_PARAM = "page"
+# メモリ計上での種類。ここに無いキーは "state"。cache は捨てても次の再実行で作り直せる。
+MEMORY_KINDS = {
+    "default_image_data_url": "image",
+    "ceph_image_info_cache": "cache",
+    "ceph_image_ref": "cache",
+    "ceph_tile_payload": "cache",
+    "ceph_uncertainty_cache": "cache",
+    "ceph_persisted_state": "cache",
+    "ceph_dicom_cache": "cache",
+    "ceph_history": "history",
+}
+# 操作のないセッションを退避するときにファイルへ移すキー (ウィジェットの値は含めない)
+SPILLABLE_STATE_KEYS = (
+    "ceph_points",
+    "ceph_stage",
+    "ceph_state_version",
+    "ceph_contours",
+    "ceph_baseline",
+    "ceph_calibration",
+    "ceph_image_spacing",
+    "ceph_history",
+    "ceph_live_origin",
+    "ceph_render_snapshot",
+)
+SNAPSHOT_VERSION = 1
+GALLERY_PAGE_SIZE = 24
+GALLERY_COLUMNS = 6
+IMAGE_UPLOAD_TYPES = ["png", "jpg", "jpeg", "gif", "webp", *DICOM_EXTENSIONS]
+UNCERTAINTY_LEVEL = 0.95
 
 
 
@@ -134,6 +234,43 @@ RESULT_ORDER = [
     "L1_FH",
 ]
 
+# 距離 (2 点間)
+DISTANCE_DEFINITIONS: List[Tuple[str, Tuple[str, str]]] = [
+    ("S-N", ("S", "N")),
+    ("N-Me", ("N", "Me")),
+    ("Ar-Pog", ("Ar", "Pog")),
+]
+
+# 点から直線までの符号付き距離 (FH の前方向が正)
+LINE_DISTANCE_DEFINITIONS: List[Tuple[str, Tuple[str, Tuple[str, str]]]] = [
+    ("U1 to A-Pog", ("U1", ("A", "Pog"))),
+    ("L1 to A-Pog", ("L1", ("A", "Pog"))),
+    ("Pog to N-B", ("Pog", ("N", "B"))),
+]
+
+# 2 点の差を FH 平面へ射影した距離。along = FH 方向 (前方が正), across = 垂直方向 (下方が正)
+PROJECTION_DEFINITIONS: List[Tuple[str, Tuple[str, str, str]]] = [
+    ("AF-BF (Wits, FH)", ("A", "B", "along")),
+    ("Overjet", ("U1", "L1", "along")),
+    ("Overbite", ("U1", "L1", "across")),
+]
+PROJECTION_PLANE = ("Po", "Or")
+
+# Go は下顎下縁平面 (Me-Am) と下顎枝平面 (Ar-Pm) の交点として構成する
+RATIO_RESULTS = ["S-Go/N-Me"]
+
+LINEAR_RESULT_ORDER = (
+    [name for name, _ in DISTANCE_DEFINITIONS]
+    + [name for name, _ in LINE_DISTANCE_DEFINITIONS]
+    + [name for name, _ in PROJECTION_DEFINITIONS]
+    + ["S-Go"]
+    + RATIO_RESULTS
+)
+
+CALIBRATION_ID = "calibration"
+CALIBRATION_DEFINITION = {"id": CALIBRATION_ID, "name": "校正 (目盛りの 2 点をなぞる)", "color": "#f43f5e"}
+DEFAULT_RULER_MM = 10.0
+
 POLYGON_ROWS: List[PolygonRow] = [
     PolygonRow("00", 0.0, 0.0, 0.0),  # 上部ダミー
     PolygonRow("Facial", 83.1, 2.5, 0.1036),
@@ -152,6 +289,7 @@ POLYGON_ROWS: List[PolygonRow] = [
     PolygonRow("L1_FH", 57.2, 3.9, 0.2500),
     PolygonRow("ZZ", 0.0, 0.0, 0.0),  # 下部ダミー
 ]
+POLYGON_GRID = np.linspace(-3.2, 3.2, 129)  # コホート密度を描く横軸の格子 (ポリゴンの表示範囲)
 
 SD_PERCENT_SCALE = 4.0
 SD_PERCENT_MAP = {
@@ -204,6 +342,16 @@ SD_PERCENT_MAP = {
     "L1_FH": 0.2500,
 }
 
+# サーバー側で描くトレース図レポートの内容 (画面の描画と同じ定義から作る)
+REPORT_LAYOUT = ReportLayout(
+    points=tuple((point["id"], point["color"]) for point in CEPH_POINTS),
+    planes=tuple((plane["start"], plane["end"], plane["color"], plane["width"]) for plane in PLANE_DEFINITIONS),
+    measures=tuple(RESULT_ORDER),
+    reference=tuple((name, mean, sd) for name, (mean, sd) in REFERENCE_DATA.items()),
+    polygon=tuple((row.label, row.mean, row.sd, row.sd_ratio) for row in POLYGON_ROWS),
+    polygon_scale=SD_PERCENT_SCALE,
+)
+
 
 # === ユーティリティ ===============================================================
 
@@ -212,6 +360,32 @@ def to_data_url(data: bytes, mime: str) -> str:
     return f"data:{mime};base64,{b64}"
 
 
+def uploaded_image_data_url(uploaded) -> str:
+    """アップロードされたファイルを表示用のデータ URL にする。
+
+    DICOM は保存されたウィンドウで 8bit PNG にし、画素間隔を校正に使えるよう残す。
+    復号は同じファイルにつき 1 回だけ (再実行ではキャッシュを返す)。
+    """
+    data = uploaded.getvalue()
+    if not is_dicom(data, uploaded.name):
+        return to_data_url(data, uploaded.type or "image/png")
+    key = content_key(data)
+    cached = st.session_state.get("ceph_dicom_cache")
+    if cached and cached[0] == key:
+        return cached[1]
+    dicom = DicomImage(data, uploaded.name)
+    png = dicom.to_png()
+    image_data_url = to_data_url(png, "image/png")
+    header = dicom.header
+    st.session_state.ceph_image_spacing = (
+        {"image_key": content_key(png), "mm_per_px": header.mm_per_px, "source": f"DICOM {header.spacing_source}"}
+        if header.mm_per_px
+        else None
+    )
+    st.session_state.ceph_dicom_cache = (key, image_data_url)
+    return image_data_url
+
+
 def load_default_image_data_url() -> Optional[str]:
     path = Path(__file__).with_name("zzz.gif")
     if not path.exists():
@@ -230,13 +404,411 @@ def get_default_point_state() -> Dict[str, Dict[str, float]]:
     return state
 
 
+def image_reference(image_data_url: Optional[str]) -> Optional[Dict[str, str]]:
+    """画像の参照 (内容キーと MIME)。同じデータ URL ならハッシュし直さない。"""
+    if not image_data_url:
+        return None
+    cached = st.session_state.get("ceph_image_ref")
+    if cached and cached[0] == image_data_url:
+        return cached[1]
+    mime = image_data_url[5 : image_data_url.find(";")] or "image/png"
+    info = st.session_state.get("ceph_image_info_cache")
+    key = info[1]["key"] if info and info[0] == image_data_url else content_key(data_url_to_bytes(image_data_url))
+    ref = {"key": key, "mime": mime}
+    st.session_state.ceph_image_ref = (image_data_url, ref)
+    return ref
+
+
+def build_session_snapshot(image_ref: Optional[Dict[str, str]]) -> Dict:
+    """外部ストアに置く状態。比率と小さな辞書だけで、画像は参照のみ。"""
+    return {
+        "v": SNAPSHOT_VERSION,
+        "points": {
+            pid: [round(info.get("x_ratio", 0.5), 6), round(info.get("y_ratio", 0.5), 6)]
+            for pid, info in st.session_state.ceph_points.items()
+        },
+        "stage": st.session_state.ceph_stage,
+        "version": st.session_state.ceph_state_version,
+        "contours": st.session_state.ceph_contours,
+        "calibration": st.session_state.ceph_calibration,
+        "spacing": st.session_state.ceph_image_spacing,
+        "baseline": st.session_state.ceph_baseline,
+        "image": image_ref,
+    }
+
+
+def apply_session_snapshot(snapshot: Dict, image_data_url: Optional[str]) -> None:
+    st.session_state.ceph_points = {
+        pid: {"x_ratio": float(x), "y_ratio": float(y)} for pid, (x, y) in snapshot.get("points", {}).items()
+    }
+    if snapshot.get("stage"):
+        st.session_state.ceph_stage = dict(snapshot["stage"])
+    st.session_state.ceph_state_version = int(snapshot.get("version") or 0) + 1
+    st.session_state.ceph_contours = dict(snapshot.get("contours") or {})
+    st.session_state.ceph_calibration = snapshot.get("calibration")
+    st.session_state.ceph_image_spacing = snapshot.get("spacing")
+    st.session_state.ceph_baseline = snapshot.get("baseline")
+    if image_data_url:
+        st.session_state.default_image_data_url = image_data_url
+
+
+def attach_session_store() -> None:
+    """外部ストアが有効なら、URL の sid で以前の状態を復元する (無ければ sid を発行する)。"""
+    store = default_state_store()
+    if store is None:
+        st.session_state.ceph_session_id = None
+        return
+    try:
+        session_id = st.query_params.get(SESSION_PARAM)
+    except Exception:
+        session_id = None
+    if not valid_session_id(session_id):
+        session_id = new_session_id()
+        try:
+            st.query_params[SESSION_PARAM] = session_id
+        except Exception:
+            pass
+    st.session_state.ceph_session_id = session_id
+    raw = store.get(session_state_key(session_id))
+    if raw is None:
+        return
+    snapshot = json.loads(raw)
+    if snapshot.get("v") != SNAPSHOT_VERSION:
+        return
+    image_data_url = None
+    image_ref = snapshot.get("image")
+    if image_ref:
+        data = store.get(image_key(image_ref["key"]), cache=False)
+        if data is not None:
+            image_data_url = to_data_url(data, image_ref["mime"])
+    apply_session_snapshot(snapshot, image_data_url)
+    st.session_state.ceph_persisted_state = raw
+
+
+def memory_kind(key: str) -> str:
+    return MEMORY_KINDS.get(key, "state")
+
+
+def uploaded_file_bytes(ctx) -> int:
+    """このセッションのアップローダーが保持しているバイト数 (取得できなければ 0)。"""
+    storage = getattr(ctx.uploaded_file_mgr, "file_storage", None)
+    if not isinstance(storage, dict):
+        return 0
+    return sum(len(getattr(record, "data", b"")) for record in storage.get(ctx.session_id, {}).values())
+
+
+def spill_session_image(state) -> int:
+    """画像を退避ファイルへ移し、セッションから外す (state は他セッションの状態でもよい)。
+
+    データ URL を参照しているキャッシュも一緒に捨てないと解放されない。
+    """
+    if "default_image_data_url" not in state:
+        return 0
+    image_data_url = state["default_image_data_url"]
+    if not image_data_url:
+        return 0
+    mime = image_data_url[5 : image_data_url.find(";")] or "image/png"
+    data = data_url_to_bytes(image_data_url)
+    key = content_key(data)
+    default_spill_store().write(key, data)
+    state["ceph_spilled_image"] = {"key": key, "mime": mime}
+    state["default_image_data_url"] = None
+    for cache_key in [k for k, kind in MEMORY_KINDS.items() if kind == "cache"]:
+        if cache_key in state:
+            del state[cache_key]
+    return len(image_data_url)
+
+
+def spill_session(session_id: str, state) -> int:
+    """操作のないセッションの画像とランドマーク状態をまとめて退避する (背景スレッドから呼ぶ)。"""
+    freed = spill_session_image(state)
+    snapshot = {key: state[key] for key in SPILLABLE_STATE_KEYS if key in state}
+    if not snapshot:
+        return freed
+    freed += default_spill_store().write_state(session_id, snapshot)
+    state["ceph_spilled_state"] = session_id
+    for key in snapshot:
+        del state[key]
+    return freed
+
+
+def session_liveness() -> Optional[Callable[[str], bool]]:
+    """セッションがまだ開いているかを返す関数 (Streamlit のランタイムが無い実行では None)。"""
+    try:
+        return runtime.get_instance().is_active_session
+    except Exception:
+        return None
+
+
+def account_session_memory() -> None:
+    """再実行の終わりにこのセッションを計上し、上限を超えていれば捨てる・退避する。"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    session_budget = budget_bytes(SESSION_BUDGET_ENV, DEFAULT_SESSION_BUDGET_MB)
+    extra = {"uploader": uploaded_file_bytes(ctx), "html": st.session_state.get("ceph_rendered_html_bytes", 0)}
+
+    def measure(evicted: Tuple[str, ...] = ()):
+        return measure_items(ctx.session_id, st.session_state.to_dict().items(), memory_kind, extra, evicted)
+
+    usage = measure()
+    evicted: List[str] = []
+    if session_budget and usage.total > session_budget:
+        excess = usage.total - session_budget
+        for key, kind, size in usage.items:
+            if excess <= 0:
+                break
+            if kind == "cache" and key in st.session_state:
+                del st.session_state[key]
+                evicted.append(key)
+                excess -= size
+        if excess > 0 and spill_session_image(st.session_state):
+            evicted.append("default_image_data_url")
+        usage = measure(tuple(evicted))
+    is_active = session_liveness()
+    MEMORY_REGISTRY.report(usage, ctx.session_state, is_active)
+
+    process_budget = budget_bytes(PROCESS_BUDGET_ENV, DEFAULT_PROCESS_BUDGET_MB)
+    if process_budget and MEMORY_REGISTRY.total() > process_budget:
+        MEMORY_REGISTRY.spill_sessions(
+            lambda _, state: spill_session_image(state),
+            IDLE_GRACE,
+            exclude=ctx.session_id,
+            order_kind="image",
+            limit_bytes=MEMORY_REGISTRY.total() - process_budget,
+        )
+    start_idle_reaper(spill_session, is_active)
+
+
+def render_memory_diagnostics() -> None:
+    st.title("メモリ診断")
+    is_active = session_liveness()
+    if is_active is not None:
+        MEMORY_REGISTRY.prune(is_active)
+    usages = MEMORY_REGISTRY.usages()
+    spill_files, spill_bytes = default_spill_store().usage()
+    cols = st.columns(5)
+    cols[0].metric("プロセス RSS", f"{current_rss_mb():.0f} MB")
+    cols[1].metric("計上合計", f"{sum(u.total for u in usages) / MB:.1f} MB")
+    cols[2].metric("セッション数", len(usages))
+    cols[3].metric("退避したセッション", MEMORY_REGISTRY.spilled_sessions)
+    cols[4].metric("退避ファイル", f"{spill_files} 件 / {spill_bytes / MB:.1f} MB")
+    st.caption(
+        f"上限: セッション {budget_bytes(SESSION_BUDGET_ENV, DEFAULT_SESSION_BUDGET_MB) / MB:.0f} MB, "
+        f"プロセス {budget_bytes(PROCESS_BUDGET_ENV, DEFAULT_PROCESS_BUDGET_MB) / MB:.0f} MB (0 は無効)"
+    )
+    kinds = sorted({kind for usage in usages for kind in usage.by_kind})
+    now = time.time()
+    st.markdown("### セッション別 (MB)")
+    st.dataframe(
+        [
+            {
+                "セッション": usage.session_id[:8],
+                "合計": round(usage.total / MB, 2),
+                **{kind: round(usage.kind_bytes(kind) / MB, 2) for kind in kinds},
+                "最終報告 (秒前)": round(now - usage.updated),
+                "直近の退避": ", ".join(usage.evicted) or "—",
+            }
+            for usage in usages
+        ],
+        width="stretch",
+        hide_index=True,
+    )
+    st.markdown("### 大きい項目")
+    st.dataframe(
+        sorted(
+            (
+                {"セッション": usage.session_id[:8], "キー": key, "種類": kind, "MB": round(size / MB, 3)}
+                for usage in usages
+                for key, kind, size in usage.items[:5]
+            ),
+            key=lambda row: row["MB"],
+            reverse=True,
+        )[:50],
+        width="stretch",
+        hide_index=True,
+    )
+
+
+def open_case(record: CaseRecord) -> bool:
+    """保存済み症例の画像とランドマークを作業中の状態にする。画像が残っていなければ False。"""
+    stored = default_image_store().get(record.image_key) if record.image_key else None
+    width, height = record.image_size
+    if stored is None or not width or not height:
+        return False
+    data, mime = stored
+    points = get_default_point_state()
+    points.update(
+        {pid: {"x_ratio": x / width, "y_ratio": y / height} for pid, (x, y) in record.points.items() if pid in points}
+    )
+    st.session_state.default_image_data_url = to_data_url(data, mime)
+    st.session_state.ceph_points = points
+    st.session_state.ceph_contours = {}
+    st.session_state.ceph_calibration = None
+    st.session_state.ceph_image_spacing = (
+        {"image_key": record.image_key, "mm_per_px": record.mm_per_px, "source": "保存済み症例"}
+        if record.mm_per_px
+        else None
+    )
+    # 別の画像の位置へ戻れても意味がないので履歴は作り直す
+    st.session_state.ceph_history = DeltaHistory(POINT_IDS)
+    st.session_state.ceph_live_origin = {}
+    st.session_state.ceph_last_event = "open-case"
+    st.session_state.ceph_active_id = None
+    st.session_state.ceph_state_version += 1
+    st.session_state.ceph_opened_case = record.case_id
+    # アップローダーに前のファイルが残っていると次の再実行で画像が差し替わるので、空の新しいものにする
+    st.session_state.ceph_upload_epoch += 1
+    return True
+
+
+def render_case_gallery() -> None:
+    """保存済み症例のサムネイル一覧。表示中のページの分だけ読み、原画像は開くときに読む。"""
+    st.title("症例ギャラリー")
+    if st.button("← 解析に戻る"):
+        del st.query_params[PAGE_PARAM]
+        st.rerun()
+    archive = default_archive()
+    store = default_image_store()
+    search_col, page_col = st.columns([3, 1])
+    search = search_col.text_input("症例 ID で絞り込む").strip()
+    total = archive.count(search)
+    pages = max(1, math.ceil(total / GALLERY_PAGE_SIZE))
+    page = page_col.number_input("ページ", min_value=1, max_value=pages, value=1, step=1)
+    st.caption(f"{total} 症例 ({page} / {pages} ページ, 更新の新しい順)")
+    records = archive.list_cases((page - 1) * GALLERY_PAGE_SIZE, GALLERY_PAGE_SIZE, search)
+    sex_labels = {"M": "男性", "F": "女性"}
+    for start in range(0, len(records), GALLERY_COLUMNS):
+        for col, record in zip(st.columns(GALLERY_COLUMNS), records[start : start + GALLERY_COLUMNS]):
+            with col:
+                thumbnail = store.thumbnail(record.image_key) if record.image_key else None
+                has_image = thumbnail is not None or (record.image_key and store.image_path(record.image_key))
+                if thumbnail is not None:
+                    st.image(str(thumbnail), width="stretch")
+                else:
+                    st.caption("サムネイル作成中…" if has_image else "画像なし")
+                details = [f"{record.age:g} 歳" if record.age is not None else "", sex_labels.get(record.sex, "")]
+                st.caption(f"**{record.case_id}** " + " ".join(item for item in details if item))
+                if st.button("開く", key=f"gallery-open-{record.case_id}", width="stretch", disabled=not has_image):
+                    if open_case(record):
+                        del st.query_params[PAGE_PARAM]
+                        st.rerun()
+                    st.error("画像が見つかりません。")
+
+
+def persist_session_state() -> None:
+    """状態が前回の書き込みから変わっていれば外部ストアへ送る (書き込み自体は非同期)。"""
+    session_id = st.session_state.get("ceph_session_id")
+    store = default_state_store()
+    if not session_id or store is None:
+        return
+    image_data_url = st.session_state.get("default_image_data_url")
+    image_ref = image_reference(image_data_url)
+    raw = json.dumps(build_session_snapshot(image_ref), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if raw == st.session_state.get("ceph_persisted_state"):
+        return
+    if image_ref:
+        store.put_blob_once(image_key(image_ref["key"]), data_url_to_bytes(image_data_url))
+    store.put(session_state_key(session_id), raw)
+    st.session_state.ceph_persisted_state = raw
+
+
+def rehydrate_spilled_image() -> None:
+    spilled = st.session_state.get("ceph_spilled_image")
+    if not spilled:
+        return
+    data = default_spill_store().read(spilled["key"])
+    if data is not None and not st.session_state.get("default_image_data_url"):
+        st.session_state.default_image_data_url = to_data_url(data, spilled["mime"])
+    del st.session_state["ceph_spilled_image"]
+
+
+def rehydrate_spilled_state() -> None:
+    session_id = st.session_state.get("ceph_spilled_state")
+    if not session_id:
+        return
+    snapshot = default_spill_store().pop_state(session_id)
+    for key, value in (snapshot or {}).items():
+        st.session_state[key] = value
+    del st.session_state["ceph_spilled_state"]
+
+
 def ensure_session_state() -> None:
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        # 背景スレッドの退避が終わるのを待ち、この再実行の間は退避させない
+        MEMORY_REGISTRY.begin(ctx.session_id)
+    if "ceph_session_id" not in st.session_state:
+        attach_session_store()
+    rehydrate_spilled_state()
+    rehydrate_spilled_image()
     if "ceph_points" not in st.session_state:
         st.session_state.ceph_points = get_default_point_state()
     if "ceph_stage" not in st.session_state:
         st.session_state.ceph_stage = {"width": BASE_CANVAS_WIDTH, "height": BASE_CANVAS_HEIGHT}
     if "default_image_data_url" not in st.session_state:
         st.session_state.default_image_data_url = load_default_image_data_url()
+    if "ceph_state_version" not in st.session_state:
+        st.session_state.ceph_state_version = 0
+    if "ceph_history" not in st.session_state:
+        st.session_state.ceph_history = DeltaHistory(POINT_IDS)
+        st.session_state.ceph_live_origin = {}
+    if "ceph_contours" not in st.session_state:
+        st.session_state.ceph_contours = {}
+    if "ceph_baseline" not in st.session_state:
+        st.session_state.ceph_baseline = None
+    if "ceph_calibration" not in st.session_state:
+        st.session_state.ceph_calibration = None
+    if "ceph_image_spacing" not in st.session_state:
+        st.session_state.ceph_image_spacing = None
+    if "ceph_upload_epoch" not in st.session_state:
+        st.session_state.ceph_upload_epoch = 0
+
+
+def get_image_info(image_data_url: str) -> Dict:
+    """原画像のサイズと内容キー。同じ画像なら再デコードしない。"""
+    cached = st.session_state.get("ceph_image_info_cache")
+    if cached and cached[0] == image_data_url:
+        return cached[1]
+    data = data_url_to_bytes(image_data_url)
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+    info = {"key": content_key(data), "width": width, "height": height}
+    st.session_state.ceph_image_info_cache = (image_data_url, info)
+    st.session_state.ceph_image_info = info
+    return info
+
+
+def image_spacing_mm_per_px(image_info: Dict) -> Optional[float]:
+    """DICOM の画素間隔 (この画像のものだけ)。"""
+    spacing = st.session_state.get("ceph_image_spacing")
+    if not spacing or spacing.get("image_key") != image_info.get("key"):
+        return None
+    return spacing["mm_per_px"]
+
+
+def get_calibration_mm_per_px(image_info: Dict, ruler_mm: float) -> Optional[float]:
+    """校正線 (原画像座標) と実長から原画像 1 px あたりの mm を返す。
+
+    校正線が無ければ DICOM の画素間隔、それも無ければ None。
+    """
+    calibration = st.session_state.get("ceph_calibration")
+    if not calibration or calibration.get("image_key") != image_info.get("key"):
+        return image_spacing_mm_per_px(image_info)
+    (x0, y0), (x1, y1) = calibration["start"], calibration["end"]
+    length = math.hypot(x1 - x0, y1 - y0)
+    if length <= 0 or ruler_mm <= 0:
+        return None
+    return ruler_mm / length
+
+
+def build_points_native(state: Dict[str, Dict[str, float]], image_info: Dict) -> Dict[str, Tuple[float, float]]:
+    """比率を原画像のピクセル座標に直す (ブラウザ幅に依存しない)。"""
+    width, height = image_info["width"], image_info["height"]
+    return {
+        pid: (float(info.get("x_ratio", 0.5)) * width, float(info.get("y_ratio", 0.5)) * height)
+        for pid, info in state.items()
+    }
 
 
 def build_component_payload(
@@ -244,11 +816,21 @@ def build_component_payload(
     marker_size: int,
     show_labels: bool,
     point_state: Dict[str, Dict[str, float]],
+    renderer: str = "dom",
+    state_version: int = 0,
+    stage: Optional[Dict[str, float]] = None,
+    contours: Optional[Dict[str, List[List[float]]]] = None,
+    trace: Optional[str] = None,
+    overlay: Optional[Dict] = None,
+    halos: Optional[Dict[str, float]] = None,
 ) -> str:
     payload = {
         "image": image_data_url,
         "markerSize": marker_size,
         "showLabels": show_labels,
+        "renderer": renderer,
+        "version": state_version,
+        "stage": stage,
         "points": [
             {
                 "id": item["id"],
@@ -256,6 +838,7 @@ def build_component_payload(
                 "color": item["color"],
                 "ratio_x": point_state.get(item["id"], {}).get("x_ratio", 0.5),
                 "ratio_y": point_state.get(item["id"], {}).get("y_ratio", 0.5),
+                "halo": (halos or {}).get(item["id"], 0.0),
             }
             for item in CEPH_POINTS
         ],
@@ -271,18 +854,54 @@ def build_component_payload(
             }
             for plane in PLANE_DEFINITIONS
         ],
+        "contours": contours or {},
+        "contourDefs": CONTOUR_DEFINITIONS + [CALIBRATION_DEFINITION],
+        "trace": trace,
+        "overlay": overlay,
+        "telemetryBuckets": list(BUCKET_EDGES_MS),
     }
     json_payload = json.dumps(payload, ensure_ascii=False).replace("</", "<\\/")
     return json_payload
 
 
+def build_render_contours() -> Dict[str, List[List[float]]]:
+    contours = dict(st.session_state.get("ceph_contours") or {})
+    calibration = st.session_state.get("ceph_calibration")
+    image_info = st.session_state.get("ceph_image_info")
+    if calibration and image_info and calibration.get("image_key") == image_info["key"]:
+        contours[CALIBRATION_ID] = [
+            [x / image_info["width"], y / image_info["height"]] for x, y in (calibration["start"], calibration["end"])
+        ]
+    return contours
+
+
 def render_ceph_component(
     image_data_url: str,
     marker_size: int,
     show_labels: bool,
     point_state: Dict[str, Dict[str, float]],
+    renderer: str = "dom",
+    trace: Optional[str] = None,
+    overlay: Optional[Dict] = None,
+    halos: Optional[Dict[str, float]] = None,
 ) -> Optional[Dict]:
-    payload_json = build_component_payload(image_data_url, marker_size, show_labels, point_state)
+    payload_json = build_component_payload(
+        image_data_url,
+        marker_size,
+        show_labels,
+        point_state,
+        renderer,
+        state_version=st.session_state.get("ceph_state_version", 0),
+        stage=st.session_state.get("ceph_stage"),
+        contours=build_render_contours(),
+        trace=trace,
+        overlay=overlay,
+        halos=halos,
+    )
+    resize_script = load_frontend_script("resize_observer.js")
+    canvas_script = load_frontend_script("canvas_renderer.js") if renderer == "canvas" else ""
+    contour_script = load_frontend_script("contour_tracer.js")
+    telemetry_script = load_frontend_script("telemetry.js")
 
     html = f"""
     <style>
@@ -304,6 +923,11 @@ def render_ceph_component(
         inset: 0;
         pointer-events: none;
       }}
+      #ceph-contours, #ceph-baseline {{
+        position: absolute;
+        inset: 0;
+        pointer-events: none;
+      }}
       #ceph-stage {{
         position: absolute;
         inset: 0;
@@ -321,6 +945,15 @@ def render_ceph_component(
       .ceph-marker.dragging {{
         cursor: grabbing;
       }}
+      .ceph-marker .halo {{
+        position: absolute;
+        left: 50%;
+        top: 0;
+        transform: translate(-50%, -50%);
+        border-radius: 50%;
+        pointer-events: none;
+        background: radial-gradient(circle, rgba(250, 204, 21, 0.55) 0%, rgba(250, 204, 21, 0) 70%);
+      }}
       .ceph-marker .pin {{
         width: 0;
         height: 0;
@@ -348,10 +981,16 @@ def render_ceph_component(
     </style>
     <div class="ceph-wrapper">
       <img id="ceph-image" src="{image_data_url}" alt="cephalometric background" />
+      <svg id="ceph-baseline"></svg>
+      <svg id="ceph-contours"></svg>
       <svg id="ceph-planes"></svg>
       <div id="ceph-stage"></div>
       <div id="ceph-coords">ポイントをドラッグして位置を調整できます。</div>
     </div>
+    <script>{resize_script}</script>
+    <script>{canvas_script}</script>
+    <script>{contour_script}</script>
+    <script>{telemetry_script}</script>
     <script>
       const payload = {payload_json};
       (function() {{
@@ -360,6 +999,8 @@ def render_ceph_component(
         const stage = document.getElementById("ceph-stage");
         const planesSvg = document.getElementById("ceph-planes");
         const coords = document.getElementById("ceph-coords");
+        const contoursSvg = document.getElementById("ceph-contours");
+        const baselineSvg = document.getElementById("ceph-baseline");
         if (!wrapper || !image || !stage || !planesSvg) {{
           return;
         }}
@@ -382,18 +1023,213 @@ def render_ceph_component(
           );
         }};
 
+        // ドラッグ計測は次に送る値に相乗りさせる (計測のためだけには送信しない)。
+        const telemetry = window.CephTelemetry
+          ? window.CephTelemetry.create({{
+              edges: payload.telemetryBuckets,
+              renderer: payload.renderer,
+              view: "main",
+            }})
+          : null;
         const emitValue = (value) => {{
+          const report = telemetry ? telemetry.drain() : null;
           postMessage({{
             type: "streamlit:setComponentValue",
-            value,
+            value: report ? {{ ...value, telemetry: report }} : value,
           }});
         }};
 
+        // Python が保持している状態 (payload) との差分があるときだけ送信する。
+        // 単なる拡大縮小 (縦横比が同じ) は比率が変わらないので送信しない。
+        const RATIO_EPSILON = 1e-6;
+        const ASPECT_EPSILON = 5e-3;
+        const syncedRatios = {{}};
+        payload.points.forEach((pt) => {{
+          syncedRatios[pt.id] = {{ x: pt.ratio_x, y: pt.ratio_y }};
+        }});
+        let syncedStage = payload.stage || null;
+        const syncInstance = Math.random().toString(36).slice(2);
+        let syncSeq = 0;
+        const emitIfChanged = (eventType, activeId, stageSize, points) => {{
+          const width = Math.round(stageSize.width || 0);
+          const height = Math.round(stageSize.height || 0);
+          if (!width || !height) {{
+            return;
+          }}
+          const stageChanged =
+            !syncedStage ||
+            !syncedStage.width ||
+            Math.abs(syncedStage.height / syncedStage.width - height / width) > ASPECT_EPSILON;
+          const changed = stageChanged
+            ? points
+            : points.filter((pt) => {{
+                const prev = syncedRatios[pt.id];
+                return (
+                  !prev ||
+                  Math.abs(prev.x - pt.x_ratio) > RATIO_EPSILON ||
+                  Math.abs(prev.y - pt.y_ratio) > RATIO_EPSILON
+                );
+              }});
+          if (!stageChanged && changed.length === 0) {{
+            return;
+          }}
+          changed.forEach((pt) => {{
+            syncedRatios[pt.id] = {{ x: pt.x_ratio, y: pt.y_ratio }};
+          }});
+          syncedStage = {{ width, height }};
+          syncSeq += 1;
+          emitValue({{
+            version: payload.version,
+            instance: syncInstance,
+            seq: syncSeq,
+            event: eventType,
+            active_id: activeId || null,
+            stage: {{ width, height }},
+            points: changed,
+          }});
+        }};
+
+        // 輪郭トレース: ストローク 1 本ごとに簡略化済みの比率列を 1 回だけ送る。
+        let isMarkerDragging = () => false;
+        const tracer = window.CephContourTracer
+          ? window.CephContourTracer.create({{
+              container: wrapper,
+              svg: contoursSvg,
+              getSize: () => ({{ width: image.clientWidth || 0, height: image.clientHeight || 0 }}),
+              canStart: () => !isMarkerDragging(),
+              definitions: Array.isArray(payload.contourDefs) ? payload.contourDefs : [],
+              contours: payload.contours || {{}},
+              active: payload.trace || null,
+              onStroke: (id, ratios, rawCount) => {{
+                coords.textContent = `${{id}}: ${{rawCount}} → ${{ratios.length}} 点`;
+                syncSeq += 1;
+                emitValue({{
+                  version: payload.version,
+                  instance: syncInstance,
+                  seq: syncSeq,
+                  event: "contour",
+                  active_id: id,
+                  stage: syncedStage,
+                  points: [],
+                  contours: {{ [id]: ratios }},
+                }});
+              }},
+            }})
+          : null;
+        // 重ね合わせ: 比較トレース (登録済みの変換を適用済みの比率) を破線で重ねる。
+        const renderBaseline = () => {{
+          const overlay = payload.overlay;
+          if (!baselineSvg || !overlay || !Array.isArray(overlay.points)) {{
+            return;
+          }}
+          const width = image.clientWidth || 0;
+          const height = image.clientHeight || 0;
+          baselineSvg.setAttribute("viewBox", `0 0 ${{width}} ${{height}}`);
+          baselineSvg.setAttribute("width", width);
+          baselineSvg.setAttribute("height", height);
+          const ns = "http://www.w3.org/2000/svg";
+          const color = overlay.color || "#e2e8f0";
+          const byId = {{}};
+          overlay.points.forEach((pt) => {{
+            byId[pt.id] = {{ x: pt.ratio_x * width, y: pt.ratio_y * height }};
+          }});
+          const parts = [];
+          (Array.isArray(payload.planes) ? payload.planes : []).forEach((plane) => {{
+            const a = byId[plane.start];
+            const b = byId[plane.end];
+            if (a && b) {{
+              parts.push(
+                `<line x1="${{a.x}}" y1="${{a.y}}" x2="${{b.x}}" y2="${{b.y}}" stroke="${{color}}" stroke-width="1.5" stroke-dasharray="6 4" opacity="0.75" />`
+              );
+            }}
+          }});
+          Object.keys(byId).forEach((id) => {{
+            const pt = byId[id];
+            parts.push(
+              `<circle cx="${{pt.x}}" cy="${{pt.y}}" r="3.5" fill="none" stroke="${{color}}" stroke-width="1.5" />`
+            );
+          }});
+          baselineSvg.innerHTML = parts.join("");
+        }};
+        const renderContours = () => {{
+          renderBaseline();
+          if (tracer) {{
+            tracer.render();
+          }}
+        }};
+
+        if (payload.renderer === "canvas" && window.CephCanvasRenderer) {{
+          stage.style.display = "none";
+          planesSvg.style.display = "none";
+          const labelById = {{}};
+          payload.points.forEach((pt) => {{
+            labelById[pt.id] = pt.label || pt.id;
+          }});
+          const describe = (id) => {{
+            const apex = renderer.getPixel(id);
+            coords.textContent = `${{labelById[id]}}: x=${{Math.round(apex.x)}}, y=${{Math.round(apex.y)}}`;
+          }};
+          const emitCanvasState = (eventType, activeId) => {{
+            const points = renderer.ids.map((id) => {{
+              const apex = renderer.getPixel(id);
+              const ratio = renderer.getRatio(id);
+              return {{
+                id,
+                label: labelById[id],
+                x_px: apex.x,
+                y_px: apex.y,
+                x_ratio: ratio.x,
+                y_ratio: ratio.y,
+              }};
+            }});
+            emitIfChanged(eventType, activeId, renderer.size(), points);
+          }};
+          const renderer = window.CephCanvasRenderer.create({{
+            container: wrapper,
+            insertBefore: coords,
+            image,
+            points: payload.points,
+            planes: Array.isArray(payload.planes) ? payload.planes : [],
+            markerSize: defaultSize,
+            showLabels,
+            labelFormatter: (id, label, x, y) => `${{label}} (${{Math.round(x)}}, ${{Math.round(y)}})`,
+            onDragStart: (id) => {{
+              describe(id);
+              if (telemetry) telemetry.dragStart();
+            }},
+            onDrag: (id, event) => {{
+              describe(id);
+              if (telemetry) telemetry.input(event ? event.timeStamp : 0);
+            }},
+            onDragEnd: (id, eventType) => {{
+              describe(id);
+              if (telemetry) telemetry.dragEnd();
+              emitCanvasState(eventType, id);
+            }},
+          }});
+          isMarkerDragging = () => renderer.isDragging();
+          const canvasLayout = () => {{
+            renderer.layout();
+            renderContours();
+            coords.textContent = "位置情報を取得しました。";
+            emitCanvasState("layout", null);
+          }};
+          window.cephObserveResize(wrapper, canvasLayout);
+          if (image.complete && image.naturalWidth) {{
+            canvasLayout();
+          }} else {{
+            image.addEventListener("load", canvasLayout, {{ once: true }});
+          }}
+          emitCanvasState("init", null);
+          return;
+        }}
+
         const clamp = (value, min, max) => Math.min(Math.max(value, min), max);
         const markers = [];
         const markerById = {{}};
         const dragOffset = {{ x: 0, y: 0 }};
         let activeMarker = null;
+        isMarkerDragging = () => activeMarker !== null;
 
         const planeDefs = Array.isArray(payload.planes) ? payload.planes : [];
         const planeLines = [];
@@ -421,8 +1257,6 @@ def render_ceph_component(
         }};
 
         const emitState = (eventType, activeId) => {{
-          const width = Math.round(stage.clientWidth || 0);
-          const height = Math.round(stage.clientHeight || 0);
           const points = markers.map((marker) => ({{
             id: marker.dataset.id,
             label: marker.dataset.label,
@@ -431,12 +1265,12 @@ def render_ceph_component(
             x_ratio: parseFloat(marker.dataset.ratioX || "0"),
             y_ratio: parseFloat(marker.dataset.ratioY || "0"),
           }}));
-          emitValue({{
-            event: eventType,
-            active_id: activeId || null,
-            stage: {{ width, height }},
-            points,
-          }});
+          emitIfChanged(
+            eventType,
+            activeId,
+            {{ width: stage.clientWidth, height: stage.clientHeight }},
+            points
+          );
         }};
 
         const updatePlanes = () => {{
@@ -497,6 +1331,18 @@ def render_ceph_component(
           pin.style.borderBottom = `${{size}}px solid ${{pt.color || "#f97316"}}`;
           marker.appendChild(pin);
 
+          // 感度ハロー: 計測値への影響が大きいポイントほど大きく表示する
+          const halo = Number(pt.halo) || 0;
+          if (halo > 0) {{
+            const haloEl = document.createElement("div");
+            haloEl.className = "halo";
+            const diameter = size * (0.8 + 1.6 * halo);
+            haloEl.style.width = `${{diameter}}px`;
+            haloEl.style.height = `${{diameter}}px`;
+            haloEl.style.opacity = String(0.35 + 0.65 * halo);
+            marker.insertBefore(haloEl, pin);
+          }}
+
           if (showLabels) {{
             const label = document.createElement("div");
             label.className = "label";
@@ -515,6 +1361,7 @@ def render_ceph_component(
             dragOffset.y = event.clientY - (stageRect.top + top);
             activeMarker = marker;
             marker.classList.add("dragging");
+            if (telemetry) telemetry.dragStart();
             try {{
               marker.setPointerCapture(event.pointerId);
             }} catch (err) {{}}
@@ -543,6 +1390,7 @@ def render_ceph_component(
         const updateLayout = () => {{
           markers.forEach(setFromRatios);
           updatePlanes();
+          renderContours();
           coords.textContent = "位置情報を取得しました。";
           emitState("layout", null);
         }};
@@ -556,6 +1404,7 @@ def render_ceph_component(
           const top = event.clientY - stageRect.top - dragOffset.y;
           setPosition(activeMarker, left, top);
           updatePlanes();
+          if (telemetry) telemetry.input(event.timeStamp);
           coords.textContent = `${{activeMarker.dataset.baseLabel}}: x=${{Math.round(parseFloat(activeMarker.dataset.left || "0"))}}, y=${{Math.round(parseFloat(activeMarker.dataset.top || "0"))}}`;
           event.preventDefault();
         }};
@@ -572,13 +1421,14 @@ def render_ceph_component(
           coords.textContent = `${{activeMarker.dataset.baseLabel}}: x=${{Math.round(parseFloat(activeMarker.dataset.left || "0"))}}, y=${{Math.round(parseFloat(activeMarker.dataset.top || "0"))}}`;
           updatePlanes();
           activeMarker = null;
+          if (telemetry) telemetry.dragEnd();
           emitState(eventType, activeId);
         }};
 
         window.addEventListener("pointermove", handlePointerMove, {{ passive: false }});
         window.addEventListener("pointerup", stopDragging("pointerup"), {{ passive: false }});
         window.addEventListener("pointercancel", stopDragging("pointercancel"), {{ passive: false }});
-        window.addEventListener("resize", () => {{
+        window.cephObserveResize(wrapper, () => {{
           updateLayout();
           coords.textContent = "レイアウトを再調整しました。";
         }});
@@ -597,7 +1447,8 @@ def render_ceph_component(
     </script>
     """
 
-    return components.html(html, height=820, scrolling=False)
+    st.session_state.ceph_rendered_html_bytes = len(html)
+    return html_component(html, height=820, key=COMPONENT_KEY)
 
 
 def angle_between(p1: Tuple[float, float], p2: Tuple[float, float], p3: Tuple[float, float], p4: Tuple[float, float]) -> float:
@@ -632,6 +1483,181 @@ def compute_angles(points_px: Dict[str, Tuple[float, float]]) -> Dict[str, float
     return results
 
 
+def compute_angles_batch(points: np.ndarray, point_ids: Sequence[str] = POINT_IDS) -> Dict[str, np.ndarray]:
+    """compute_angles のベクトル版。points は (..., L, 2) で、先頭の次元ごとの角度を返す。
+
+    座標成分ごとに取り出して計算するので、サンプル軸が連続したビュー
+    (``(2, L, n)`` 配列の転置など) を渡すと最も速い。
+    """
+    index = {pid: idx for idx, pid in enumerate(point_ids)}
+    batch_shape = points.shape[:-2]
+    results: Dict[str, np.ndarray] = {}
+    for name, ((a1, a2), (b1, b2)) in ANGLE_DEFINITIONS:
+        if any(pid not in index for pid in (a1, a2, b1, b2)):
+            results[name] = np.full(batch_shape, np.nan)
+            continue
+        ax = points[..., index[a1], 0] - points[..., index[a2], 0]
+        ay = points[..., index[a1], 1] - points[..., index[a2], 1]
+        bx = points[..., index[b1], 0] - points[..., index[b2], 0]
+        by = points[..., index[b1], 1] - points[..., index[b2], 1]
+        cross = np.abs(ax * by - ay * bx)
+        dot = ax * bx + ay * by
+        # 長さ 0 のベクトルは compute_angles と同じく NaN にする
+        value = np.where((cross == 0) & (dot == 0), np.nan, np.degrees(np.arctan2(cross, dot)))
+        if name == "Convexity":
+            value = 180.0 - value
+        results[name] = value
+    results["SNA-SNB diff"] = results["SNA"] - results["SNB"]
+    return results
+
+
+def compute_linear_batch(
+    points: np.ndarray, mm_per_px: Optional[float] = None, point_ids: Sequence[str] = POINT_IDS
+) -> Dict[str, np.ndarray]:
+    """距離・直線距離・FH 射影・比率をまとめて計算する。points は (..., L, 2)。
+
+    mm_per_px があれば長さを mm、なければ入力と同じ px 単位で返す。比率は %。
+    """
+    index = {pid: idx for idx, pid in enumerate(point_ids)}
+    scale = mm_per_px or 1.0
+
+    def xy(pid: str) -> Tuple[np.ndarray, np.ndarray]:
+        return points[..., index[pid], 0], points[..., index[pid], 1]
+
+    # FH の前方向 (Po→Or) の単位ベクトルと、その下向き法線
+    (px0, py0), (px1, py1) = xy(PROJECTION_PLANE[0]), xy(PROJECTION_PLANE[1])
+    fh_length = np.hypot(px1 - px0, py1 - py0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ux, uy = (px1 - px0) / fh_length, (py1 - py0) / fh_length
+    nx, ny = -uy, ux
+    flip = np.where(ny < 0, -1.0, 1.0)
+    nx, ny = nx * flip, ny * flip
+
+    results: Dict[str, np.ndarray] = {}
+    for name, (start, end) in DISTANCE_DEFINITIONS:
+        (x0, y0), (x1, y1) = xy(start), xy(end)
+        results[name] = np.hypot(x1 - x0, y1 - y0) * scale
+    for name, (pid, (start, end)) in LINE_DISTANCE_DEFINITIONS:
+        (x, y), (x0, y0), (x1, y1) = xy(pid), xy(start), xy(end)
+        dx, dy = x1 - x0, y1 - y0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            signed = ((x - x0) * dy - (y - y0) * dx) / np.hypot(dx, dy)
+        # 法線 (dy, -dx) が前方を向くように符号をそろえる
+        results[name] = signed * np.sign(dy * ux - dx * uy) * scale
+    for name, (first, second, axis) in PROJECTION_DEFINITIONS:
+        (x0, y0), (x1, y1) = xy(first), xy(second)
+        if axis == "along":
+            results[name] = ((x0 - x1) * ux + (y0 - y1) * uy) * scale
+        else:
+            results[name] = ((x0 - x1) * nx + (y0 - y1) * ny) * scale
+
+    (ax0, ay0), (ax1, ay1) = xy("Ar"), xy("Pm")
+    (bx0, by0), (bx1, by1) = xy("Me"), xy("Am")
+    rx, ry, mx, my = ax1 - ax0, ay1 - ay0, bx1 - bx0, by1 - by0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((bx0 - ax0) * my - (by0 - ay0) * mx) / (rx * my - ry * mx)
+    gx, gy = ax0 + t * rx, ay0 + t * ry
+    sx, sy = xy("S")
+    results["S-Go"] = np.hypot(gx - sx, gy - sy) * scale
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results["S-Go/N-Me"] = 100.0 * results["S-Go"] / results["N-Me"]
+    return results
+
+
+def compute_measurements_batch(
+    points: np.ndarray, mm_per_px: Optional[float] = None, point_ids: Sequence[str] = POINT_IDS
+) -> Dict[str, np.ndarray]:
+    """角度と直線計測を 1 回の呼び出しでまとめて評価する。"""
+    results = compute_angles_batch(points, point_ids)
+    results.update(compute_linear_batch(points, mm_per_px, point_ids))
+    return results
+
+
+def measure_native(points_native: Dict[str, Tuple[float, float]], mm_per_px: Optional[float] = None) -> Dict[str, float]:
+    """原画像 px のランドマークから全計測値を求める。表・ポリゴン・信頼区間はすべてこの値を使う。
+
+    ステージ px は iframe の大きさで縦横比が変わるため、角度もここで原画像座標から計算する。
+    """
+    values = compute_measurements_batch(points_to_array(points_native, POINT_IDS), mm_per_px)
+    return {name: float(value) for name, value in values.items()}
+
+
+def measure_record(record: CaseRecord) -> Dict[str, float]:
+    """保存済み症例の計測値をランドマークから計算し直す (レポート・再計測用)。"""
+    return measure_native(record.points, record.mm_per_px)
+
+
+def measurement_units(calibrated: bool) -> Dict[str, str]:
+    units = {name: "°" for name in RESULT_ORDER}
+    units.update({name: "mm" if calibrated else "px" for name in LINEAR_RESULT_ORDER})
+    units.update({name: "%" for name in RATIO_RESULTS})
+    return units
+
+
+def compute_angle_jacobian(
+    points: np.ndarray, point_ids: Sequence[str] = POINT_IDS
+) -> Tuple[List[str], np.ndarray]:
+    """RESULT_ORDER の各計測値のランドマーク座標に対する解析的な勾配 (°/px)。
+
+    points (..., L, 2) に対して (..., M, L, 2) を返す。2 本のベクトル a, b のなす角
+    θ について s = sign(a×b) とすると ∂θ/∂a = -s (-a_y, a_x) / |a|²、
+    ∂θ/∂b = s (-b_y, b_x) / |b|²。端点への配分は接続行列でまとめて行う。
+    """
+    index = {pid: idx for idx, pid in enumerate(point_ids)}
+    count = len(point_ids)
+    names = [name for name, _ in ANGLE_DEFINITIONS]
+    incidence_a = np.zeros((len(names), count))
+    incidence_b = np.zeros((len(names), count))
+    valid = np.ones(len(names), dtype=bool)
+    for row, (name, ((a1, a2), (b1, b2))) in enumerate(ANGLE_DEFINITIONS):
+        if any(pid not in index for pid in (a1, a2, b1, b2)):
+            valid[row] = False
+            continue
+        incidence_a[row, index[a1]] += 1.0
+        incidence_a[row, index[a2]] -= 1.0
+        incidence_b[row, index[b1]] += 1.0
+        incidence_b[row, index[b2]] -= 1.0
+    a = np.einsum("ml,...ld->...md", incidence_a, points)
+    b = np.einsum("ml,...ld->...md", incidence_b, points)
+    sign = np.sign(a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0])[..., None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad_a = -sign * np.stack([-a[..., 1], a[..., 0]], axis=-1) / (a ** 2).sum(axis=-1, keepdims=True)
+        grad_b = sign * np.stack([-b[..., 1], b[..., 0]], axis=-1) / (b ** 2).sum(axis=-1, keepdims=True)
+    jacobian = np.degrees(
+        grad_a[..., :, None, :] * incidence_a[:, :, None] + grad_b[..., :, None, :] * incidence_b[:, :, None]
+    )
+    # Convexity は 180° から引いた値なので符号を反転する
+    flip = np.array([-1.0 if name == "Convexity" else 1.0 for name in names])
+    jacobian = jacobian * flip[:, None, None]
+    jacobian[..., ~valid, :, :] = np.nan
+    by_name = {name: jacobian[..., row, :, :] for row, name in enumerate(names)}
+    by_name["SNA-SNB diff"] = by_name["SNA"] - by_name["SNB"]
+    return list(RESULT_ORDER), np.stack([by_name[name] for name in RESULT_ORDER], axis=-3)
+
+
+def compute_sensitivity(
+    points_px: Dict[str, Tuple[float, float]], px_per_mm: float
+) -> Dict[str, Tuple[float, Optional[str]]]:
+    """ポイントごとに、1 mm ずれたとき最も大きく動く計測値とその変化量 (σ) を返す。"""
+    names, jacobian = compute_angle_jacobian(points_to_array(points_px, POINT_IDS))
+    sds = np.array([REFERENCE_DATA[name][1] for name in names])
+    sigma_per_mm = np.hypot(jacobian[..., 0], jacobian[..., 1]) * px_per_mm / sds[:, None]
+    sigma_per_mm = np.where(np.isfinite(sigma_per_mm), sigma_per_mm, -1.0)
+    top = sigma_per_mm.argmax(axis=0)
+    result: Dict[str, Tuple[float, Optional[str]]] = {}
+    for idx, pid in enumerate(POINT_IDS):
+        score = float(sigma_per_mm[top[idx], idx])
+        result[pid] = (score, names[top[idx]]) if score > 0 else (0.0, None)
+    return result
+
+
+def sensitivity_halos(sensitivity: Dict[str, Tuple[float, Optional[str]]]) -> Dict[str, float]:
+    peak = max((score for score, _ in sensitivity.values()), default=0.0)
+    if peak <= 0:
+        return {}
+    return {pid: round(score / peak, 3) for pid, (score, _) in sensitivity.items()}
+
+
 def format_float(value: float, digits: int = 2) -> str:
     if value is None or math.isnan(value):
         return "—"
@@ -639,42 +1665,169 @@ def format_float(value: float, digits: int = 2) -> str:
 
 
 def build_points_px(stage: Dict[str, float], state: Dict[str, Dict[str, float]]) -> Dict[str, Tuple[float, float]]:
+    """比率 × 現在のステージ寸法で px 座標を出す (状態は比率だけを正とする)。"""
     width = stage.get("width") or BASE_CANVAS_WIDTH
     height = stage.get("height") or BASE_CANVAS_HEIGHT
-    points: Dict[str, Tuple[float, float]] = {}
-    for pid, info in state.items():
-        x_px = info.get("x_px")
-        y_px = info.get("y_px")
-        if x_px is None or y_px is None:
-            x_px = info.get("x_ratio", 0.5) * width
-            y_px = info.get("y_ratio", 0.5) * height
-        points[pid] = (float(x_px), float(y_px))
-    return points
-
-
-def update_state_from_component(component_value: Dict) -> None:
-    if not component_value:
+    return {
+        pid: (float(info.get("x_ratio", 0.5) * width), float(info.get("y_ratio", 0.5) * height))
+        for pid, info in state.items()
+    }
+
+
+def apply_component_traces(component_value: Dict) -> bool:
+    """値に入っている輪郭・校正線を反映し、変化があれば True を返す。"""
+    changed = False
+    contours = dict(component_value.get("contours") or {})
+    ruler = contours.pop(CALIBRATION_ID, None)
+    image_info = st.session_state.get("ceph_image_info")
+    if ruler and len(ruler) >= 2 and image_info:
+        # 校正線は端点だけを原画像座標で保持する
+        calibration = {
+            "image_key": image_info["key"],
+            "start": (ruler[0][0] * image_info["width"], ruler[0][1] * image_info["height"]),
+            "end": (ruler[-1][0] * image_info["width"], ruler[-1][1] * image_info["height"]),
+        }
+        if calibration != st.session_state.get("ceph_calibration"):
+            st.session_state.ceph_calibration = calibration
+            changed = True
+    for contour_id, raw in contours.items():
+        if contour_id not in CONTOUR_IDS:
+            continue
+        contour = normalize_contour(raw)
+        if contour and contour != st.session_state.ceph_contours.get(contour_id):
+            st.session_state.ceph_contours[contour_id] = contour
+            changed = True
+    return changed
+
+
+def request_site() -> str:
+    try:
+        return st.context.headers.get("Host", "") or ""
+    except Exception:
+        return ""
+
+
+def record_client_metrics(component_value: Dict) -> None:
+    """相乗りしてきたドラッグ計測を集計先に足し込む (同じ値の再送は 1 回だけ)。"""
+    report = component_value.get("telemetry")
+    if not report:
         return
+    key = (component_value.get("instance"), component_value.get("seq") or 0)
+    if st.session_state.get("ceph_telemetry_key") == key:
+        return
+    st.session_state.ceph_telemetry_key = key
+    METRICS_SINK.record(report, request_site())
+
+
+def update_state_from_component(component_value: Dict) -> bool:
+    """コンポーネント値を反映し、状態が変化した場合に True を返す。
+
+    値には描画時の状態バージョンと、iframe ごとの instance / 連番 seq が入っている。
+    Streamlit は再実行のたびに直前の値を返すため、現在と異なるバージョンの値や
+    反映済みの seq (エコー) は無視し、実際に動いたポイントだけを書き込む。
+    ライブ同期 (LIVE_SYNC_EVENTS) の値はバージョンを進めず、確定イベントでまとめて進める。
+    """
+    if not component_value:
+        return False
+    # 計測は古いバージョンの値でも有効なので、フィルタより先に取り込む
+    record_client_metrics(component_value)
+    if "points" not in component_value:
+        # 計測だけを運ぶ値 (ライブ同期が無効な軽量ビュー)
+        return False
+    version = component_value.get("version")
+    if version is not None:
+        sync_key = (component_value.get("instance"), component_value.get("seq") or 0)
+        last_key = st.session_state.get("ceph_sync_key")
+        if last_key and last_key[0] == sync_key[0] and sync_key[1] <= last_key[1]:
+            return False
+        st.session_state.ceph_sync_key = sync_key
+        if version != st.session_state.ceph_state_version:
+            # ポイントは古い描画に対する差分なので捨てるが、トレースは丸ごと置き換えなので取り込む
+            if not apply_component_traces(component_value):
+                return False
+            st.session_state.ceph_state_version += 1
+            st.session_state.ceph_last_event = component_value.get("event")
+            return True
+
+    changed = apply_component_traces(component_value)
     stage = component_value.get("stage") or {}
     width = stage.get("width") or st.session_state.ceph_stage.get("width")
     height = stage.get("height") or st.session_state.ceph_stage.get("height")
-    if width and height:
+    if width and height and (
+        width != st.session_state.ceph_stage.get("width")
+        or height != st.session_state.ceph_stage.get("height")
+    ):
         st.session_state.ceph_stage = {"width": width, "height": height}
+        changed = True
+    event = component_value.get("event")
+    live_origin = st.session_state.ceph_live_origin
+    deltas = []
     points = component_value.get("points") or []
     for entry in points:
         pid = entry.get("id")
         if pid not in st.session_state.ceph_points:
             st.session_state.ceph_points[pid] = {}
-        st.session_state.ceph_points[pid].update(
-            {
-                "x_ratio": entry.get("x_ratio", st.session_state.ceph_points[pid].get("x_ratio", 0.5)),
-                "y_ratio": entry.get("y_ratio", st.session_state.ceph_points[pid].get("y_ratio", 0.5)),
-                "x_px": entry.get("x_px"),
-                "y_px": entry.get("y_px"),
-            }
-        )
-    st.session_state.ceph_last_event = component_value.get("event")
-    st.session_state.ceph_active_id = component_value.get("active_id")
+        current = st.session_state.ceph_points[pid]
+        old_xy = (current.get("x_ratio"), current.get("y_ratio"))
+        # px はそのときの iframe の寸法に依存するので保持しない (比率 × ステージで都度求める)
+        updated = {
+            "x_ratio": entry.get("x_ratio", current.get("x_ratio", 0.5)),
+            "y_ratio": entry.get("y_ratio", current.get("y_ratio", 0.5)),
+        }
+        if (
+            abs(updated["x_ratio"] - current.get("x_ratio", float("nan"))) <= RATIO_EPSILON
+            and abs(updated["y_ratio"] - current.get("y_ratio", float("nan"))) <= RATIO_EPSILON
+        ):
+            continue
+        current.update(updated)
+        current.pop("x_px", None)
+        current.pop("y_px", None)
+        changed = True
+        new_xy = (updated["x_ratio"], updated["y_ratio"])
+        if None not in old_xy and old_xy != new_xy:
+            if event in LIVE_SYNC_EVENTS:
+                live_origin.setdefault(pid, old_xy)
+            else:
+                deltas.append((pid, live_origin.pop(pid, old_xy), new_xy))
+    if event in LIVE_SYNC_EVENTS:
+        if changed:
+            st.session_state.ceph_live_dirty = True
+    elif changed or st.session_state.get("ceph_live_dirty"):
+        # ライブ同期で動いたまま確定値に差分がなかったポイントも 1 操作として記録する
+        for pid, origin in live_origin.items():
+            info = st.session_state.ceph_points.get(pid, {})
+            deltas.append((pid, origin, (info.get("x_ratio"), info.get("y_ratio"))))
+        live_origin.clear()
+        st.session_state.ceph_history.record(deltas)
+        st.session_state.ceph_state_version += 1
+        st.session_state.ceph_live_dirty = False
+    if changed:
+        st.session_state.ceph_last_event = event
+        st.session_state.ceph_active_id = component_value.get("active_id")
+    return changed
+
+
+def apply_pending_component_value(key: str) -> bool:
+    """前回の実行で届いたコンポーネント値を、コンポーネントを描く前に反映する。
+
+    コンポーネントの戻り値は描画後にしか得られないため、それより前に描く UI や
+    iframe へ返す内容が 1 実行ぶん古くなる。描画後にも同じ値が返るが、反映済みの seq として無視される。
+    """
+    component_value = st.session_state.get(key)
+    if not isinstance(component_value, dict):
+        return False
+    return update_state_from_component(component_value)
+
+
+def apply_history_step(step) -> None:
+    """undo / redo を現在のポイント状態に適用し、コンポーネントを描き直させる。"""
+    moved = step(st.session_state.ceph_points)
+    if not moved:
+        return
+    st.session_state.ceph_live_origin.clear()
+    st.session_state.ceph_state_version += 1
+    st.session_state.ceph_last_event = "undo" if step.__name__ == "undo" else "redo"
+    st.session_state.ceph_active_id = moved[0] if len(moved) == 1 else None
 
 
 def build_reference_text(name: str) -> str:
@@ -697,39 +1850,365 @@ def compute_sigma(value: float, name: str) -> Optional[float]:
     return (value - mean) / sd
 
 
-def create_results_table(angles: Dict[str, float]) -> List[Dict[str, str]]:
+def format_interval(low: Optional[float], high: Optional[float], digits: int = 2) -> str:
+    if low is None or high is None or math.isnan(low) or math.isnan(high):
+        return "—"
+    return f"{low:.{digits}f} – {high:.{digits}f}"
+
+
+def create_results_table(
+    measurements: Dict[str, float],
+    intervals: Optional[Dict[str, IntervalEstimate]] = None,
+    units: Optional[Dict[str, str]] = None,
+) -> List[Dict[str, str]]:
     rows: List[Dict[str, str]] = []
-    for name in RESULT_ORDER:
-        formatted_value = format_float(angles.get(name))
-        sigma = compute_sigma(angles.get(name, float("nan")), name)
+    ci_label = f"{UNCERTAINTY_LEVEL:.0%} CI"
+    units = units or measurement_units(calibrated=False)
+    for name in RESULT_ORDER + LINEAR_RESULT_ORDER:
+        formatted_value = format_float(measurements.get(name, float("nan")))
+        sigma = compute_sigma(measurements.get(name, float("nan")), name)
+        row = {
+            "計測項目": name,
+            "値": formatted_value,
+            "単位": units.get(name, ""),
+            "平均±SD": build_reference_text(name),
+            "偏差 (σ)": format_float(sigma, digits=2) if sigma is not None else "—",
+        }
+        if intervals is not None:
+            estimate = intervals.get(name)
+            if estimate is None:
+                row[ci_label] = "—"
+                row[f"σ {ci_label}"] = "—"
+            else:
+                row[ci_label] = format_interval(estimate.low, estimate.high)
+                row[f"σ {ci_label}"] = format_interval(
+                    compute_sigma(estimate.low, name), compute_sigma(estimate.high, name)
+                )
+        rows.append(row)
+    return rows
+
+
+def save_case(
+    case_id: str,
+    age: Optional[float],
+    sex: str,
+    points_native: Dict[str, Tuple[float, float]],
+    image_info: Dict,
+    mm_per_px: Optional[float],
+    rater: str = "",
+    image_data_url: Optional[str] = None,
+) -> bool:
+    """症例をアーカイブに保存し、同じトランザクションでコホート統計・σ 分布・類似症例の索引を更新する。
+
+    計測値は表示中の iframe の大きさに左右されないよう、原画像座標のランドマークから計算し直して保存する。
+    評価者別のトレースも保存し、評価者間信頼性の集計を差分更新する。別の評価者の保存は
+    トレースだけを足し、症例の主トレース (統計や索引に入る値) は変えない。
+    画像は内容キーで 1 回だけ保存し、ギャラリー用のサムネイルを背景で作る。
+    """
+    if image_data_url:
+        mime = image_data_url[5 : image_data_url.find(";")] or "image/png"
+        default_image_store().put(image_info["key"], data_url_to_bytes(image_data_url), mime)
+    store = default_cohort_store(RESULT_ORDER)
+    density = default_density_store(REFERENCE_DATA)
+    reliability = default_reliability_store(POINT_IDS, RESULT_ORDER, compute_angles_batch)
+    similar = default_similarity_index(REFERENCE_DATA, RESULT_ORDER, measure_record)
+
+    def on_insert(conn, inserted: CaseRecord) -> None:
+        store.fold(conn, inserted)
+        density.fold(conn, inserted)
+        similar.fold(conn, inserted)
+
+    def on_update(conn, before: CaseRecord, after: CaseRecord) -> None:
+        store.refold(conn, before, after)
+        density.refold(conn, before, after)
+        similar.fold(conn, after)
+
+    record = CaseRecord(
+        case_id=case_id,
+        points=points_native,
+        measurements=measure_native(points_native, mm_per_px),
+        age=age,
+        sex=sex,
+        image_key=image_info["key"],
+        image_size=(image_info["width"], image_info["height"]),
+        mm_per_px=mm_per_px,
+        rater=rater,
+    )
+    return store.archive.save(record, on_insert=on_insert, on_tracing=reliability.fold, on_update=on_update)
+
+
+def render_case_report(record: CaseRecord, image_data_url: str, fmt: str) -> bytes:
+    """トレース図レポート。ダウンロードのときに (スクリプトの外で) 呼ばれるのでセッション状態には触らない。"""
+    renderer = default_report_renderer(REPORT_LAYOUT, measure_record)
+    return renderer.render(record, data_url_to_bytes(image_data_url), fmt).read_bytes()
+
+
+def create_reliability_tables(raters: int) -> Tuple[int, List[Dict[str, str]], List[Dict[str, str]], List[Dict[str, str]]]:
+    """(症例数, ICC 表, Bland–Altman 表, ランドマーク MRE 表)。"""
+    stats = default_reliability_store(POINT_IDS, RESULT_ORDER, compute_angles_batch).stats(raters)
+    icc1, icc2 = stats.icc()
+    icc_rows = [
+        {
+            "計測項目": name,
+            "症例数": str(int(stats.icc_n[m])),
+            "ICC(1,1)": format_float(icc1[m], digits=3),
+            "ICC(2,1)": format_float(icc2[m], digits=3),
+        }
+        for m, name in enumerate(stats.measures)
+    ]
+    bias, sd = stats.bland_altman()
+    pair_a, pair_b = rater_pairs(raters)
+    ba_rows = [
+        {
+            "計測項目": name,
+            "評価者": f"{b + 1} − {a + 1}",
+            "バイアス": format_float(bias[m, p]),
+            f"一致限界 (±{LOA_Z}SD)": format_interval(bias[m, p] - LOA_Z * sd[m, p], bias[m, p] + LOA_Z * sd[m, p]),
+        }
+        for m, name in enumerate(stats.measures)
+        for p, (a, b) in enumerate(zip(pair_a, pair_b))
+    ]
+    mre, mre_sd = stats.radial_error()
+    mre_rows = [
+        {"ポイント": pid, "MRE (mm)": format_float(mre[i]), "SD (mm)": format_float(mre_sd[i])}
+        for i, pid in enumerate(stats.point_ids)
+    ]
+    return stats.cases, icc_rows, ba_rows, mre_rows
+
+
+def create_similar_cases_table(
+    measurements: Dict[str, float], k: int, exclude: Optional[str] = None
+) -> List[Dict[str, str]]:
+    """σ ベクトルが近い保存済み症例。差の大きい項目も添える。"""
+    archive = default_archive()
+    index = default_similarity_index(REFERENCE_DATA, RESULT_ORDER, measure_record)
+    sex_labels = {"M": "男性", "F": "女性"}
+    rows: List[Dict[str, str]] = []
+    for other_id, distance in index.query(measurements, k, exclude):
+        record = archive.get(other_id)
+        if record is None:
+            continue
+        other_measurements = index.measurements(record)
+        gaps = []
+        for name in RESULT_ORDER:
+            own = compute_sigma(measurements.get(name, float("nan")), name)
+            other = compute_sigma(other_measurements.get(name, float("nan")), name)
+            if own is not None and other is not None:
+                gaps.append((abs(own - other), name))
         rows.append(
             {
-                "計測項目": name,
-                "角度 (°)": formatted_value,
-                "平均±SD": build_reference_text(name),
-                "偏差 (σ)": format_float(sigma, digits=2) if sigma is not None else "—",
+                "症例 ID": other_id,
+                "距離 (σ)": format_float(distance),
+                "年齢": f"{record.age:g}" if record.age is not None else "—",
+                "性別": sex_labels.get(record.sex, "不明"),
+                "差の大きい項目": ", ".join(f"{name} ({gap:.1f}σ)" for gap, name in sorted(gaps, reverse=True)[:2] if gap >= 0.05),
             }
         )
     return rows
 
 
-def build_points_table(points_px: Dict[str, Tuple[float, float]]) -> List[Dict[str, str]]:
+def create_cohort_table(band: str, sex: str, measurements: Dict[str, float]) -> Tuple[List[Dict[str, str]], int]:
+    """比較表と、分位点・順位にまだ反映されていない修正の件数。"""
+    cells = default_cohort_store(RESULT_ORDER).cells(band, sex)
     rows: List[Dict[str, str]] = []
-    for item in CEPH_POINTS:
-        pid = item["id"]
-        px = points_px.get(pid, (float("nan"), float("nan")))
+    for name in RESULT_ORDER:
+        cell = cells.get(name)
+        if cell is None:
+            continue
+        summary = cell.summary()
+        value = measurements.get(name, float("nan"))
+        rank = cell.sketch.rank(value)
         rows.append(
             {
-                "Point": pid,
-                "x (px)": format_float(px[0], digits=1),
-                "y (px)": format_float(px[1], digits=1),
+                "計測項目": name,
+                "n": str(summary["n"]),
+                "平均±SD": f"{format_float(summary['mean'])} ± {format_float(summary['sd'])}",
+                "5%": format_float(summary["q05"]),
+                "25%": format_float(summary["q25"]),
+                "中央値": format_float(summary["q50"]),
+                "75%": format_float(summary["q75"]),
+                "95%": format_float(summary["q95"]),
+                "現在値": format_float(value),
+                "順位 (%)": format_float(rank * 100, digits=0),
             }
         )
+    return rows, max((cell.stale for cell in cells.values()), default=0)
+
+
+def compute_uncertainty(
+    points_native: Dict[str, Tuple[float, float]],
+    samples: int,
+    px_per_mm: float,
+    mm_per_px: Optional[float] = None,
+) -> Dict[str, IntervalEstimate]:
+    """モンテカルロで計測値の信頼区間を求める。同じランドマーク状態では再計算しない。
+
+    座標は原画像 px、px_per_mm は誤差モデル (mm) の換算に、mm_per_px は長さの表示単位に使う。
+    """
+    key = state_key(points_native, samples, px_per_mm, mm_per_px, UNCERTAINTY_LEVEL)
+    cached = st.session_state.get("ceph_uncertainty_cache")
+    if cached and cached[0] == key:
+        return cached[1]
+    center = points_to_array(points_native, POINT_IDS)
+    estimates = monte_carlo_intervals(
+        center,
+        POINT_IDS,
+        lambda points: compute_measurements_batch(points, mm_per_px),
+        samples,
+        px_per_mm,
+        UNCERTAINTY_LEVEL,
+    )
+    st.session_state.ceph_uncertainty_cache = (key, estimates)
+    return estimates
+
+
+def build_points_table(
+    points_px: Dict[str, Tuple[float, float]],
+    sensitivity: Optional[Dict[str, Tuple[float, Optional[str]]]] = None,
+) -> List[Dict[str, str]]:
+    rows: List[Dict[str, str]] = []
+    for item in CEPH_POINTS:
+        pid = item["id"]
+        px = points_px.get(pid, (float("nan"), float("nan")))
+        row = {
+            "Point": pid,
+            "x (px)": format_float(px[0], digits=1),
+            "y (px)": format_float(px[1], digits=1),
+        }
+        if sensitivity is not None:
+            score, measure = sensitivity.get(pid, (0.0, None))
+            row["感度 (σ/mm)"] = format_float(score) if measure else "—"
+            row["最も影響する計測"] = measure or "—"
+        rows.append(row)
     return rows
 
 
-def build_polygon_figure(angles: Dict[str, float]) -> Optional[go.Figure]:
-    """日本人標準枠と測定値ポリゴンを重ねて描画する。"""
+def create_contour_table(
+    measurements: Dict[str, float], units: Optional[Dict[str, str]] = None
+) -> List[Dict[str, str]]:
+    units = units or CONTOUR_UNITS
+    return [
+        {
+            "計測項目": name,
+            "値": format_float(measurements.get(name, float("nan"))),
+            "単位": units.get(name, ""),
+        }
+        for name in CONTOUR_RESULT_ORDER
+    ]
+
+
+def baseline_points_native(image_info: Dict) -> Dict[str, Tuple[float, float]]:
+    """比較トレースの原画像座標。保存時の画像サイズが無い (古い作業状態の) ときは現在の画像で代用する。"""
+    baseline = st.session_state.ceph_baseline
+    return build_points_native(baseline["points"], baseline.get("image") or image_info)
+
+
+def build_overlay_payload(registration: str, allow_scale: bool, image_info: Dict) -> Optional[Dict]:
+    """比較トレースを現在の画像座標へ重ね合わせ、コンポーネント用の比率にする。"""
+    baseline = st.session_state.ceph_baseline
+    if not baseline:
+        return None
+    current = points_to_array(build_points_native(st.session_state.ceph_points, image_info), POINT_IDS)
+    previous = points_to_array(baseline_points_native(image_info), POINT_IDS)
+    registered, _ = register_batch(current[None], previous[None], POINT_IDS, registration, allow_scale)
+    width, height = image_info["width"], image_info["height"]
+    return {
+        "color": "#e2e8f0",
+        "points": [
+            {"id": pid, "ratio_x": float(x / width), "ratio_y": float(y / height)}
+            for pid, (x, y) in zip(POINT_IDS, registered[0])
+            if math.isfinite(x) and math.isfinite(y)
+        ],
+    }
+
+
+def create_superimposition_tables(
+    registration: str, allow_scale: bool, image_info: Dict, mm_per_px: Optional[float] = None
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """比較トレース (治療前) 基準の点移動量表と角度変化表。原画像座標で重ね合わせ、校正済みなら mm で出す。"""
+    before_native = baseline_points_native(image_info)
+    after_native = build_points_native(st.session_state.ceph_points, image_info)
+    before = points_to_array(before_native, POINT_IDS)
+    after = points_to_array(after_native, POINT_IDS)
+    registered, _ = register_batch(before[None], after[None], POINT_IDS, registration, allow_scale)
+    dx, dy, distance = displacements(before[None], registered)
+    scale = mm_per_px or 1.0
+    unit = "mm" if mm_per_px else "px"
+    displacement_rows = [
+        {
+            "Point": pid,
+            f"Δx ({unit})": format_float(float(dx[0, idx]) * scale, digits=1),
+            f"Δy ({unit})": format_float(float(dy[0, idx]) * scale, digits=1),
+            f"移動量 ({unit})": format_float(float(distance[0, idx]) * scale, digits=1),
+        }
+        for idx, pid in enumerate(POINT_IDS)
+    ]
+    angles_before = compute_angles(before_native)
+    angles_after = compute_angles(after_native)
+    angle_rows = [
+        {
+            "計測項目": name,
+            "比較 (°)": format_float(angles_before.get(name, float("nan"))),
+            "現在 (°)": format_float(angles_after.get(name, float("nan"))),
+            "Δ (°)": format_float(angles_after.get(name, float("nan")) - angles_before.get(name, float("nan"))),
+        }
+        for name in RESULT_ORDER
+    ]
+    return displacement_rows, angle_rows
+
+
+def summarize_serial_batch(data, registration: str, allow_scale: bool) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """CSV の全症例をまとめて重ね合わせ、点ごとの移動量と症例ごとの角度変化を返す。"""
+    cases, before, after = load_serial_csv(data, POINT_IDS)
+    registered, _ = register_batch(before, after, POINT_IDS, registration, allow_scale)
+    dx, dy, distance = displacements(before, registered)
+    movement = pd.DataFrame(
+        {
+            "case_id": np.repeat(cases, len(POINT_IDS)),
+            "point": np.tile(POINT_IDS, len(cases)),
+            "dx": dx.ravel(),
+            "dy": dy.ravel(),
+            "distance": distance.ravel(),
+        }
+    )
+    angles_before = compute_angles_batch(before)
+    angles_after = compute_angles_batch(after)
+    angle_change = pd.DataFrame({"case_id": cases})
+    for name in RESULT_ORDER:
+        angle_change[name] = angles_after[name] - angles_before[name]
+    return movement, angle_change
+
+
+def cohort_density_layer(
+    histograms: Dict[str, SigmaHistogram],
+) -> Tuple[np.ndarray, List[Optional[Tuple[float, float, float]]]]:
+    """σ ヒストグラムをポリゴンの横軸へ写した (行 × POLYGON_GRID) の相対密度と、行ごとの四分位 (横軸)。
+
+    ポリゴンの横軸は行ごとに σ × sd_ratio × SD_PERCENT_SCALE なので、格子点ごとに σ へ戻してビンを引く。
+    密度は行ごとに最大値で割る (行の間の比較ではなく形を見るため)。
+    """
+    z = np.full((len(POLYGON_ROWS), len(POLYGON_GRID)), np.nan)
+    quartiles: List[Optional[Tuple[float, float, float]]] = [None] * len(POLYGON_ROWS)
+    for idx, row in enumerate(POLYGON_ROWS):
+        histogram = histograms.get(row.label)
+        if histogram is None or not histogram.n or not row.sd_ratio:
+            continue
+        scale = row.sd_ratio * SD_PERCENT_SCALE
+        density = histogram.density()
+        bins = np.searchsorted(SIGMA_EDGES, POLYGON_GRID / scale, side="right") - 1
+        inside = (bins >= 0) & (bins < len(density))
+        row_z = np.where(inside, density[np.clip(bins, 0, len(density) - 1)], 0.0)
+        peak = row_z.max()
+        z[idx] = row_z / peak if peak > 0 else row_z
+        q1, median, q3 = histogram.quantiles((0.25, 0.5, 0.75)) * scale
+        quartiles[idx] = (float(q1), float(median), float(q3))
+    return z, quartiles
+
+
+def build_polygon_figure(
+    angles: Dict[str, float], cohort: Optional[Dict[str, SigmaHistogram]] = None
+) -> Optional[go.Figure]:
+    """日本人標準枠と測定値ポリゴンを重ねて描画する。cohort があれば保存症例の分布も重ねる。"""
     rows = POLYGON_ROWS
     labels = [row.label for row in rows]
     means = [row.mean for row in rows]
@@ -799,6 +2278,45 @@ def build_polygon_figure(angles: Dict[str, float]) -> Optional[go.Figure]:
         layer="below",
     )
 
+    if cohort:
+        # 症例数によらずトレースは 2 本 (密度のヒートマップと中央値の線)
+        density_z, quartiles = cohort_density_layer(cohort)
+        fig.add_trace(
+            go.Heatmap(
+                x=POLYGON_GRID,
+                y=y_positions,
+                z=density_z,
+                zmin=0.0,
+                zmax=1.0,
+                colorscale=[[0.0, "rgba(13, 148, 136, 0)"], [1.0, "rgba(13, 148, 136, 0.75)"]],
+                showscale=False,
+                hoverinfo="skip",
+            )
+        )
+        quartile_rows = [idx for idx, value in enumerate(quartiles) if value is not None]
+        if quartile_rows:
+            fig.add_trace(
+                go.Scatter(
+                    x=[quartiles[i][1] for i in quartile_rows],
+                    y=[y_positions[i] for i in quartile_rows],
+                    mode="lines+markers",
+                    line=dict(color="#0f766e", width=2, dash="dot"),
+                    marker=dict(size=6, color="#0f766e"),
+                    customdata=[
+                        (
+                            rows[i].label,
+                            cohort[rows[i].label].n,
+                            *(value / (rows[i].sd_ratio * SD_PERCENT_SCALE) for value in quartiles[i]),
+                        )
+                        for i in quartile_rows
+                    ],
+                    hovertemplate="<b>%{customdata[0]}</b> (コホート n=%{customdata[1]})<br>"
+                    "中央値: %{customdata[3]:.2f} σ<br>四分位: %{customdata[2]:.2f} – %{customdata[4]:.2f} σ<extra></extra>",
+                    showlegend=False,
+                    name="コホート中央値",
+                )
+            )
+
     base_polygon_x = left_base + right_base[::-1] + [left_base[0]]
     base_polygon_y = y_positions + y_positions[::-1] + [y_positions[0]]
     fig.add_trace(
@@ -935,61 +2453,311 @@ def build_polygon_figure(angles: Dict[str, float]) -> Optional[go.Figure]:
 
 def main() -> None:
     ensure_session_state()
+    page = st.query_params.get(PAGE_PARAM)
+    if page in ("memory", "gallery"):
+        if page == "memory":
+            render_memory_diagnostics()
+        else:
+            render_case_gallery()
+        account_session_memory()
+        return
 
     st.title("🦷Cephalometric Analyzer (Streamlit)")
     st.caption("Streamlit ")
+    # サイドバーの undo / redo 可否などがコンポーネントより先に描かれるので、届いた値を先に反映する
+    apply_pending_component_value(COMPONENT_KEY)
 
     with st.sidebar:
         st.header("表示設定")
         show_labels = st.checkbox("ポイントラベルを表示", value=True)
         marker_size = st.slider("マーカーサイズ (px)", min_value=12, max_value=48, value=26, step=2)
+        renderer = st.radio(
+            "描画方式",
+            options=["dom", "canvas"],
+            format_func=lambda value: "DOM (標準)" if value == "dom" else "Canvas (多点向け)",
+            horizontal=True,
+        )
+        undo_col, redo_col = st.columns(2)
+        history = st.session_state.ceph_history
+        # コールバックはスクリプトより先に走るので、可否はこの実行で描くときには反映済みになる
+        undo_col.button(
+            "↶ 元に戻す",
+            width="stretch",
+            disabled=not history.can_undo,
+            on_click=apply_history_step,
+            args=(history.undo,),
+        )
+        redo_col.button(
+            "↷ やり直す",
+            width="stretch",
+            disabled=not history.can_redo,
+            on_click=apply_history_step,
+            args=(history.redo,),
+        )
         if st.button("ポイント位置を初期値に戻す", width="stretch"):
-            st.session_state.ceph_points = get_default_point_state()
+            default_state = get_default_point_state()
+            history.record(diff_states(st.session_state.ceph_points, default_state, RATIO_EPSILON))
+            st.session_state.ceph_points = default_state
             st.session_state.ceph_stage = {"width": BASE_CANVAS_WIDTH, "height": BASE_CANVAS_HEIGHT}
             st.session_state.ceph_last_event = "reset"
             st.session_state.ceph_active_id = None
-            st.experimental_rerun()
+            st.session_state.ceph_state_version += 1
+            st.rerun()
+
+        st.header("輪郭トレース")
+        contour_names = {
+            definition["id"]: definition["name"] for definition in CONTOUR_DEFINITIONS + [CALIBRATION_DEFINITION]
+        }
+        trace = st.selectbox(
+            "なぞる輪郭",
+            options=[None] + CONTOUR_IDS + [CALIBRATION_ID],
+            format_func=lambda value: "オフ (ポイント操作)" if value is None else contour_names[value],
+        )
+        traced = (
+            st.session_state.ceph_calibration is not None
+            if trace == CALIBRATION_ID
+            else trace in st.session_state.ceph_contours
+        )
+        if trace is not None and st.button("この輪郭を消去", width="stretch", disabled=not traced):
+            if trace == CALIBRATION_ID:
+                st.session_state.ceph_calibration = None
+            else:
+                st.session_state.ceph_contours.pop(trace, None)
+            st.session_state.ceph_last_event = "contour-clear"
+            st.session_state.ceph_state_version += 1
+        ruler_mm = st.number_input(
+            "校正線の実長 (mm)", min_value=0.1, max_value=500.0, value=DEFAULT_RULER_MM, step=1.0
+        )
+
+        st.header("重ね合わせ")
+        if st.button("現在のトレースを比較用に保存", width="stretch"):
+            # 比率と画像サイズで持ち、重ね合わせは原画像座標で行う (ステージの大きさに左右されない)
+            current_image = st.session_state.get("ceph_image_info")
+            st.session_state.ceph_baseline = {
+                "points": {pid: dict(info) for pid, info in st.session_state.ceph_points.items()},
+                "image": {"width": current_image["width"], "height": current_image["height"]} if current_image else None,
+            }
+            st.session_state.ceph_state_version += 1
+        registration = st.selectbox(
+            "重ね合わせ基準",
+            options=list(REGISTRATIONS),
+            format_func=lambda value: REGISTRATIONS[value]["name"],
+        )
+        allow_scale = st.checkbox("拡大率の差も補正する", value=False)
+        show_overlay = st.checkbox(
+            "比較トレースを重ねて表示",
+            value=True,
+            disabled=st.session_state.ceph_baseline is None,
+        )
+
+        st.header("計測の不確かさ")
+        show_uncertainty = st.checkbox("ランドマーク誤差から信頼区間を推定", value=False)
+        uncertainty_samples = st.select_slider(
+            "サンプル数",
+            options=[10_000, DEFAULT_SAMPLES, 300_000, 1_000_000],
+            value=DEFAULT_SAMPLES,
+            format_func=lambda value: f"{value:,}",
+            disabled=not show_uncertainty,
+        )
+        show_halos = st.checkbox("感度ハローを表示", value=True)
+        st.markdown(f"[メモリ診断ページ](?{PAGE_PARAM}=memory)")
+        if st.button("保存済み症例を開く", width="stretch"):
+            st.query_params[PAGE_PARAM] = "gallery"
+            st.rerun()
 
     st.markdown("### 画像の選択")
     uploaded = st.file_uploader(
         "分析したいレントゲン画像をアップロードしてください。",
-        type=["png", "jpg", "jpeg", "gif", "webp"],
+        type=IMAGE_UPLOAD_TYPES,
+        key=f"ceph_upload_{st.session_state.ceph_upload_epoch}",
     )
 
+    image_data_url = None
     if uploaded is not None:
-        image_bytes = uploaded.read()
-        mime = uploaded.type or "image/png"
-        image_data_url = to_data_url(image_bytes, mime)
-        st.session_state.default_image_data_url = image_data_url
-        st.success("アップロードした画像を読み込みました。")
-    else:
+        try:
+            image_data_url = uploaded_image_data_url(uploaded)
+        except (RuntimeError, ValueError) as exc:
+            st.error(str(exc))
+        else:
+            st.session_state.default_image_data_url = image_data_url
+            st.success("アップロードした画像を読み込みました。")
+    if image_data_url is None:
         image_data_url = st.session_state.default_image_data_url
         if image_data_url:
             st.info("画像が未選択です。")
         else:
             st.error("表示できる画像がまだです。")
+            account_session_memory()
             return
 
+    opened = st.session_state.pop("ceph_opened_case", None)
+    if opened:
+        st.success(f"保存済みの症例 {opened} を開きました。")
+
+    image_info = get_image_info(image_data_url)
+    mm_per_px = get_calibration_mm_per_px(image_info, ruler_mm)
+    with st.sidebar:
+        if mm_per_px:
+            px_per_mm = 1.0 / mm_per_px
+            spacing = st.session_state.ceph_image_spacing
+            source = spacing["source"] if mm_per_px == image_spacing_mm_per_px(image_info) else "校正線"
+            st.caption(
+                f"校正済み ({source}): {px_per_mm:.2f} px/mm (原画像 {image_info['width']}×{image_info['height']})"
+            )
+        else:
+            px_per_mm = st.number_input(
+                "1 mm あたりの px (原画像, 未校正時)",
+                min_value=0.5,
+                max_value=100.0,
+                value=DEFAULT_PX_PER_MM,
+                step=0.5,
+            )
+
+    halos = None
+    if show_halos:
+        rendered_native = build_points_native(st.session_state.ceph_points, image_info)
+        halos = sensitivity_halos(compute_sensitivity(rendered_native, px_per_mm))
     component_value = render_ceph_component(
         image_data_url=image_data_url,
         marker_size=marker_size,
         show_labels=show_labels,
         point_state=st.session_state.ceph_points,
+        renderer=renderer,
+        trace=trace,
+        overlay=build_overlay_payload(registration, allow_scale, image_info) if show_overlay else None,
+        halos=halos,
     )
 
     if isinstance(component_value, dict):
         update_state_from_component(component_value)
 
-    points_px = build_points_px(st.session_state.ceph_stage, st.session_state.ceph_points)
-    angles = compute_angles(points_px)
+    mm_per_px = get_calibration_mm_per_px(image_info, ruler_mm)
+    points_native = build_points_native(st.session_state.ceph_points, image_info)
+    measurements = measure_native(points_native, mm_per_px)
+    units = measurement_units(calibrated=mm_per_px is not None)
+
+    with st.sidebar:
+        st.header("症例アーカイブ")
+        case_id = st.text_input("症例 ID").strip()
+        case_rater = st.text_input("評価者", help="同じ症例を複数の評価者がトレースすると評価者間信頼性に使われます。").strip()
+        case_age = st.number_input("年齢", min_value=0.0, max_value=120.0, value=None, step=1.0)
+        case_sex = st.selectbox(
+            "性別", options=[""] + list(SEXES), format_func=lambda value: {"": "不明", "M": "男性", "F": "女性"}[value]
+        )
+        if st.button("この症例を保存", width="stretch", disabled=not case_id):
+            is_new = save_case(
+                case_id,
+                case_age,
+                case_sex,
+                points_native,
+                image_info,
+                mm_per_px,
+                case_rater,
+                image_data_url,
+            )
+            saved = default_archive().get(case_id)
+            if is_new:
+                st.success(f"{case_id} を保存し、コホート統計に加えました。")
+            elif saved is not None and saved.rater != case_rater:
+                st.info(f"{case_id} に評価者「{case_rater or '(未入力)'}」のトレースを追加しました (症例の計測値は変えていません)。")
+            else:
+                st.info(f"{case_id} を更新し、コホート統計を置き換えました (分位点は再構築時に揃います)。")
 
     left_col, right_col = st.columns([1.3, 0.7])
 
     with left_col:
         st.markdown("### 計測結果")
-        rows = create_results_table(angles)
+        if not mm_per_px:
+            st.caption("長さは原画像の px です。校正線をなぞると mm で表示します。")
+        intervals = (
+            compute_uncertainty(points_native, uncertainty_samples, px_per_mm, mm_per_px)
+            if show_uncertainty
+            else None
+        )
+        rows = create_results_table(measurements, intervals, units)
         st.dataframe(rows, width="stretch", hide_index=True)
-        polygon_fig = build_polygon_figure(angles)
+        report_record = CaseRecord(
+            case_id=case_id,
+            points=points_native,
+            measurements=measurements,
+            age=case_age,
+            sex=case_sex,
+            image_key=image_info["key"],
+            image_size=(image_info["width"], image_info["height"]),
+            mm_per_px=mm_per_px,
+        )
+        for col, (fmt, mime) in zip(st.columns(len(REPORT_FORMATS)), REPORT_FORMATS.items()):
+            # 押されたときに描く (同じランドマーク状態なら描画済みのファイルを返す)
+            col.download_button(
+                f"トレース図レポート ({fmt.upper()})",
+                data=partial(render_case_report, report_record, image_data_url, fmt),
+                file_name=f"{case_id or 'ceph'}-report.{fmt}",
+                mime=mime,
+                on_click="ignore",
+                width="stretch",
+            )
+        with st.expander("似た骨格パターンの保存済み症例"):
+            similar_k = st.slider("表示する症例数", min_value=1, max_value=20, value=5)
+            similar_rows = create_similar_cases_table(measurements, similar_k, exclude=case_id or None)
+            if similar_rows:
+                st.caption(f"角度 {len(RESULT_ORDER)} 項目の σ のユークリッド距離 (欠測は平均とみなす)")
+                st.dataframe(similar_rows, width="stretch", hide_index=True)
+                similar_id = st.selectbox("症例を開く", options=[row["症例 ID"] for row in similar_rows])
+                if st.button("開く", key="similar-open"):
+                    record = default_archive().get(similar_id)
+                    if record is not None and open_case(record):
+                        st.rerun()
+                    st.error("画像が見つかりません。")
+            else:
+                st.caption("保存済みの症例はまだありません (`python ceph_similar.py --rebuild` で既存症例から作れます)。")
+        with st.expander("自施設コホートとの比較"):
+            band_options = [ALL] + [label for _, _, label in AGE_BANDS]
+            sex_options = [ALL] + list(SEXES)
+            band_col, sex_col = st.columns(2)
+            cohort_band = band_col.selectbox(
+                "年齢帯",
+                options=band_options,
+                index=band_options.index(age_band(case_age) or ALL),
+                format_func=lambda value: "全年齢" if value == ALL else value,
+            )
+            cohort_sex = sex_col.selectbox(
+                "性別 (コホート)",
+                options=sex_options,
+                index=sex_options.index(case_sex or ALL),
+                format_func=lambda value: {ALL: "全体", "M": "男性", "F": "女性"}[value],
+            )
+            cohort_rows, cohort_stale = create_cohort_table(cohort_band, cohort_sex, measurements)
+            if cohort_rows:
+                st.dataframe(cohort_rows, width="stretch", hide_index=True)
+                if cohort_stale:
+                    st.caption(
+                        f"分位点と順位には修正前の値が {cohort_stale} 件残っています"
+                        " (`python ceph_cohort.py --rebuild` で揃います。n・平均・SD は反映済み)。"
+                    )
+            else:
+                st.caption("この区分の保存済み症例はまだありません。")
+        with st.expander("評価者間信頼性"):
+            raters = st.radio("評価者数", options=list(RATER_COUNTS), horizontal=True, format_func=lambda k: f"{k} 人")
+            case_count, icc_rows, ba_rows, mre_rows = create_reliability_tables(raters)
+            if case_count:
+                st.caption(f"{case_count} 症例 (評価者名順の先頭 {raters} 人)。未校正の症例は {DEFAULT_PX_PER_MM:g} px/mm で換算。")
+                st.dataframe(icc_rows, width="stretch", hide_index=True)
+                st.dataframe(ba_rows, width="stretch", hide_index=True)
+                st.dataframe(mre_rows, width="stretch", hide_index=True)
+            else:
+                st.caption(f"{raters} 人以上がトレースした症例はまだありません。")
+        show_cohort_density = st.checkbox(
+            "自施設コホートの分布を重ねる", value=False, help="上の「自施設コホートとの比較」で選んだ年齢帯・性別"
+        )
+        cohort_density = None
+        if show_cohort_density:
+            cohort_density = default_density_store(REFERENCE_DATA).histograms(cohort_band, cohort_sex)
+            if cohort_density:
+                n_cases = max(h.n for h in cohort_density.values())
+                st.caption(f"コホート {n_cases} 症例の σ 分布 (濃いほど多い, 点線は中央値)")
+            else:
+                st.caption("この区分の分布はまだありません (`python ceph_cohort.py --rebuild` で既存症例から作れます)。")
+        polygon_fig = build_polygon_figure(measurements, cohort_density)
         if polygon_fig is not None:
             st.markdown("### 標準偏差ポリゴン")
             st.plotly_chart(
@@ -999,10 +2767,50 @@ def main() -> None:
             )
         else:
             st.info("ポリゴン図を表示できる計測値がありません。")
+        if st.session_state.ceph_contours:
+            st.markdown("### 輪郭計測")
+            contour_measurements = compute_contour_measurements(
+                st.session_state.ceph_contours,
+                {"width": image_info["width"], "height": image_info["height"]},
+                points_native,
+                mm_per_px,
+            )
+            st.dataframe(
+                create_contour_table(contour_measurements, contour_units(mm_per_px is not None)),
+                width="stretch",
+                hide_index=True,
+            )
+        if st.session_state.ceph_baseline:
+            st.markdown("### 重ね合わせ (比較トレース基準)")
+            displacement_rows, angle_rows = create_superimposition_tables(registration, allow_scale, image_info, mm_per_px)
+            st.dataframe(angle_rows, width="stretch", hide_index=True)
+            st.dataframe(displacement_rows, width="stretch", hide_index=True)
+        with st.expander("一括重ね合わせ (CSV)"):
+            st.caption("列: case_id, timepoint (pre / post), point, x, y。選択中の重ね合わせ基準を全症例に適用します。")
+            serial_csv = st.file_uploader("連続トレース CSV", type=["csv"], key="serial_csv")
+            if serial_csv is not None:
+                try:
+                    movement, angle_change = summarize_serial_batch(serial_csv, registration, allow_scale)
+                except ValueError as exc:
+                    st.error(str(exc))
+                else:
+                    st.caption(f"{len(angle_change)} 症例")
+                    st.dataframe(
+                        movement.groupby("point", sort=False)[["dx", "dy", "distance"]].mean().round(2),
+                        width="stretch",
+                    )
+                    st.dataframe(angle_change.round(2), width="stretch", hide_index=True)
+                    st.download_button(
+                        "点移動量 CSV をダウンロード",
+                        movement.to_csv(index=False).encode("utf-8"),
+                        file_name="superimposition_movement.csv",
+                        mime="text/csv",
+                    )
 
     with right_col:
-        st.markdown("### 現在の座標 (px)")
-        st.dataframe(build_points_table(points_px), width="stretch", hide_index=True, height=400)
+        st.markdown("### 現在の座標 (原画像 px)")
+        sensitivity = compute_sensitivity(points_native, px_per_mm)
+        st.dataframe(build_points_table(points_native, sensitivity), width="stretch", hide_index=True, height=400)
 
         stage = st.session_state.ceph_stage
         st.markdown(
@@ -1016,6 +2824,17 @@ def main() -> None:
         active_id = st.session_state.get("ceph_active_id")
         if last_event:
             st.caption(f"最後のイベント: {last_event} / アクティブポイント: {active_id or '—'}")
+        if st.session_state.get("ceph_session_id"):
+            st.caption("作業状態は外部ストアに保存されます。この URL を開き直すと続きから再開できます。")
+        with st.expander("ドラッグ計測 (全セッション)"):
+            telemetry_rows = METRICS_SINK.summary()
+            if telemetry_rows:
+                st.dataframe(telemetry_rows, width="stretch", hide_index=True)
+            else:
+                st.caption("まだ計測値がありません。ドラッグ後の同期で送られます。")
+
+    persist_session_state()
+    account_session_memory()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+"""公開データセット形式のランドマーク正解に対する精度ベンチマーク。
+
+正解と比べるランドマークの出所は何でもよい (検出器や補正処理の出力ファイル、
+別の評価者の注釈、症例アーカイブのトレース)。どれも画像 × ランドマークの配列
+(欠けた点は NaN) にそろえてから、次をまとめて計算する。
+  - ランドマークごと・全体の平均放射誤差 (MRE, mm) と標準偏差
+  - 成功検出率 (SDR): 放射誤差が 2 / 2.5 / 3 / 4 mm 以内の割合
+  - 角度ごとの絶対誤差と、標準値 ±1SD による 3 分類の一致率
+正解に無いランドマーク (ISBI 2015 なら Am, Pm, U1r, L1r) とそれを使う角度は集計から外れる。
+ファイルの読み込みは画像ごとに別プロセスで行う。
+
+データセットの置き方:
+    ISBI 2015  <root>/AnnotationsByMD/{400_senior,400_junior}/NNN.txt (19 点, 0.1 mm/px)
+    CSV        image_id,landmark,x,y[,mm_per_px] の 1 行 1 点 (landmark は POINT_IDS の名前)
+
+    python ceph_benchmark.py /data/ISBI2015 --subset Test1Data --predictions pred.csv --max-mre 2.0
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ceph_cases import CaseArchive
+
+SDR_THRESHOLDS_MM = (2.0, 2.5, 3.0, 4.0)
+ISBI_MM_PER_PX = 0.1
+ISBI_ANNOTATORS = ("400_senior", "400_junior")
+ISBI_SUBSETS: Dict[str, Tuple[int, int]] = {
+    "TrainingData": (1, 150),
+    "Test1Data": (151, 300),
+    "Test2Data": (301, 400),
+}
+# ISBI 2015 の 19 点 (1 始まり) のうち POINT_IDS に対応するもの。
+# Gn, Go, 軟組織, PNS, ANS は対応する点が無く、Am/Pm/U1r/L1r は ISBI に無い。
+ISBI_POINTS: Dict[int, str] = {
+    1: "S",
+    2: "N",
+    3: "Or",
+    4: "Po",
+    5: "A",
+    6: "B",
+    7: "Pog",
+    8: "Me",
+    11: "L1",
+    12: "U1",
+    19: "Ar",
+}
+ISBI_LANDMARKS = 19
+
+Measure = Callable[[np.ndarray], Dict[str, np.ndarray]]
+Points = Dict[str, Tuple[float, float]]
+
+
+@dataclass
+class LandmarkSet:
+    """画像ごとのランドマーク。points は (N, L, 2) の原画像 px で、欠けた点は NaN。"""
+
+    image_ids: List[str]
+    point_ids: Tuple[str, ...]
+    points: np.ndarray
+    mm_per_px: np.ndarray  # (N,)
+
+    @classmethod
+    def from_dicts(
+        cls,
+        items: Sequence[Tuple[str, Points, Optional[float]]],
+        point_ids: Sequence[str],
+        default_mm_per_px: float = ISBI_MM_PER_PX,
+    ) -> "LandmarkSet":
+        index = {pid: i for i, pid in enumerate(point_ids)}
+        points = np.full((len(items), len(point_ids), 2), np.nan)
+        mm_per_px = np.full(len(items), default_mm_per_px)
+        for n, (_, item_points, scale) in enumerate(items):
+            if scale:
+                mm_per_px[n] = scale
+            for pid, xy in item_points.items():
+                if pid in index:
+                    points[n, index[pid]] = xy
+        return cls([image_id for image_id, _, _ in items], tuple(point_ids), points, mm_per_px)
+
+    def align(self, image_ids: Sequence[str]) -> "LandmarkSet":
+        """image_ids の順に並べ替える。無い画像は全点 NaN。"""
+        position = {image_id: n for n, image_id in enumerate(self.image_ids)}
+        points = np.full((len(image_ids),) + self.points.shape[1:], np.nan)
+        mm_per_px = np.full(len(image_ids), np.nan)
+        rows = [(n, position[image_id]) for n, image_id in enumerate(image_ids) if image_id in position]
+        if rows:
+            target, source = np.array(rows).T
+            points[target] = self.points[source]
+            mm_per_px[target] = self.mm_per_px[source]
+        return LandmarkSet(list(image_ids), self.point_ids, points, mm_per_px)
+
+
+def read_isbi_file(path: str) -> Points:
+    """ISBI 2015 の注釈 (先頭 19 行が "x,y") を POINT_IDS の名前で返す。"""
+    coords: List[Tuple[float, float]] = []
+    with open(path, encoding="utf-8", errors="replace") as handle:
+        for line in handle:
+            fields = line.replace(",", " ").split()
+            if len(fields) < 2:
+                continue
+            coords.append((float(fields[0]), float(fields[1])))
+            if len(coords) == ISBI_LANDMARKS:
+                break
+    if len(coords) < ISBI_LANDMARKS:
+        raise ValueError(f"{path}: ISBI 2015 の注釈は {ISBI_LANDMARKS} 点必要です ({len(coords)} 点)")
+    return {pid: coords[number - 1] for number, pid in ISBI_POINTS.items()}
+
+
+def _read_isbi_group(paths: Tuple[str, ...]) -> Points:
+    """同じ画像の複数評価者の注釈を平均する。"""
+    annotations = [read_isbi_file(path) for path in paths]
+    return {
+        pid: tuple(float(v) for v in np.mean([points[pid] for points in annotations], axis=0))
+        for pid in annotations[0]
+    }
+
+
+def _map(function: Callable, items: Sequence, workers: int) -> List:
+    if workers > 1 and len(items) > workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(function, items, chunksize=max(1, len(items) // (4 * workers))))
+    return [function(item) for item in items]
+
+
+def isbi_image_ids(subset: Optional[str]) -> Optional[List[str]]:
+    if subset is None:
+        return None
+    if subset not in ISBI_SUBSETS:
+        raise ValueError(f"ISBI 2015 のサブセットは {', '.join(ISBI_SUBSETS)} のどれかです: {subset}")
+    first, last = ISBI_SUBSETS[subset]
+    return [f"{number:03d}" for number in range(first, last + 1)]
+
+
+def load_isbi(
+    root: Path,
+    point_ids: Sequence[str],
+    subset: Optional[str] = None,
+    annotators: Sequence[str] = ISBI_ANNOTATORS,
+    workers: int = 1,
+) -> LandmarkSet:
+    """ISBI 2015 の注釈を読む。評価者が複数あれば点ごとに平均したものを正解にする。"""
+    folders = [Path(root) / "AnnotationsByMD" / name for name in annotators]
+    missing = [str(folder) for folder in folders if not folder.is_dir()]
+    if missing:
+        raise ValueError(f"ISBI 2015 の注釈フォルダがありません: {', '.join(missing)}")
+    wanted = isbi_image_ids(subset)
+    image_ids = sorted(path.stem for path in folders[0].glob("*.txt"))
+    if wanted is not None:
+        image_ids = sorted(set(image_ids) & set(wanted))
+    groups = [tuple(str(folder / f"{image_id}.txt") for folder in folders) for image_id in image_ids]
+    annotations = _map(_read_isbi_group, groups, workers)
+    return LandmarkSet.from_dicts(
+        [(image_id, points, ISBI_MM_PER_PX) for image_id, points in zip(image_ids, annotations)], point_ids
+    )
+
+
+def load_isbi_predictions(folder: Path, point_ids: Sequence[str], workers: int = 1) -> LandmarkSet:
+    """ISBI 2015 と同じ形式 (画像ごとの txt) で書き出された予測を読む。"""
+    paths = sorted(Path(folder).glob("*.txt"))
+    annotations = _map(read_isbi_file, [str(path) for path in paths], workers)
+    return LandmarkSet.from_dicts(
+        [(path.stem, points, ISBI_MM_PER_PX) for path, points in zip(paths, annotations)], point_ids
+    )
+
+
+def load_csv(path: Path, point_ids: Sequence[str], default_mm_per_px: float = ISBI_MM_PER_PX) -> LandmarkSet:
+    """image_id,landmark,x,y[,mm_per_px] の CSV を読む。"""
+    points: Dict[str, Points] = {}
+    scales: Dict[str, float] = {}
+    with open(path, newline="", encoding="utf-8-sig") as handle:
+        for row in csv.DictReader(handle):
+            image_id = row["image_id"]
+            points.setdefault(image_id, {})[row["landmark"]] = (float(row["x"]), float(row["y"]))
+            if row.get("mm_per_px"):
+                scales[image_id] = float(row["mm_per_px"])
+    return LandmarkSet.from_dicts(
+        [(image_id, item, scales.get(image_id)) for image_id, item in points.items()], point_ids, default_mm_per_px
+    )
+
+
+def load_archive(archive: CaseArchive, rater: str, point_ids: Sequence[str]) -> LandmarkSet:
+    """症例アーカイブのある評価者のトレースを、症例 ID を画像 ID として読む。"""
+    items = []
+    with archive.connect() as conn:
+        rows = conn.execute("SELECT case_id, points, mm_per_px FROM tracings WHERE rater = ?", (rater,))
+        for row in rows:
+            points = {pid: (float(x), float(y)) for pid, (x, y) in json.loads(row["points"]).items()}
+            items.append((row["case_id"], points, row["mm_per_px"]))
+    return LandmarkSet.from_dicts(items, point_ids)
+
+
+@dataclass(frozen=True)
+class BenchmarkReport:
+    images: int
+    missing_images: int
+    mre_mm: float
+    sd_mm: float
+    sdr: Dict[str, float]  # 閾値 (mm) の文字列 → 割合
+    landmark_mre_mm: Dict[str, float]
+    angle_mae_deg: Dict[str, float]
+    agreement: Dict[str, float]
+    mean_agreement: float
+
+    def to_json(self) -> str:
+        def clean(value):
+            if isinstance(value, dict):
+                return {key: clean(item) for key, item in value.items()}
+            return None if isinstance(value, float) and not math.isfinite(value) else value
+
+        return json.dumps(clean(asdict(self)), indent=2, ensure_ascii=False)
+
+
+def classify(values: np.ndarray, reference: Tuple[float, float]) -> np.ndarray:
+    """標準値 ±1SD で -1 (小) / 0 (標準) / 1 (大) に分ける。NaN は NaN のまま。"""
+    mean, sd = reference
+    z = (values - mean) / sd
+    return np.where(np.isnan(z), np.nan, np.where(z > 1, 1.0, np.where(z < -1, -1.0, 0.0)))
+
+
+def _nanmean(values: np.ndarray, axis=None):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = np.sum(np.isfinite(values), axis=axis)
+        total = np.nansum(values, axis=axis)
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+def evaluate(
+    truth: LandmarkSet,
+    predicted: LandmarkSet,
+    measure: Measure,
+    reference: Dict[str, Tuple[float, float]],
+    thresholds: Sequence[float] = SDR_THRESHOLDS_MM,
+) -> BenchmarkReport:
+    """正解と予測を画像 ID でそろえて比べる。放射誤差は正解側の mm/px で mm にする。"""
+    predicted = predicted.align(truth.image_ids)
+    radial = np.hypot(*(predicted.points - truth.points).transpose(2, 0, 1)) * truth.mm_per_px[:, None]
+    compared = np.isfinite(truth.points[..., 0])
+    found = np.isfinite(radial)
+    # 正解があるのに予測が無い点は検出失敗として SDR の分母に入れる
+    attempted = radial[compared]
+    errors = radial[found]
+    sdr = {
+        f"{threshold:g}": float(np.mean(np.where(np.isfinite(attempted), attempted <= threshold, False)))
+        if attempted.size
+        else math.nan
+        for threshold in thresholds
+    }
+    landmark_mre = _nanmean(np.where(found, radial, np.nan), axis=0)
+
+    truth_values = measure(truth.points)
+    predicted_values = measure(predicted.points)
+    angle_mae: Dict[str, float] = {}
+    agreement: Dict[str, float] = {}
+    for name, reference_values in reference.items():
+        if name not in truth_values:
+            continue
+        a, b = truth_values[name], predicted_values[name]
+        both = np.isfinite(a) & np.isfinite(b)
+        if not both.any():
+            continue
+        angle_mae[name] = float(np.mean(np.abs(a[both] - b[both])))
+        agreement[name] = float(np.mean(classify(a[both], reference_values) == classify(b[both], reference_values)))
+    return BenchmarkReport(
+        images=len(truth.image_ids),
+        missing_images=int(np.sum(~np.isfinite(predicted.mm_per_px))),
+        mre_mm=float(errors.mean()) if errors.size else math.nan,
+        sd_mm=float(errors.std(ddof=1)) if errors.size > 1 else math.nan,
+        sdr=sdr,
+        landmark_mre_mm={
+            pid: float(value) for pid, value, any_truth in zip(truth.point_ids, landmark_mre, compared.any(axis=0))
+            if any_truth
+        },
+        angle_mae_deg=angle_mae,
+        agreement=agreement,
+        mean_agreement=float(np.mean(list(agreement.values()))) if agreement else math.nan,
+    )
+
+
+def format_report(report: BenchmarkReport) -> str:
+    lines = [
+        f"images: {report.images} (予測なし {report.missing_images})",
+        f"MRE: {report.mre_mm:.3f} ± {report.sd_mm:.3f} mm",
+        "SDR: " + "  ".join(f"{t} mm={rate * 100:.1f}%" for t, rate in report.sdr.items()),
+        "landmark MRE (mm): " + "  ".join(f"{pid}={value:.2f}" for pid, value in report.landmark_mre_mm.items()),
+    ]
+    for name in report.agreement:
+        lines.append(
+            f"{name:>14}  MAE={report.angle_mae_deg[name]:.2f}°  分類一致={report.agreement[name] * 100:.1f}%"
+        )
+    lines.append(f"分類一致 (平均): {report.mean_agreement * 100:.1f}%")
+    return "\n".join(lines)
+
+
+def load_source(path: str, point_ids: Sequence[str], workers: int) -> LandmarkSet:
+    source = Path(path)
+    if source.is_dir():
+        return load_isbi_predictions(source, point_ids, workers)
+    return load_csv(source, point_ids)
+
+
+def main() -> None:
+    from CEF03 import POINT_IDS, REFERENCE_DATA, compute_angles_batch
+
+    parser = argparse.ArgumentParser(description="公開データセット形式の正解に対するランドマーク精度")
+    parser.add_argument("truth", help="ISBI 2015 のルート、または正解の CSV")
+    parser.add_argument("--subset", choices=list(ISBI_SUBSETS), help="ISBI 2015 のサブセット")
+    parser.add_argument("--annotator", action="append", choices=list(ISBI_ANNOTATORS), help="既定は 2 人の平均")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--predictions", help="予測の CSV、または ISBI 形式の txt を置いたフォルダ")
+    source.add_argument("--archive-rater", help="症例アーカイブのこの評価者のトレース (症例 ID = 画像 ID)")
+    source.add_argument("--compare-annotators", action="store_true", help="ISBI の junior を senior と比べる")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--max-mre", type=float, help="MRE (mm) がこれを超えたら終了コード 1")
+    parser.add_argument("--min-sdr", type=float, help="2 mm の SDR がこれ未満なら終了コード 1")
+    parser.add_argument("--min-agreement", type=float, help="平均分類一致率がこれ未満なら終了コード 1")
+    args = parser.parse_args()
+
+    root = Path(args.truth)
+    if root.is_dir():
+        annotators = ISBI_ANNOTATORS[:1] if args.compare_annotators else (args.annotator or ISBI_ANNOTATORS)
+        truth = load_isbi(root, POINT_IDS, args.subset, annotators, args.workers)
+    else:
+        truth = load_csv(root, POINT_IDS)
+    if args.compare_annotators:
+        predicted = load_isbi(root, POINT_IDS, args.subset, ISBI_ANNOTATORS[1:], args.workers)
+    elif args.archive_rater:
+        from ceph_cases import default_archive
+
+        predicted = load_archive(default_archive(), args.archive_rater, POINT_IDS)
+    else:
+        predicted = load_source(args.predictions, POINT_IDS, args.workers)
+
+    report = evaluate(truth, predicted, compute_angles_batch, REFERENCE_DATA)
+    print(report.to_json() if args.json else format_report(report))
+    failures = []
+    if args.max_mre is not None and not report.mre_mm <= args.max_mre:
+        failures.append(f"MRE {report.mre_mm:.3f} mm > {args.max_mre}")
+    if args.min_sdr is not None and not report.sdr.get("2", math.nan) >= args.min_sdr:
+        failures.append(f"SDR(2 mm) {report.sdr.get('2')} < {args.min_sdr}")
+    if args.min_agreement is not None and not report.mean_agreement >= args.min_agreement:
+        failures.append(f"分類一致 {report.mean_agreement:.3f} < {args.min_agreement}")
+    if failures:
+        print("FAIL: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
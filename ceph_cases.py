@@ -0,0 +1,342 @@
+"""トレース済み症例のアーカイブ (SQLite, 標準ライブラリのみ)。
+
+1 症例 = 原画像座標のランドマークと計測値、年齢・性別などの属性。
+同じ症例を複数の評価者がトレースした場合は、評価者ごとのランドマークを tracings に持つ
+(cases には最初に保存した評価者のトレースが入り、他の評価者の保存では変わらない)。
+接続は呼び出しごとに開くので、Streamlit の複数セッション (スレッド) や
+別プロセスのワーカーから同時に使える (WAL モード)。
+保存先は環境変数 ``CEPH_ARCHIVE_DIR`` (既定 ``.ceph_archive``)。
+"""
+
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+ARCHIVE_ENV = "CEPH_ARCHIVE_DIR"
+DEFAULT_ARCHIVE_DIR = ".ceph_archive"
+DB_NAME = "cases.sqlite3"
+SEXES = ("M", "F")
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    rowid INTEGER PRIMARY KEY,
+    case_id TEXT NOT NULL UNIQUE,
+    age REAL,
+    sex TEXT NOT NULL DEFAULT '',
+    image_key TEXT NOT NULL DEFAULT '',
+    image_width INTEGER NOT NULL DEFAULT 0,
+    image_height INTEGER NOT NULL DEFAULT 0,
+    mm_per_px REAL,
+    points TEXT NOT NULL,
+    measurements TEXT NOT NULL,
+    rater TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cases_updated ON cases (updated);
+CREATE TABLE IF NOT EXISTS tracings (
+    case_id TEXT NOT NULL,
+    rater TEXT NOT NULL,
+    points TEXT NOT NULL,
+    mm_per_px REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (case_id, rater)
+);
+"""
+
+
+@dataclass(frozen=True)
+class CaseRecord:
+    case_id: str
+    points: Dict[str, Tuple[float, float]]  # 原画像 px
+    measurements: Dict[str, float]
+    age: Optional[float] = None
+    sex: str = ""  # "M" / "F" / "" (不明)
+    image_key: str = ""
+    image_size: Tuple[int, int] = (0, 0)
+    mm_per_px: Optional[float] = None
+    rater: str = ""
+    created: float = field(default_factory=time.time)
+
+
+@dataclass(frozen=True)
+class Tracing:
+    rater: str
+    points: Dict[str, Tuple[float, float]]  # 原画像 px
+    mm_per_px: Optional[float] = None
+
+
+TracingHook = Callable[[sqlite3.Connection, str, List[Tracing], List[Tracing]], None]
+UpdateHook = Callable[[sqlite3.Connection, CaseRecord, CaseRecord], None]
+
+
+def _dump_floats(values: Dict[str, float]) -> str:
+    # NaN は JSON に書けないので null にする
+    return json.dumps({k: (None if v is None or not math.isfinite(v) else float(v)) for k, v in values.items()})
+
+
+def _load_floats(text: str) -> Dict[str, float]:
+    return {k: (math.nan if v is None else float(v)) for k, v in json.loads(text).items()}
+
+
+def _load_points(text: str) -> Dict[str, Tuple[float, float]]:
+    return {pid: (float(xy[0]), float(xy[1])) for pid, xy in json.loads(text).items()}
+
+
+def _row_to_tracing(row: sqlite3.Row) -> Tracing:
+    return Tracing(row["rater"], _load_points(row["points"]), row["mm_per_px"])
+
+
+def _select_tracings(conn: sqlite3.Connection, case_id: str) -> List[Tracing]:
+    rows = conn.execute("SELECT * FROM tracings WHERE case_id = ? ORDER BY rater", (case_id,)).fetchall()
+    return [_row_to_tracing(row) for row in rows]
+
+
+def _row_to_record(row: sqlite3.Row) -> CaseRecord:
+    return CaseRecord(
+        case_id=row["case_id"],
+        points=_load_points(row["points"]),
+        measurements=_load_floats(row["measurements"]),
+        age=row["age"],
+        sex=row["sex"],
+        image_key=row["image_key"],
+        image_size=(row["image_width"], row["image_height"]),
+        mm_per_px=row["mm_per_px"],
+        rater=row["rater"],
+        created=row["created"],
+    )
+
+
+class CaseArchive:
+    def __init__(self, root: Optional[Path] = None) -> None:
+        self.root = Path(root or os.environ.get(ARCHIVE_ENV) or DEFAULT_ARCHIVE_DIR)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.path = self.root / DB_NAME
+        self._schemas: List[str] = [SCHEMA]
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as conn:
+            self._migrate(conn)
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection) -> None:
+        """評価者列の無い古い cases に列を足す。持ち主は主トレースと同じ点を持つ評価者とみなす。"""
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(cases)")}
+        if "rater" in columns:
+            return
+        conn.execute("ALTER TABLE cases ADD COLUMN rater TEXT NOT NULL DEFAULT ''")
+        conn.execute(
+            "UPDATE cases SET rater = COALESCE((SELECT t.rater FROM tracings t WHERE t.case_id = cases.case_id"
+            " AND t.points = cases.points ORDER BY t.updated LIMIT 1), '')"
+        )
+
+    def add_schema(self, schema: str) -> None:
+        """他のモジュールが同じ DB に置くテーブルを登録する。"""
+        if schema not in self._schemas:
+            self._schemas.append(schema)
+            with self.connect() as conn:
+                conn.executescript(schema)
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            for schema in self._schemas:
+                conn.executescript(schema)
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """書き込みトランザクション。BEGIN IMMEDIATE で他プロセスの書き込みと直列化する。"""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def save(
+        self,
+        record: CaseRecord,
+        on_insert: Optional[Callable[[sqlite3.Connection, CaseRecord], None]] = None,
+        on_tracing: Optional[TracingHook] = None,
+        on_update: Optional[UpdateHook] = None,
+    ) -> bool:
+        """症例を保存し、新規なら True を返す。
+
+        評価者のトレースは毎回 tracings に書く。cases (主トレース) を書き換えるのは新規か、
+        最初に保存した評価者自身の保存のときだけで、空欄の年齢・性別・mm/px は既存の値を残す。
+        on_insert (conn, 保存した症例) は新規時、on_update (conn, 変更前, 変更後) は主トレースの更新時、
+        on_tracing (conn, case_id, 変更前, 変更後の評価者別トレース) は毎回、同じトランザクション内で呼ぶ。
+        """
+        now = time.time()
+        points_json = json.dumps({pid: [float(x), float(y)] for pid, (x, y) in record.points.items()})
+        with self.transaction() as conn:
+            before = _select_tracings(conn, record.case_id) if on_tracing is not None else []
+            conn.execute(
+                "INSERT OR REPLACE INTO tracings (case_id, rater, points, mm_per_px, updated) VALUES (?, ?, ?, ?, ?)",
+                (record.case_id, record.rater, points_json, record.mm_per_px, now),
+            )
+            if on_tracing is not None:
+                on_tracing(conn, record.case_id, before, _select_tracings(conn, record.case_id))
+            row = conn.execute("SELECT * FROM cases WHERE case_id = ?", (record.case_id,)).fetchone()
+            if row is not None:
+                if row["rater"] != record.rater:
+                    return False
+                conn.execute(
+                    "UPDATE cases SET age = COALESCE(?, age), sex = COALESCE(NULLIF(?, ''), sex), image_key = ?,"
+                    " image_width = ?, image_height = ?, mm_per_px = COALESCE(?, mm_per_px), points = ?,"
+                    " measurements = ?, updated = ? WHERE case_id = ?",
+                    (
+                        record.age,
+                        record.sex,
+                        record.image_key,
+                        int(record.image_size[0]),
+                        int(record.image_size[1]),
+                        record.mm_per_px,
+                        points_json,
+                        _dump_floats(record.measurements),
+                        now,
+                        record.case_id,
+                    ),
+                )
+                if on_update is not None:
+                    after = conn.execute("SELECT * FROM cases WHERE case_id = ?", (record.case_id,)).fetchone()
+                    on_update(conn, _row_to_record(row), _row_to_record(after))
+                return False
+            conn.execute(
+                "INSERT INTO cases (age, sex, image_key, image_width, image_height, mm_per_px, points,"
+                " measurements, rater, case_id, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record.age,
+                    record.sex,
+                    record.image_key,
+                    int(record.image_size[0]),
+                    int(record.image_size[1]),
+                    record.mm_per_px,
+                    points_json,
+                    _dump_floats(record.measurements),
+                    record.rater,
+                    record.case_id,
+                    record.created,
+                    now,
+                ),
+            )
+            if on_insert is not None:
+                on_insert(conn, record)
+        return True
+
+    def remeasure(self, measure: Callable[[CaseRecord], Dict[str, float]], batch_size: int = BATCH_SIZE) -> int:
+        """保存済みの計測値を measure(record) で計算し直し、件数を返す。ランドマークと更新日時はそのまま。"""
+        count = 0
+        batch: List[Tuple[str, str]] = []
+
+        def flush() -> None:
+            with self.transaction() as conn:
+                conn.executemany("UPDATE cases SET measurements = ? WHERE case_id = ?", batch)
+            batch.clear()
+
+        for record in self.iter_records(batch_size=batch_size):
+            batch.append((_dump_floats(measure(record)), record.case_id))
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return count
+
+    def get(self, case_id: str) -> Optional[CaseRecord]:
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM cases WHERE case_id = ?", (case_id,)).fetchone()
+        return _row_to_record(row) if row else None
+
+    def tracings(self, case_id: str) -> List[Tracing]:
+        with self.connect() as conn:
+            return _select_tracings(conn, case_id)
+
+    def raters(self) -> List[str]:
+        with self.connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT rater FROM tracings ORDER BY rater")]
+
+    def iter_multi_rater(self, min_raters: int = 2, batch_size: int = BATCH_SIZE) -> Iterator[Tuple[str, List[Tracing]]]:
+        """評価者が min_raters 人以上いる症例を case_id 順に (case_id, 評価者名順のトレース) で返す。"""
+        last = ""
+        with self.connect() as conn:
+            while True:
+                case_ids = [
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT case_id FROM tracings WHERE case_id > ? GROUP BY case_id HAVING COUNT(*) >= ?"
+                        " ORDER BY case_id LIMIT ?",
+                        (last, min_raters, batch_size),
+                    )
+                ]
+                if not case_ids:
+                    return
+                marks = ",".join("?" * len(case_ids))
+                rows = conn.execute(
+                    f"SELECT * FROM tracings WHERE case_id IN ({marks}) ORDER BY case_id, rater", case_ids
+                ).fetchall()
+                grouped: Dict[str, List[Tracing]] = {case_id: [] for case_id in case_ids}
+                for row in rows:
+                    grouped[row["case_id"]].append(_row_to_tracing(row))
+                yield from grouped.items()
+                last = case_ids[-1]
+
+    def count(self, search: str = "") -> int:
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM cases WHERE case_id LIKE ?", (f"%{search}%",)).fetchone()[0]
+
+    def list_cases(self, offset: int = 0, limit: int = 50, search: str = "") -> List[CaseRecord]:
+        """更新の新しい順に 1 ページ分。search があれば症例 ID の部分一致で絞る。"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM cases WHERE case_id LIKE ? ORDER BY updated DESC LIMIT ? OFFSET ?",
+                (f"%{search}%", limit, offset),
+            ).fetchall()
+        return [_row_to_record(row) for row in rows]
+
+    def rowid_range(self) -> Tuple[int, int]:
+        with self.connect() as conn:
+            low, high = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM cases").fetchone()
+        return (low or 0, high or 0)
+
+    def iter_records(self, start: int = 0, stop: Optional[int] = None, batch_size: int = BATCH_SIZE) -> Iterator[CaseRecord]:
+        """rowid が [start, stop) の症例を rowid 順に返す (バッチごとに読むのでメモリは一定)。"""
+        last = start - 1
+        with self.connect() as conn:
+            while True:
+                rows = conn.execute(
+                    "SELECT * FROM cases WHERE rowid > ? AND rowid < ? ORDER BY rowid LIMIT ?",
+                    (last, stop if stop is not None else 2**63 - 1, batch_size),
+                ).fetchall()
+                if not rows:
+                    return
+                for row in rows:
+                    yield _row_to_record(row)
+                last = rows[-1]["rowid"]
+
+
+_default_archive: Optional[CaseArchive] = None
+_default_lock = threading.Lock()
+
+
+def default_archive() -> CaseArchive:
+    global _default_archive
+    with _default_lock:
+        if _default_archive is None:
+            _default_archive = CaseArchive()
+        return _default_archive
@@ -0,0 +1,586 @@
+"""症例アーカイブから作る自前の母集団統計 (年齢帯 × 性別ごと)。
+
+各セル (計測項目, 年齢帯, 性別) は Welford のモーメントと KLL 分位点スケッチを持つ。
+どちらも 1 症例あたり償却 O(1) で更新でき、別プロセスで作ったものをそのまま併合できる。
+セルは症例と同じ SQLite に JSON で保存し、症例の保存と同じトランザクションで更新するので、
+問い合わせはアーカイブを走査せずにセルを読むだけで済む。保存済みの症例を直したときは
+変更前の値をモーメントから引いて変更後を足す。KLL スケッチは値を消せないので、
+直した件数 (スケッチの n − モーメントの n) だけ分位点が古いまま残り、再構築で揃う。
+
+周辺集計 (年齢帯だけ・性別だけ・全体) も ``ALL`` のセルとして同時に更新する。
+標準値 (平均, SD) からの偏差 σ の固定幅ヒストグラムも同じ単位で持ち、
+標準偏差ポリゴンに母集団の分布を重ねるのに使う (症例数によらず大きさは一定)。
+
+    python ceph_cohort.py --rebuild --workers 4   # アーカイブ全体から作り直す
+    python ceph_cohort.py --show --sex F
+    python ceph_cohort.py --remeasure             # 計測値を原画像座標から計算し直して作り直す
+"""
+
+import argparse
+import json
+import math
+import random
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ceph_cases import CaseArchive, CaseRecord, default_archive
+
+ALL = "*"
+AGE_BANDS: Tuple[Tuple[float, float, str], ...] = (
+    (0.0, 8.0, "<8"),
+    (8.0, 12.0, "8-11"),
+    (12.0, 15.0, "12-14"),
+    (15.0, 18.0, "15-17"),
+    (18.0, math.inf, "18+"),
+)
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+DEFAULT_K = 200
+SIGMA_LIMIT = 8.0
+SIGMA_BIN = 0.125
+SIGMA_EDGES = np.linspace(-SIGMA_LIMIT, SIGMA_LIMIT, int(2 * SIGMA_LIMIT / SIGMA_BIN) + 1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cohort (
+    measure TEXT NOT NULL,
+    age_band TEXT NOT NULL,
+    sex TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (measure, age_band, sex)
+);
+"""
+
+DENSITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cohort_density (
+    measure TEXT NOT NULL,
+    age_band TEXT NOT NULL,
+    sex TEXT NOT NULL,
+    counts TEXT NOT NULL,
+    PRIMARY KEY (measure, age_band, sex)
+);
+"""
+
+CellKey = Tuple[str, str, str]
+Reference = Dict[str, Tuple[float, float]]
+
+
+def age_band(age: Optional[float]) -> Optional[str]:
+    if age is None or not math.isfinite(age) or age < 0:
+        return None
+    for low, high, label in AGE_BANDS:
+        if low <= age < high:
+            return label
+    return None
+
+
+def cell_groups(age: Optional[float], sex: str) -> List[Tuple[str, str]]:
+    """1 症例が寄与する (年齢帯, 性別) の組。不明な属性は ALL にだけ入る。"""
+    band = age_band(age)
+    groups = [(ALL, ALL)]
+    if band:
+        groups.append((band, ALL))
+    if sex:
+        groups.append((ALL, sex))
+    if band and sex:
+        groups.append((band, sex))
+    return groups
+
+
+@dataclass
+class Moments:
+    """Welford のオンライン平均・分散 (併合は Chan らの式)。"""
+
+    n: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    minimum: float = math.inf
+    maximum: float = -math.inf
+
+    def add(self, value: float) -> None:
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def remove(self, value: float) -> None:
+        """add の逆。最小・最大は戻せないので再構築まで広いまま残る。"""
+        if self.n <= 1:
+            self.n, self.mean, self.m2 = 0, 0.0, 0.0
+            self.minimum, self.maximum = math.inf, -math.inf
+            return
+        self.n -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.n
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    def merge(self, other: "Moments") -> None:
+        if other.n == 0:
+            return
+        total = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / total
+        self.m2 += other.m2 + delta * delta * self.n * other.n / total
+        self.n = total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def sd(self) -> float:
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else math.nan
+
+    def to_list(self) -> List[float]:
+        return [self.n, self.mean, self.m2, self.minimum, self.maximum]
+
+    @classmethod
+    def from_list(cls, values: Sequence[float]) -> "Moments":
+        n, mean, m2, minimum, maximum = values
+        return cls(int(n), float(mean), float(m2), float(minimum), float(maximum))
+
+
+class KLLSketch:
+    """KLL 分位点スケッチ (Karnin, Lang, Liberty 2016)。
+
+    レベル h のコンパクタは重み 2^h の値を持ち、容量を超えると整列して 1 つおきに
+    上のレベルへ送る。容量は上のレベルほど大きく ``k * c^depth``。
+    保持する値は O(k) 個で、順位誤差はおおよそ 1.7 / k。
+    """
+
+    def __init__(self, k: int = DEFAULT_K, c: float = 2.0 / 3.0) -> None:
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.levels: List[List[float]] = [[]]
+        self._max_size = self._capacity(0)
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.levels) - height - 1
+        return int(math.ceil(self.k * self.c**depth)) + 1
+
+    def _grow(self) -> None:
+        self.levels.append([])
+        self._max_size = sum(self._capacity(h) for h in range(len(self.levels)))
+
+    def _size(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+    def _compress(self) -> None:
+        for height in range(len(self.levels)):
+            level = self.levels[height]
+            if len(level) < self._capacity(height):
+                continue
+            if height + 1 >= len(self.levels):
+                self._grow()
+            level.sort()
+            # 奇数個なら最小値を 1 つ残し、残りを乱択オフセットで 1 つおきに昇格させる
+            keep = len(level) % 2
+            promoted = level[keep + random.getrandbits(1) :: 2]
+            self.levels[height] = level[:keep]
+            self.levels[height + 1].extend(promoted)
+            if self._size() < self._max_size:
+                break
+
+    def update(self, value: float) -> None:
+        self.levels[0].append(float(value))
+        self.n += 1
+        if self._size() >= self._max_size:
+            self._compress()
+
+    def merge(self, other: "KLLSketch") -> None:
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for height, level in enumerate(other.levels):
+            self.levels[height].extend(level)
+        self.n += other.n
+        while self._size() >= self._max_size:
+            self._compress()
+
+    def _weighted(self) -> Tuple[np.ndarray, np.ndarray]:
+        values = np.concatenate([np.asarray(level, dtype=float) for level in self.levels])
+        weights = np.concatenate([np.full(len(level), 1 << h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        return values[order], np.cumsum(weights[order])
+
+    def quantiles(self, qs: Sequence[float]) -> np.ndarray:
+        if self.n == 0:
+            return np.full(len(qs), np.nan)
+        values, cumulative = self._weighted()
+        index = np.searchsorted(cumulative, np.asarray(qs, dtype=float) * cumulative[-1], side="left")
+        return values[np.minimum(index, len(values) - 1)]
+
+    def rank(self, value: float) -> float:
+        """value 以下の割合 (0〜1)。"""
+        if self.n == 0 or not math.isfinite(value):
+            return math.nan
+        values, cumulative = self._weighted()
+        index = int(np.searchsorted(values, value, side="right"))
+        return float(cumulative[index - 1] / cumulative[-1]) if index else 0.0
+
+    def to_dict(self) -> Dict:
+        return {"k": self.k, "c": self.c, "n": self.n, "levels": self.levels}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "KLLSketch":
+        sketch = cls(int(data["k"]), float(data["c"]))
+        sketch.n = int(data["n"])
+        sketch.levels = [[float(v) for v in level] for level in data["levels"]] or [[]]
+        sketch._max_size = sum(sketch._capacity(h) for h in range(len(sketch.levels)))
+        return sketch
+
+
+class CohortCell:
+    def __init__(self, moments: Optional[Moments] = None, sketch: Optional[KLLSketch] = None) -> None:
+        self.moments = moments or Moments()
+        self.sketch = sketch or KLLSketch()
+
+    def add(self, value: float) -> None:
+        self.moments.add(value)
+        self.sketch.update(value)
+
+    def remove(self, value: float) -> None:
+        """モーメントからだけ引く (スケッチには残る)。"""
+        self.moments.remove(value)
+
+    def merge(self, other: "CohortCell") -> None:
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def stale(self) -> int:
+        """スケッチに残っている、修正・削除済みの値の数。"""
+        return max(self.sketch.n - self.moments.n, 0)
+
+    def summary(self) -> Dict[str, float]:
+        row = {"n": self.moments.n, "mean": self.moments.mean if self.moments.n else math.nan, "sd": self.moments.sd}
+        for q, value in zip(QUANTILES, self.sketch.quantiles(QUANTILES)):
+            row[f"q{round(q * 100):02d}"] = float(value)
+        return row
+
+    def to_json(self) -> str:
+        return json.dumps({"moments": self.moments.to_list(), "sketch": self.sketch.to_dict()})
+
+    @classmethod
+    def from_json(cls, text: str) -> "CohortCell":
+        data = json.loads(text)
+        return cls(Moments.from_list(data["moments"]), KLLSketch.from_dict(data["sketch"]))
+
+
+class CohortStats:
+    """メモリ上のセル集合。再構築時のワーカーごとの部分集計に使う。"""
+
+    def __init__(self, measures: Sequence[str]) -> None:
+        self.measures = tuple(measures)
+        self.cells: Dict[CellKey, CohortCell] = {}
+
+    def add_case(self, measurements: Dict[str, float], age: Optional[float], sex: str) -> None:
+        groups = cell_groups(age, sex)
+        for measure in self.measures:
+            value = measurements.get(measure)
+            if value is None or not math.isfinite(value):
+                continue
+            for band, group_sex in groups:
+                self.cells.setdefault((measure, band, group_sex), CohortCell()).add(value)
+
+    def merge(self, other: "CohortStats") -> None:
+        for key, cell in other.cells.items():
+            if key in self.cells:
+                self.cells[key].merge(cell)
+            else:
+                self.cells[key] = cell
+
+
+class SigmaHistogram:
+    """σ の固定幅ヒストグラム。両端の 1 つずつは範囲外 (±SIGMA_LIMIT の外) を数える。"""
+
+    def __init__(self, counts: Optional[np.ndarray] = None) -> None:
+        self.counts = np.zeros(len(SIGMA_EDGES) + 1, dtype=np.int64) if counts is None else counts
+
+    def add(self, sigma: float) -> None:
+        self.counts[np.searchsorted(SIGMA_EDGES, sigma, side="right")] += 1
+
+    def remove(self, sigma: float) -> None:
+        slot = np.searchsorted(SIGMA_EDGES, sigma, side="right")
+        self.counts[slot] = max(self.counts[slot] - 1, 0)
+
+    def merge(self, other: "SigmaHistogram") -> None:
+        self.counts += other.counts
+
+    @property
+    def n(self) -> int:
+        return int(self.counts.sum())
+
+    def density(self) -> np.ndarray:
+        """範囲内の各ビンの確率密度 (1/σ)。範囲外も分母には入れる。"""
+        total = self.n
+        inner = self.counts[1:-1].astype(float)
+        return inner / (total * SIGMA_BIN) if total else inner
+
+    def quantiles(self, qs: Sequence[float]) -> np.ndarray:
+        """ビン内は一様とみなして線形補間した分位点。範囲外に落ちる分位点は ±SIGMA_LIMIT に丸める。"""
+        total = self.n
+        if not total:
+            return np.full(len(qs), np.nan)
+        cumulative = np.concatenate([[0.0], np.cumsum(self.counts[1:-1])]) + self.counts[0]
+        targets = np.clip(np.asarray(qs, dtype=float) * total, cumulative[0], cumulative[-1])
+        return np.interp(targets, cumulative, SIGMA_EDGES)
+
+    def to_json(self) -> str:
+        return json.dumps(self.counts.tolist())
+
+    @classmethod
+    def from_json(cls, text: str) -> "SigmaHistogram":
+        counts = np.asarray(json.loads(text), dtype=np.int64)
+        # ビンの定義が変わっていたら使わない (再構築で作り直す)
+        return cls(counts if len(counts) == len(SIGMA_EDGES) + 1 else None)
+
+
+def case_sigmas(measurements: Dict[str, float], reference: Reference) -> Dict[str, float]:
+    sigmas = {}
+    for measure, (mean, sd) in reference.items():
+        value = measurements.get(measure)
+        if value is not None and math.isfinite(value) and sd > 0:
+            sigmas[measure] = (value - mean) / sd
+    return sigmas
+
+
+def _build_chunk(args: Tuple[str, int, int, Tuple[str, ...]]) -> CohortStats:
+    root, start, stop, measures = args
+    stats = CohortStats(measures)
+    for record in CaseArchive(root).iter_records(start, stop):
+        stats.add_case(record.measurements, record.age, record.sex)
+    return stats
+
+
+def _build_density_chunk(args: Tuple[str, int, int, Reference]) -> Dict[CellKey, SigmaHistogram]:
+    root, start, stop, reference = args
+    values: Dict[CellKey, List[float]] = {}
+    for record in CaseArchive(root).iter_records(start, stop):
+        groups = cell_groups(record.age, record.sex)
+        for measure, sigma in case_sigmas(record.measurements, reference).items():
+            for band, sex in groups:
+                values.setdefault((measure, band, sex), []).append(sigma)
+    # ビンへの振り分けはセルごとにまとめて行う
+    size = len(SIGMA_EDGES) + 1
+    return {
+        key: SigmaHistogram(np.bincount(np.searchsorted(SIGMA_EDGES, sigmas, side="right"), minlength=size))
+        for key, sigmas in values.items()
+    }
+
+
+def _rowid_chunks(archive: CaseArchive, chunk_size: int, *extra) -> List[Tuple]:
+    low, high = archive.rowid_range()
+    if not high:
+        return []
+    return [
+        (str(archive.root), start, min(start + chunk_size, high + 1)) + extra
+        for start in range(low, high + 1, chunk_size)
+    ]
+
+
+class CohortStore:
+    """SQLite に永続化したセル。症例の保存時に fold (更新時は refold)、表示時に query する。"""
+
+    def __init__(self, archive: CaseArchive, measures: Sequence[str]) -> None:
+        self.archive = archive
+        self.measures = tuple(measures)
+        archive.add_schema(SCHEMA)
+
+    def fold(self, conn: sqlite3.Connection, record: CaseRecord) -> None:
+        """1 症例を足し込む。``CaseArchive.save`` の on_insert として同じトランザクションで呼ぶ。"""
+        self.refold(conn, None, record)
+
+    def refold(self, conn: sqlite3.Connection, before: Optional[CaseRecord], after: CaseRecord) -> None:
+        """変更前の症例の寄与を引いて変更後を足す。``CaseArchive.save`` の on_update として呼ぶ。"""
+        removed = self._contributions(before)
+        added = self._contributions(after)
+        for key in sorted(removed.keys() | added.keys()):
+            old, new = removed.get(key), added.get(key)
+            if old == new:
+                continue
+            row = conn.execute("SELECT state FROM cohort WHERE measure = ? AND age_band = ? AND sex = ?", key).fetchone()
+            cell = CohortCell.from_json(row[0]) if row else CohortCell()
+            if old is not None:
+                cell.remove(old)
+            if new is not None:
+                cell.add(new)
+            conn.execute(
+                "INSERT OR REPLACE INTO cohort (measure, age_band, sex, state) VALUES (?, ?, ?, ?)",
+                key + (cell.to_json(),),
+            )
+
+    def _contributions(self, record: Optional[CaseRecord]) -> Dict[CellKey, float]:
+        if record is None:
+            return {}
+        groups = cell_groups(record.age, record.sex)
+        values = {}
+        for measure in self.measures:
+            value = record.measurements.get(measure)
+            if value is None or not math.isfinite(value):
+                continue
+            for band, sex in groups:
+                values[(measure, band, sex)] = value
+        return values
+
+    def cells(self, band: str = ALL, sex: str = ALL) -> Dict[str, CohortCell]:
+        with self.archive.connect() as conn:
+            rows = conn.execute("SELECT measure, state FROM cohort WHERE age_band = ? AND sex = ?", (band, sex)).fetchall()
+        return {row["measure"]: CohortCell.from_json(row["state"]) for row in rows}
+
+    def query(self, band: str = ALL, sex: str = ALL) -> Dict[str, Dict[str, float]]:
+        cells = self.cells(band, sex)
+        return {measure: cells[measure].summary() for measure in self.measures if measure in cells}
+
+    def rebuild(self, workers: int = 1, chunk_size: int = 5000) -> int:
+        """アーカイブ全体からセルを作り直す。rowid の区間ごとに別プロセスで集計して併合する。"""
+        chunks = _rowid_chunks(self.archive, chunk_size, self.measures)
+        stats = CohortStats(self.measures)
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for part in pool.map(_build_chunk, chunks):
+                    stats.merge(part)
+        else:
+            for chunk in chunks:
+                stats.merge(_build_chunk(chunk))
+        with self.archive.transaction() as conn:
+            conn.execute("DELETE FROM cohort")
+            conn.executemany(
+                "INSERT INTO cohort (measure, age_band, sex, state) VALUES (?, ?, ?, ?)",
+                [(measure, band, sex, cell.to_json()) for (measure, band, sex), cell in stats.cells.items()],
+            )
+        return len(stats.cells)
+
+
+class DensityStore:
+    """(計測項目, 年齢帯, 性別) ごとの σ ヒストグラム。CohortStore と同じく保存時に fold / refold する。"""
+
+    def __init__(self, archive: CaseArchive, reference: Reference) -> None:
+        self.archive = archive
+        self.reference = dict(reference)
+        archive.add_schema(DENSITY_SCHEMA)
+
+    def fold(self, conn: sqlite3.Connection, record: CaseRecord) -> None:
+        self.refold(conn, None, record)
+
+    def refold(self, conn: sqlite3.Connection, before: Optional[CaseRecord], after: CaseRecord) -> None:
+        """変更前の σ を引いて変更後を足す (ヒストグラムは度数なので引いても正確)。"""
+        removed = self._contributions(before)
+        added = self._contributions(after)
+        for key in sorted(removed.keys() | added.keys()):
+            old, new = removed.get(key), added.get(key)
+            if old == new:
+                continue
+            row = conn.execute(
+                "SELECT counts FROM cohort_density WHERE measure = ? AND age_band = ? AND sex = ?", key
+            ).fetchone()
+            histogram = SigmaHistogram.from_json(row[0]) if row else SigmaHistogram()
+            if old is not None:
+                histogram.remove(old)
+            if new is not None:
+                histogram.add(new)
+            conn.execute(
+                "INSERT OR REPLACE INTO cohort_density (measure, age_band, sex, counts) VALUES (?, ?, ?, ?)",
+                key + (histogram.to_json(),),
+            )
+
+    def _contributions(self, record: Optional[CaseRecord]) -> Dict[CellKey, float]:
+        if record is None:
+            return {}
+        groups = cell_groups(record.age, record.sex)
+        return {
+            (measure, band, sex): sigma
+            for measure, sigma in case_sigmas(record.measurements, self.reference).items()
+            for band, sex in groups
+        }
+
+    def histograms(self, band: str = ALL, sex: str = ALL) -> Dict[str, SigmaHistogram]:
+        with self.archive.connect() as conn:
+            rows = conn.execute(
+                "SELECT measure, counts FROM cohort_density WHERE age_band = ? AND sex = ?", (band, sex)
+            ).fetchall()
+        return {row["measure"]: SigmaHistogram.from_json(row["counts"]) for row in rows}
+
+    def rebuild(self, workers: int = 1, chunk_size: int = 5000) -> int:
+        chunks = _rowid_chunks(self.archive, chunk_size, self.reference)
+        histograms: Dict[CellKey, SigmaHistogram] = {}
+
+        def merge(part: Dict[CellKey, SigmaHistogram]) -> None:
+            for key, histogram in part.items():
+                if key in histograms:
+                    histograms[key].merge(histogram)
+                else:
+                    histograms[key] = histogram
+
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for part in pool.map(_build_density_chunk, chunks):
+                    merge(part)
+        else:
+            for chunk in chunks:
+                merge(_build_density_chunk(chunk))
+        with self.archive.transaction() as conn:
+            conn.execute("DELETE FROM cohort_density")
+            conn.executemany(
+                "INSERT INTO cohort_density (measure, age_band, sex, counts) VALUES (?, ?, ?, ?)",
+                [(measure, band, sex, histogram.to_json()) for (measure, band, sex), histogram in histograms.items()],
+            )
+        return len(histograms)
+
+
+_default_stores: Dict[Tuple[str, ...], CohortStore] = {}
+_default_density: Optional[DensityStore] = None
+_default_lock = threading.Lock()
+
+
+def default_cohort_store(measures: Sequence[str]) -> CohortStore:
+    with _default_lock:
+        key = tuple(measures)
+        if key not in _default_stores:
+            _default_stores[key] = CohortStore(default_archive(), key)
+        return _default_stores[key]
+
+
+def default_density_store(reference: Reference) -> DensityStore:
+    global _default_density
+    with _default_lock:
+        if _default_density is None:
+            _default_density = DensityStore(default_archive(), reference)
+        return _default_density
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="症例アーカイブの母集団統計")
+    parser.add_argument("--rebuild", action="store_true", help="アーカイブ全体から作り直す")
+    parser.add_argument(
+        "--remeasure", action="store_true", help="保存済みの計測値を原画像座標のランドマークから計算し直す (統計も作り直す)"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--show", action="store_true", help="統計を表示する")
+    parser.add_argument("--band", default=ALL, choices=[ALL] + [label for _, _, label in AGE_BANDS])
+    parser.add_argument("--sex", default=ALL, choices=[ALL, "M", "F"])
+    return parser.parse_args()
+
+
+def main() -> None:
+    from CEF03 import REFERENCE_DATA, RESULT_ORDER, measure_native
+
+    args = parse_args()
+    store = default_cohort_store(RESULT_ORDER)
+    if args.remeasure:
+        count = store.archive.remeasure(lambda record: measure_native(record.points, record.mm_per_px))
+        print(f"{count} cases remeasured")
+    if args.rebuild or args.remeasure:
+        print(f"{store.rebuild(args.workers)} cells from {store.archive.count()} cases")
+        print(f"{default_density_store(REFERENCE_DATA).rebuild(args.workers)} density cells")
+    if args.show or not (args.rebuild or args.remeasure):
+        for measure, row in store.query(args.band, args.sex).items():
+            values = "  ".join(f"{key}={value:.2f}" for key, value in row.items() if key != "n")
+            print(f"{measure:>14}  n={row['n']:<6} {values}")
+
+
+if __name__ == "__main__":
+    main()
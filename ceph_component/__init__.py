@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -9,6 +10,31 @@ _THIS_DIR = Path(__file__).resolve().parent
 _TEMPLATE_PATH = _THIS_DIR / "frontend" / "index.html"
 _TEMPLATE_HTML = _TEMPLATE_PATH.read_text(encoding="utf-8")
 
+# A declared component is the only way for an iframe to hand values back to the script:
+# ``components.html`` renders a static iframe whose setComponentValue messages Streamlit drops.
+# The bridge speaks the component protocol and hosts the generated HTML in a nested iframe.
+_bridge = components.declare_component("ceph_bridge", path=str(_THIS_DIR / "bridge"))
+
+
+@lru_cache(maxsize=None)
+def load_frontend_script(name: str) -> str:
+    """Return the source of a shared frontend script for inlining into component HTML."""
+    return (_THIS_DIR / "frontend" / name).read_text(encoding="utf-8")
+
+
+def html_component(
+    html: str, *, height: int, key: str, ack: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, Any]]:
+    """Render ``html`` in a declared component and return the last value it sent.
+
+    The document inside posts ``streamlit:setComponentValue`` / ``streamlit:setFrameHeight``
+    to ``window.parent`` as usual; the bridge relays them. The nested frame is rebuilt only
+    when ``html`` changes. ``key`` must be stable so reruns update the same frame.
+    ``ack`` is forwarded to the document as a ``ceph:ack`` message on every render without
+    rebuilding it, so the document can learn which of its values the script has applied.
+    """
+    return _bridge(html=html, height=height, key=key, ack=ack, default=None)
+
 
 def ceph_component(
     *,
@@ -37,4 +63,4 @@ def ceph_component(
     return components.html(html, height=820, scrolling=False)
 
 
-__all__ = ["ceph_component"]
+__all__ = ["ceph_component", "html_component", "load_frontend_script"]
@@ -0,0 +1,430 @@
+/*
+ * Canvas-based landmark renderer.
+ *
+ * Draws markers, planes and labels on a single <canvas> instead of one
+ * absolutely positioned <div> per landmark. Positions are kept as ratios in a
+ * Float32Array and hit testing goes through a uniform grid index, so dragging
+ * stays cheap with 100+ landmarks / contour points.
+ */
+(function (global) {
+  "use strict";
+
+  const DEFAULT_COLOR = "#f97316";
+  const LABEL_FONT = "600 12px Inter, -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif";
+  const LABEL_HEIGHT = 16;
+  const MAX_BITMAP_SIZE = 4096;
+
+  const clamp = (value, min, max) => Math.min(Math.max(value, min), max);
+
+  const createGridIndex = (count) => {
+    let cellSize = 48;
+    let cols = 1;
+    let rows = 1;
+    let cells = [[]];
+    const cellOf = new Int32Array(count).fill(-1);
+
+    const keyFor = (x, y) => {
+      const cx = clamp(Math.floor(x / cellSize), 0, cols - 1);
+      const cy = clamp(Math.floor(y / cellSize), 0, rows - 1);
+      return cy * cols + cx;
+    };
+
+    const remove = (index) => {
+      const key = cellOf[index];
+      if (key < 0) {
+        return;
+      }
+      const cell = cells[key];
+      const pos = cell.indexOf(index);
+      if (pos >= 0) {
+        cell[pos] = cell[cell.length - 1];
+        cell.pop();
+      }
+      cellOf[index] = -1;
+    };
+
+    const insert = (index, x, y) => {
+      const key = keyFor(x, y);
+      if (cellOf[index] === key) {
+        return;
+      }
+      remove(index);
+      cells[key].push(index);
+      cellOf[index] = key;
+    };
+
+    const rebuild = (width, height, size, positions) => {
+      cellSize = Math.max(32, size * 2);
+      cols = Math.max(1, Math.ceil(width / cellSize));
+      rows = Math.max(1, Math.ceil(height / cellSize));
+      cells = new Array(cols * rows);
+      for (let i = 0; i < cells.length; i += 1) {
+        cells[i] = [];
+      }
+      cellOf.fill(-1);
+      for (let i = 0; i < count; i += 1) {
+        insert(i, positions[i * 2], positions[i * 2 + 1]);
+      }
+    };
+
+    const query = (x0, y0, x1, y1, visit) => {
+      const cx0 = clamp(Math.floor(x0 / cellSize), 0, cols - 1);
+      const cx1 = clamp(Math.floor(x1 / cellSize), 0, cols - 1);
+      const cy0 = clamp(Math.floor(y0 / cellSize), 0, rows - 1);
+      const cy1 = clamp(Math.floor(y1 / cellSize), 0, rows - 1);
+      for (let cy = cy0; cy <= cy1; cy += 1) {
+        for (let cx = cx0; cx <= cx1; cx += 1) {
+          const cell = cells[cy * cols + cx];
+          for (let i = 0; i < cell.length; i += 1) {
+            visit(cell[i]);
+          }
+        }
+      }
+    };
+
+    return { insert, rebuild, query };
+  };
+
+  const create = (options) => {
+    const container = options.container;
+    const image = options.image;
+    const pointsConfig = Array.isArray(options.points) ? options.points : [];
+    const planeDefs = Array.isArray(options.planes) ? options.planes : [];
+    const showLabels = options.showLabels !== false;
+    const defaultSize = Number(options.markerSize) || 28;
+    const halfWidthFactor = Number(options.halfWidthFactor) || 0.5;
+    const labelFormatter =
+      typeof options.labelFormatter === "function"
+        ? options.labelFormatter
+        : (id, label) => label;
+    const noop = () => {};
+    const onDragStart = options.onDragStart || noop;
+    const onDrag = options.onDrag || noop;
+    const onDragEnd = options.onDragEnd || noop;
+
+    const count = pointsConfig.length;
+    const ids = pointsConfig.map((pt) => pt.id);
+    const labels = pointsConfig.map((pt) => pt.label || pt.id);
+    const colors = pointsConfig.map((pt) => pt.color || DEFAULT_COLOR);
+    const sizes = new Float32Array(count);
+    const halos = new Float32Array(count);
+    const ratios = new Float32Array(count * 2);
+    const positions = new Float32Array(count * 2);
+    const indexById = {};
+    let maxSize = defaultSize;
+
+    pointsConfig.forEach((pt, i) => {
+      indexById[pt.id] = i;
+      sizes[i] = Number(pt.size) || defaultSize;
+      halos[i] = Math.min(Math.max(Number(pt.halo) || 0, 0), 1);
+      maxSize = Math.max(maxSize, sizes[i]);
+      ratios[i * 2] = typeof pt.ratio_x === "number" ? pt.ratio_x : 0.5;
+      ratios[i * 2 + 1] = typeof pt.ratio_y === "number" ? pt.ratio_y : 0.5;
+    });
+
+    const planes = planeDefs
+      .map((plane) => ({
+        start: indexById[plane.start],
+        end: indexById[plane.end],
+        color: plane.color || "#fde047",
+        width: Number(plane.width) || 2,
+        dash: plane.dash
+          ? String(plane.dash)
+              .split(/[ ,]+/)
+              .map(Number)
+              .filter((v) => Number.isFinite(v))
+          : null,
+      }))
+      .filter((plane) => plane.start !== undefined && plane.end !== undefined);
+
+    const canvas = document.createElement("canvas");
+    canvas.className = "ceph-canvas";
+    canvas.style.position = "absolute";
+    canvas.style.left = "0";
+    canvas.style.top = "0";
+    canvas.style.touchAction = options.touchAction || "none";
+    container.insertBefore(canvas, options.insertBefore || null);
+    const ctx = canvas.getContext("2d");
+
+    const grid = createGridIndex(count);
+    let width = 0;
+    let height = 0;
+    let dpr = 1;
+    let density = 1;
+    let zoom = 1;
+    let drawPending = false;
+    let activeIndex = -1;
+    let activePointerId = null;
+    const dragOffset = { x: 0, y: 0 };
+
+    const draw = () => {
+      drawPending = false;
+      // ズーム時も線幅・マーカーは画面上の大きさを保つ
+      const unit = 1 / zoom;
+      ctx.setTransform(density, 0, 0, density, 0, 0);
+      ctx.clearRect(0, 0, width, height);
+
+      ctx.lineCap = "round";
+      planes.forEach((plane) => {
+        ctx.beginPath();
+        ctx.strokeStyle = plane.color;
+        ctx.lineWidth = plane.width * unit;
+        ctx.setLineDash(plane.dash ? plane.dash.map((v) => v * unit) : []);
+        ctx.moveTo(positions[plane.start * 2], positions[plane.start * 2 + 1]);
+        ctx.lineTo(positions[plane.end * 2], positions[plane.end * 2 + 1]);
+        ctx.stroke();
+      });
+      ctx.setLineDash([]);
+
+      for (let i = 0; i < count; i += 1) {
+        if (halos[i] <= 0) {
+          continue;
+        }
+        const x = positions[i * 2];
+        const y = positions[i * 2 + 1];
+        const radius = sizes[i] * (0.4 + 0.8 * halos[i]) * unit;
+        const gradient = ctx.createRadialGradient(x, y, 0, x, y, radius);
+        gradient.addColorStop(0, `rgba(250, 204, 21, ${0.2 + 0.35 * halos[i]})`);
+        gradient.addColorStop(1, "rgba(250, 204, 21, 0)");
+        ctx.beginPath();
+        ctx.arc(x, y, radius, 0, Math.PI * 2);
+        ctx.fillStyle = gradient;
+        ctx.fill();
+      }
+
+      for (let i = 0; i < count; i += 1) {
+        const x = positions[i * 2];
+        const y = positions[i * 2 + 1];
+        const size = sizes[i] * unit;
+        const half = size * halfWidthFactor;
+        ctx.beginPath();
+        ctx.moveTo(x, y);
+        ctx.lineTo(x + half, y + size);
+        ctx.lineTo(x - half, y + size);
+        ctx.closePath();
+        ctx.fillStyle = colors[i];
+        ctx.fill();
+        if (i === activeIndex) {
+          ctx.lineWidth = 1.5 * unit;
+          ctx.strokeStyle = "#f8fafc";
+          ctx.stroke();
+        }
+      }
+
+      if (showLabels) {
+        ctx.save();
+        ctx.textAlign = "center";
+        ctx.textBaseline = "top";
+        ctx.fillStyle = "#f8fafc";
+        ctx.shadowColor = "rgba(15, 23, 42, 0.8)";
+        ctx.shadowBlur = 2;
+        ctx.shadowOffsetY = 1;
+        ctx.font = LABEL_FONT;
+        ctx.scale(unit, unit);
+        for (let i = 0; i < count; i += 1) {
+          const x = positions[i * 2];
+          const y = positions[i * 2 + 1];
+          ctx.fillText(labelFormatter(ids[i], labels[i], x, y), x * zoom, (y + (sizes[i] + 4) * unit) * zoom);
+        }
+        ctx.restore();
+      }
+    };
+
+    const requestDraw = () => {
+      if (drawPending) {
+        return;
+      }
+      drawPending = true;
+      global.requestAnimationFrame(draw);
+    };
+
+    const placeFromRatio = (i) => {
+      positions[i * 2] = ratios[i * 2] * width;
+      positions[i * 2 + 1] = ratios[i * 2 + 1] * height;
+    };
+
+    const resizeBitmap = () => {
+      const longest = Math.max(width, height, 1);
+      density = Math.min(dpr * zoom, MAX_BITMAP_SIZE / longest);
+      canvas.width = Math.max(1, Math.round(width * density));
+      canvas.height = Math.max(1, Math.round(height * density));
+    };
+
+    const layout = () => {
+      width = image.clientWidth || container.clientWidth || 0;
+      height = image.clientHeight || container.clientHeight || 0;
+      dpr = global.devicePixelRatio || 1;
+      canvas.style.width = `${width}px`;
+      canvas.style.height = `${height}px`;
+      resizeBitmap();
+      for (let i = 0; i < count; i += 1) {
+        placeFromRatio(i);
+      }
+      grid.rebuild(width, height, maxSize, positions);
+      requestDraw();
+    };
+
+    const setPixel = (i, x, y) => {
+      const px = clamp(x, 0, width);
+      const py = clamp(y, 0, height);
+      positions[i * 2] = px;
+      positions[i * 2 + 1] = py;
+      ratios[i * 2] = width ? px / width : 0;
+      ratios[i * 2 + 1] = height ? py / height : 0;
+      grid.insert(i, px, py);
+      requestDraw();
+    };
+
+    const hitTest = (x, y) => {
+      let best = -1;
+      let bestDistance = Infinity;
+      const unit = 1 / zoom;
+      const reach = Math.max(maxSize * Math.max(halfWidthFactor, 0.5), 8) * unit;
+      grid.query(x - reach, y - (maxSize + LABEL_HEIGHT) * unit, x + reach, y + 4 * unit, (i) => {
+        const px = positions[i * 2];
+        const py = positions[i * 2 + 1];
+        const size = sizes[i] * unit;
+        const half = Math.max(size * halfWidthFactor, 8 * unit);
+        const slack = 4 * unit;
+        if (x < px - half || x > px + half || y < py - slack || y > py + size + slack) {
+          return;
+        }
+        const distance = Math.hypot(x - px, y - (py + size / 2));
+        if (distance < bestDistance) {
+          bestDistance = distance;
+          best = i;
+        }
+      });
+      return best;
+    };
+
+    const localPoint = (event) => {
+      const rect = canvas.getBoundingClientRect();
+      const scaleX = rect.width ? width / rect.width : 1;
+      const scaleY = rect.height ? height / rect.height : 1;
+      return {
+        x: (event.clientX - rect.left) * scaleX,
+        y: (event.clientY - rect.top) * scaleY,
+      };
+    };
+
+    canvas.addEventListener(
+      "pointerdown",
+      (event) => {
+        if (activeIndex >= 0) {
+          return;
+        }
+        const point = localPoint(event);
+        const hit = hitTest(point.x, point.y);
+        if (hit < 0) {
+          return;
+        }
+        activeIndex = hit;
+        activePointerId = event.pointerId;
+        dragOffset.x = point.x - positions[hit * 2];
+        dragOffset.y = point.y - positions[hit * 2 + 1];
+        canvas.style.cursor = "grabbing";
+        try {
+          canvas.setPointerCapture(event.pointerId);
+        } catch (error) {
+          /* ignore */
+        }
+        requestDraw();
+        onDragStart(ids[hit]);
+        event.preventDefault();
+      },
+      { passive: false }
+    );
+
+    canvas.addEventListener(
+      "pointermove",
+      (event) => {
+        const point = localPoint(event);
+        if (activeIndex < 0) {
+          canvas.style.cursor = hitTest(point.x, point.y) >= 0 ? "grab" : "default";
+          return;
+        }
+        if (event.pointerId !== activePointerId) {
+          return;
+        }
+        setPixel(activeIndex, point.x - dragOffset.x, point.y - dragOffset.y);
+        onDrag(ids[activeIndex], event);
+        event.preventDefault();
+      },
+      { passive: false }
+    );
+
+    const stopDragging = (eventType) => (event) => {
+      if (activeIndex < 0 || event.pointerId !== activePointerId) {
+        return;
+      }
+      try {
+        canvas.releasePointerCapture(event.pointerId);
+      } catch (error) {
+        /* ignore */
+      }
+      const id = ids[activeIndex];
+      activeIndex = -1;
+      activePointerId = null;
+      canvas.style.cursor = "grab";
+      requestDraw();
+      onDragEnd(id, eventType);
+    };
+
+    canvas.addEventListener("pointerup", stopDragging("pointerup"));
+    canvas.addEventListener("pointercancel", stopDragging("pointercancel"));
+
+    const cancelDrag = () => {
+      if (activeIndex < 0) {
+        return;
+      }
+      const id = ids[activeIndex];
+      activeIndex = -1;
+      activePointerId = null;
+      requestDraw();
+      onDragEnd(id, "pointercancel");
+    };
+
+    return {
+      canvas,
+      ids,
+      layout,
+      requestDraw,
+      cancelDrag,
+      isDragging: () => activeIndex >= 0,
+      setZoom: (value) => {
+        zoom = Math.max(1, Number(value) || 1);
+        resizeBitmap();
+        requestDraw();
+      },
+      size: () => ({ width, height }),
+      has: (id) => indexById[id] !== undefined,
+      getPixel: (id) => {
+        const i = indexById[id];
+        return i === undefined ? null : { x: positions[i * 2], y: positions[i * 2 + 1] };
+      },
+      getRatio: (id) => {
+        const i = indexById[id];
+        return i === undefined ? null : { x: ratios[i * 2], y: ratios[i * 2 + 1] };
+      },
+      setPixel: (id, x, y) => {
+        const i = indexById[id];
+        if (i !== undefined) {
+          setPixel(i, x, y);
+        }
+      },
+      setRatio: (id, x, y) => {
+        const i = indexById[id];
+        if (i !== undefined) {
+          ratios[i * 2] = x;
+          ratios[i * 2 + 1] = y;
+          placeFromRatio(i);
+          grid.insert(i, positions[i * 2], positions[i * 2 + 1]);
+          requestDraw();
+        }
+      },
+    };
+  };
+
+  global.CephCanvasRenderer = { create };
+})(window);
@@ -0,0 +1,248 @@
+/*
+ * Freehand contour tracing with streaming polyline simplification.
+ *
+ * Raw pointer samples are reduced while the stroke is drawn: a vertex is only
+ * kept once the buffered samples stop fitting the segment from the last kept
+ * vertex within `tolerance` px. On release the kept vertices get one final
+ * Douglas-Peucker pass, so a stroke of thousands of samples is sent to Python
+ * as a few dozen ratio pairs in a single message.
+ */
+(function (global) {
+  "use strict";
+
+  const SVG_NS = "http://www.w3.org/2000/svg";
+  const MAX_BUFFER = 64;
+
+  const segmentDistance = (px, py, ax, ay, bx, by) => {
+    const dx = bx - ax;
+    const dy = by - ay;
+    const lengthSq = dx * dx + dy * dy;
+    if (lengthSq === 0) {
+      return Math.hypot(px - ax, py - ay);
+    }
+    const t = Math.max(0, Math.min(1, ((px - ax) * dx + (py - ay) * dy) / lengthSq));
+    return Math.hypot(px - (ax + t * dx), py - (ay + t * dy));
+  };
+
+  const douglasPeucker = (flat, tolerance) => {
+    const count = flat.length / 2;
+    if (count <= 2) {
+      return flat.slice();
+    }
+    const keep = new Uint8Array(count);
+    keep[0] = 1;
+    keep[count - 1] = 1;
+    const stack = [[0, count - 1]];
+    while (stack.length) {
+      const [first, last] = stack.pop();
+      let maxDistance = 0;
+      let index = -1;
+      for (let i = first + 1; i < last; i += 1) {
+        const distance = segmentDistance(
+          flat[i * 2],
+          flat[i * 2 + 1],
+          flat[first * 2],
+          flat[first * 2 + 1],
+          flat[last * 2],
+          flat[last * 2 + 1]
+        );
+        if (distance > maxDistance) {
+          maxDistance = distance;
+          index = i;
+        }
+      }
+      if (index >= 0 && maxDistance > tolerance) {
+        keep[index] = 1;
+        stack.push([first, index], [index, last]);
+      }
+    }
+    const out = [];
+    for (let i = 0; i < count; i += 1) {
+      if (keep[i]) {
+        out.push(flat[i * 2], flat[i * 2 + 1]);
+      }
+    }
+    return out;
+  };
+
+  const createStreamSimplifier = (tolerance) => {
+    const kept = [];
+    let buffer = [];
+    let rawCount = 0;
+
+    const push = (x, y) => {
+      rawCount += 1;
+      if (kept.length === 0) {
+        kept.push(x, y);
+        return;
+      }
+      buffer.push(x, y);
+      const ax = kept[kept.length - 2];
+      const ay = kept[kept.length - 1];
+      const n = buffer.length / 2;
+      let split = n > MAX_BUFFER;
+      for (let i = 0; !split && i < n - 1; i += 1) {
+        split = segmentDistance(buffer[i * 2], buffer[i * 2 + 1], ax, ay, x, y) > tolerance;
+      }
+      if (split && n >= 2) {
+        kept.push(buffer[buffer.length - 4], buffer[buffer.length - 3]);
+        buffer = [x, y];
+      }
+    };
+
+    const finish = () => {
+      if (buffer.length) {
+        kept.push(buffer[buffer.length - 2], buffer[buffer.length - 1]);
+        buffer = [];
+      }
+      return douglasPeucker(kept, tolerance);
+    };
+
+    return {
+      push,
+      finish,
+      preview: () => kept.concat(buffer.slice(-2)),
+      rawCount: () => rawCount,
+    };
+  };
+
+  const create = (options) => {
+    const container = options.container;
+    const svg = options.svg;
+    const getSize = options.getSize;
+    const tolerance = Number(options.tolerance) || 1.5;
+    const canStart = options.canStart || (() => true);
+    const onStroke = options.onStroke || (() => {});
+    const definitions = Array.isArray(options.definitions) ? options.definitions : [];
+    const contours = Object.assign({}, options.contours || {});
+    const active = options.active || null;
+    const colorById = {};
+    definitions.forEach((def) => {
+      colorById[def.id] = def.color || "#22d3ee";
+    });
+
+    let stroke = null;
+    let strokePointerId = null;
+    let livePath = null;
+    let drawPending = false;
+
+    const toPoints = (flat) => {
+      const parts = [];
+      for (let i = 0; i < flat.length; i += 2) {
+        parts.push(`${flat[i].toFixed(1)},${flat[i + 1].toFixed(1)}`);
+      }
+      return parts.join(" ");
+    };
+
+    const render = () => {
+      const size = getSize();
+      svg.setAttribute("viewBox", `0 0 ${size.width} ${size.height}`);
+      svg.setAttribute("width", size.width);
+      svg.setAttribute("height", size.height);
+      svg.innerHTML = "";
+      Object.keys(contours).forEach((id) => {
+        const ratios = contours[id];
+        if (!Array.isArray(ratios) || ratios.length < 2) {
+          return;
+        }
+        const flat = [];
+        ratios.forEach((pt) => flat.push(pt[0] * size.width, pt[1] * size.height));
+        const line = document.createElementNS(SVG_NS, "polyline");
+        line.setAttribute("points", toPoints(flat));
+        line.setAttribute("fill", "none");
+        line.setAttribute("stroke", colorById[id] || "#22d3ee");
+        line.setAttribute("stroke-width", id === active ? 2.5 : 1.8);
+        line.setAttribute("stroke-linejoin", "round");
+        line.setAttribute("stroke-linecap", "round");
+        line.setAttribute("vector-effect", "non-scaling-stroke");
+        svg.appendChild(line);
+      });
+      livePath = document.createElementNS(SVG_NS, "polyline");
+      livePath.setAttribute("fill", "none");
+      livePath.setAttribute("stroke", colorById[active] || "#22d3ee");
+      livePath.setAttribute("stroke-width", 2.5);
+      livePath.setAttribute("stroke-dasharray", "4 3");
+      livePath.setAttribute("vector-effect", "non-scaling-stroke");
+      svg.appendChild(livePath);
+    };
+
+    const drawLive = () => {
+      drawPending = false;
+      if (stroke && livePath) {
+        livePath.setAttribute("points", toPoints(stroke.preview()));
+      }
+    };
+
+    const localPoint = (event) => {
+      const rect = svg.getBoundingClientRect();
+      const size = getSize();
+      return {
+        x: (event.clientX - rect.left) * (rect.width ? size.width / rect.width : 1),
+        y: (event.clientY - rect.top) * (rect.height ? size.height / rect.height : 1),
+      };
+    };
+
+    if (active) {
+      container.style.touchAction = "none";
+      container.addEventListener("pointerdown", (event) => {
+        if (stroke || !canStart(event)) {
+          return;
+        }
+        const point = localPoint(event);
+        stroke = createStreamSimplifier(tolerance);
+        strokePointerId = event.pointerId;
+        stroke.push(point.x, point.y);
+        try {
+          container.setPointerCapture(event.pointerId);
+        } catch (error) {
+          /* ignore */
+        }
+        event.preventDefault();
+      });
+      container.addEventListener("pointermove", (event) => {
+        if (!stroke || event.pointerId !== strokePointerId) {
+          return;
+        }
+        const samples = event.getCoalescedEvents ? event.getCoalescedEvents() : [];
+        (samples.length ? samples : [event]).forEach((sample) => {
+          const point = localPoint(sample);
+          stroke.push(point.x, point.y);
+        });
+        if (!drawPending) {
+          drawPending = true;
+          global.requestAnimationFrame(drawLive);
+        }
+      });
+      const finish = (event) => {
+        if (!stroke || event.pointerId !== strokePointerId) {
+          return;
+        }
+        const flat = stroke.finish();
+        const rawCount = stroke.rawCount();
+        stroke = null;
+        strokePointerId = null;
+        if (flat.length < 4) {
+          render();
+          return;
+        }
+        const size = getSize();
+        const ratios = [];
+        for (let i = 0; i < flat.length; i += 2) {
+          ratios.push([
+            Math.round((flat[i] / (size.width || 1)) * 1e5) / 1e5,
+            Math.round((flat[i + 1] / (size.height || 1)) * 1e5) / 1e5,
+          ]);
+        }
+        contours[active] = ratios;
+        render();
+        onStroke(active, ratios, rawCount);
+      };
+      container.addEventListener("pointerup", finish);
+      container.addEventListener("pointercancel", finish);
+    }
+
+    return { render, isTracing: () => stroke !== null };
+  };
+
+  global.CephContourTracer = { create, douglasPeucker };
+})(window);
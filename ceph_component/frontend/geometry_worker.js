@@ -0,0 +1,315 @@
+/*
+ * Angle and SD-polygon geometry off the main thread.
+ *
+ * The main thread sends landmark coordinates as a transferable Float64Array
+ * (x0, y0, x1, y1, ... in the order given at configure time) and applies the
+ * returned typed arrays to the DOM. Row centres of the angle stack can only be
+ * measured in the DOM, so they are sent separately on layout changes and the
+ * polygon outline is recomputed only then. At most one update is in flight;
+ * newer coordinates replace the pending ones instead of queueing.
+ *
+ * Without Worker / Blob support the same core runs synchronously.
+ */
+(function (global) {
+  "use strict";
+
+  // Runs inside the worker (serialised with toString), so it must not close
+  // over anything from this file.
+  function geometryCore() {
+    const SKIP = { "00": true, "01": true, ZZ: true, VTOP: true, VBOT: true };
+    let angles = [];
+    let rows = [];
+    let index = {};
+    let sdBase = 1;
+    let widthScale = 1;
+    let layout = null;
+
+    const configure = (msg) => {
+      angles = msg.angles || [];
+      rows = msg.rows || [];
+      sdBase = msg.sdBase || 1;
+      widthScale = msg.widthScale || 1;
+      index = {};
+      (msg.ids || []).forEach((id, i) => {
+        index[id] = i;
+      });
+    };
+
+    const angleOf = (c, pairA, pairB) => {
+      const a1 = index[pairA[0]];
+      const a2 = index[pairA[1]];
+      const b1 = index[pairB[0]];
+      const b2 = index[pairB[1]];
+      if (a1 === undefined || a2 === undefined || b1 === undefined || b2 === undefined) {
+        return NaN;
+      }
+      const vAx = c[a1 * 2] - c[a2 * 2];
+      const vAy = c[a1 * 2 + 1] - c[a2 * 2 + 1];
+      const vBx = c[b1 * 2] - c[b2 * 2];
+      const vBy = c[b1 * 2 + 1] - c[b2 * 2 + 1];
+      const lenA = Math.hypot(vAx, vAy);
+      const lenB = Math.hypot(vBx, vBy);
+      if (!(lenA >= 1e-6) || !(lenB >= 1e-6)) {
+        return NaN;
+      }
+      const r = Math.min(1, Math.max(-1, (vAx * vBx + vAy * vBy) / (lenA * lenB)));
+      return (Math.acos(r) * 180) / Math.PI;
+    };
+
+    const computeAngles = (c) => {
+      const values = new Float64Array(angles.length);
+      const byId = {};
+      angles.forEach((cfg, i) => {
+        let v = NaN;
+        if (cfg.type === "angle") {
+          v = angleOf(c, cfg.vectors[0], cfg.vectors[1]);
+        } else if (cfg.type === "difference") {
+          const a = byId[cfg.minuend];
+          const b = byId[cfg.subtrahend];
+          if (a !== undefined && b !== undefined) {
+            v = a - b;
+          }
+        }
+        if (cfg.id === "Convexity") {
+          v = 180 - v;
+        }
+        values[i] = v;
+        byId[cfg.id] = v;
+      });
+      return { values, byId };
+    };
+
+    const setLayout = (msg) => {
+      const centers = msg.centers;
+      const h = msg.height || 600;
+      const w = msg.width || 800;
+      const offsetX = Math.round(w * 0.2) + 60;
+      const count = rows.length;
+      const ys = new Array(count).fill(null);
+      for (let i = 0; i < count; i += 1) {
+        if (!SKIP[rows[i][0]] && Number.isFinite(centers[i])) {
+          ys[i] = centers[i];
+        }
+      }
+      for (let i = 0; i < count; i += 1) {
+        if (ys[i] !== null) {
+          continue;
+        }
+        let prev = null;
+        let next = null;
+        for (let p = i - 1; p >= 0; p -= 1) {
+          if (ys[p] !== null) {
+            prev = ys[p];
+            break;
+          }
+        }
+        for (let n = i + 1; n < count; n += 1) {
+          if (ys[n] !== null) {
+            next = ys[n];
+            break;
+          }
+        }
+        if (prev !== null && next !== null) ys[i] = (prev + next) / 2;
+        else if (prev !== null) ys[i] = prev + 40;
+        else if (next !== null) ys[i] = next - 40;
+        else ys[i] = Math.round(h * 0.1);
+      }
+      const gaps = [];
+      for (let i = 1; i < count; i += 1) gaps.push(Math.abs(ys[i] - ys[i - 1]));
+      const median = gaps.length ? gaps.sort((a, b) => a - b)[Math.floor(gaps.length / 2)] : 24;
+      const unit = Math.max(14, Math.round(median));
+
+      const idxVTOP = rows.findIndex((r) => r[0] === "VTOP");
+      const idxVBOT = rows.findIndex((r) => r[0] === "VBOT");
+      let firstRealY = null;
+      let lastRealY = null;
+      for (let i = 0; i < count; i += 1) {
+        if (!SKIP[rows[i][0]]) {
+          firstRealY = ys[i];
+          break;
+        }
+      }
+      for (let i = count - 1; i >= 0; i -= 1) {
+        if (!SKIP[rows[i][0]]) {
+          lastRealY = ys[i];
+          break;
+        }
+      }
+      if (idxVTOP >= 0 && firstRealY !== null) ys[idxVTOP] = firstRealY - unit;
+      if (idxVBOT >= 0 && lastRealY !== null) ys[idxVBOT] = lastRealY + unit;
+
+      const yInt = ys.map((v) => Math.round(v));
+      const outline = new Float32Array(count * 4);
+      for (let i = 0; i < count; i += 1) {
+        const spread = rows[i][3] * sdBase * widthScale * unit;
+        outline[i * 2] = Math.round(offsetX - spread);
+        outline[i * 2 + 1] = yInt[i];
+        const j = 2 * count - 1 - i;
+        outline[j * 2] = Math.round(offsetX + spread);
+        outline[j * 2 + 1] = yInt[i];
+      }
+      layout = {
+        yInt,
+        unit,
+        offsetX,
+        idxVTOP,
+        idxVBOT,
+        outline,
+        center: new Float32Array([Math.round(offsetX), yInt[0], yInt[count - 1]]),
+        dirty: true,
+      };
+    };
+
+    const patientLine = (byId) => {
+      if (!layout) {
+        return new Float32Array(0);
+      }
+      const pts = [];
+      const offsetXInt = Math.round(layout.offsetX);
+      if (layout.idxVTOP >= 0) pts.push(offsetXInt, layout.yInt[layout.idxVTOP]);
+      rows.forEach((row, i) => {
+        if (SKIP[row[0]]) return;
+        const mean = row[1];
+        const sd = row[2];
+        const ratio = row[3];
+        const val = byId[row[0]];
+        if (!sd || !ratio || val === undefined || !Number.isFinite(val)) return;
+        const sdPx = ratio * sdBase * widthScale * layout.unit;
+        pts.push(Math.round(layout.offsetX + ((val - mean) / sd) * sdPx), layout.yInt[i]);
+      });
+      if (layout.idxVBOT >= 0) pts.push(offsetXInt, layout.yInt[layout.idxVBOT]);
+      return new Float32Array(pts);
+    };
+
+    const compute = (msg) => {
+      const result = computeAngles(msg.coords);
+      const out = { seq: msg.seq, values: result.values, patient: patientLine(result.byId) };
+      if (layout && layout.dirty) {
+        out.outline = layout.outline.slice();
+        out.center = layout.center.slice();
+        layout.dirty = false;
+      }
+      return out;
+    };
+
+    return { configure, setLayout, compute };
+  }
+
+  const transferList = (result) =>
+    [result.values, result.patient, result.outline, result.center]
+      .filter(Boolean)
+      .map((array) => array.buffer);
+
+  const spawnWorker = () => {
+    if (typeof global.Worker !== "function" || typeof global.Blob !== "function" || !global.URL) {
+      return null;
+    }
+    const source =
+      "const core = (" +
+      geometryCore.toString() +
+      ")();\n" +
+      "self.onmessage = (event) => {\n" +
+      "  const msg = event.data;\n" +
+      "  if (msg.type === 'configure') { core.configure(msg); return; }\n" +
+      "  if (msg.type === 'layout') { core.setLayout(msg); return; }\n" +
+      "  const result = core.compute(msg);\n" +
+      "  self.postMessage(result, (" +
+      transferList.toString() +
+      ")(result));\n" +
+      "};\n";
+    try {
+      const url = global.URL.createObjectURL(new global.Blob([source], { type: "text/javascript" }));
+      const worker = new global.Worker(url);
+      global.URL.revokeObjectURL(url);
+      return worker;
+    } catch (error) {
+      return null;
+    }
+  };
+
+  const createClient = (options) => {
+    const onResult = options.onResult || (() => {});
+    const config = {
+      type: "configure",
+      ids: options.ids || [],
+      angles: options.angles || [],
+      rows: options.rows || [],
+      sdBase: options.sdBase,
+      widthScale: options.widthScale,
+    };
+    let core = null;
+    let worker = spawnWorker();
+    let seq = 0;
+    let inFlight = false;
+    let pending = null;
+    let lastLayout = null;
+
+    const useInline = () => {
+      if (worker) {
+        worker.terminate();
+        worker = null;
+      }
+      core = geometryCore();
+      core.configure(config);
+      if (lastLayout) {
+        core.setLayout(lastLayout);
+      }
+    };
+
+    const send = (msg) => {
+      inFlight = true;
+      worker.postMessage(msg, [msg.coords.buffer]);
+    };
+
+    if (worker) {
+      worker.onmessage = (event) => {
+        inFlight = false;
+        onResult(event.data);
+        if (pending) {
+          const next = pending;
+          pending = null;
+          send(next);
+        }
+      };
+      worker.onerror = () => {
+        inFlight = false;
+        useInline();
+        if (pending) {
+          const next = pending;
+          pending = null;
+          onResult(core.compute(next));
+        }
+      };
+      worker.postMessage(config);
+    } else {
+      useInline();
+    }
+
+    const layout = (centers, width, height) => {
+      lastLayout = { type: "layout", centers, width, height };
+      if (worker) {
+        worker.postMessage(lastLayout);
+      } else {
+        core.setLayout(lastLayout);
+      }
+    };
+
+    const update = (coords) => {
+      seq += 1;
+      const msg = { type: "compute", seq, coords };
+      if (!worker) {
+        onResult(core.compute(msg));
+        return;
+      }
+      if (inFlight) {
+        pending = msg;
+        return;
+      }
+      send(msg);
+    };
+
+    return { layout, update, usesWorker: () => worker !== null };
+  };
+
+  global.CephGeometry = { createClient };
+})(window);
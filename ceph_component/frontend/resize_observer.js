@@ -0,0 +1,44 @@
+/*
+ * Debounced size observer shared by the component frontends.
+ *
+ * Mobile rotation or the URL bar collapsing fires dozens of window "resize"
+ * events. Watching the wrapper with a ResizeObserver and collapsing bursts into
+ * one callback keeps relayout work (and anything it emits) to one per change.
+ */
+(function (global) {
+  "use strict";
+
+  global.cephObserveResize = (target, callback, delay) => {
+    const wait = typeof delay === "number" ? delay : 120;
+    let timer = null;
+    let lastWidth = -1;
+    let lastHeight = -1;
+
+    const flush = () => {
+      timer = null;
+      const width = Math.round(target.clientWidth || 0);
+      const height = Math.round(target.clientHeight || 0);
+      if (width === lastWidth && height === lastHeight) {
+        return;
+      }
+      lastWidth = width;
+      lastHeight = height;
+      callback({ width, height });
+    };
+
+    const schedule = () => {
+      if (timer !== null) {
+        global.clearTimeout(timer);
+      }
+      timer = global.setTimeout(flush, wait);
+    };
+
+    if (typeof global.ResizeObserver === "function") {
+      const observer = new global.ResizeObserver(schedule);
+      observer.observe(target);
+      return () => observer.disconnect();
+    }
+    global.addEventListener("resize", schedule);
+    return () => global.removeEventListener("resize", schedule);
+  };
+})(window);
@@ -0,0 +1,143 @@
+/*
+ * Drag smoothness telemetry.
+ *
+ * Records, as fixed-bucket histograms:
+ *   - latency: pointer event -> the next animation frame callback (approximate
+ *     pointer-to-paint; style/layout/paint follow right after the callback)
+ *   - frame:   frame intervals while a drag is active
+ *   - longtask: PerformanceObserver "longtask" durations
+ * drain() returns a compact snapshot (or null when nothing was recorded) and
+ * resets the counters, so each snapshot is sent to Python exactly once on the
+ * next component value.
+ */
+(function (global) {
+  "use strict";
+
+  const DEFAULT_EDGES = [4, 8, 12, 16, 20, 25, 33, 50, 75, 100, 150, 250, 500, 1000];
+
+  const create = (options) => {
+    const opts = options || {};
+    const edges = Array.isArray(opts.edges) && opts.edges.length ? opts.edges : DEFAULT_EDGES;
+    const histogram = () => new Uint32Array(edges.length + 1);
+    const now = () => global.performance.now();
+
+    let latency = histogram();
+    let frame = histogram();
+    let longTask = histogram();
+    let drags = 0;
+    let dragMs = 0;
+    let frames = 0;
+    let dirty = false;
+    let dragStartedAt = null;
+    let lastFrameAt = null;
+    let pendingInputAt = null;
+    let rafId = null;
+
+    const bucket = (ms) => {
+      let i = 0;
+      while (i < edges.length && ms > edges[i]) {
+        i += 1;
+      }
+      return i;
+    };
+    const add = (hist, ms) => {
+      if (!(ms >= 0)) {
+        return;
+      }
+      hist[bucket(ms)] += 1;
+      dirty = true;
+    };
+
+    const onFrame = (frameAt) => {
+      if (pendingInputAt !== null) {
+        add(latency, now() - pendingInputAt);
+        pendingInputAt = null;
+      }
+      if (lastFrameAt !== null) {
+        add(frame, frameAt - lastFrameAt);
+        frames += 1;
+      }
+      lastFrameAt = frameAt;
+      rafId = dragStartedAt !== null ? global.requestAnimationFrame(onFrame) : null;
+    };
+
+    const dragStart = () => {
+      drags += 1;
+      dirty = true;
+      dragStartedAt = now();
+      lastFrameAt = null;
+      if (rafId === null) {
+        rafId = global.requestAnimationFrame(onFrame);
+      }
+    };
+
+    // event.timeStamp は performance.now() と同じ時間軸
+    const input = (timeStamp) => {
+      if (pendingInputAt === null) {
+        pendingInputAt = typeof timeStamp === "number" && timeStamp > 0 ? timeStamp : now();
+      }
+    };
+
+    const dragEnd = () => {
+      if (dragStartedAt !== null) {
+        dragMs += now() - dragStartedAt;
+        dragStartedAt = null;
+      }
+    };
+
+    try {
+      const observer = new global.PerformanceObserver((list) => {
+        list.getEntries().forEach((entry) => add(longTask, entry.duration));
+      });
+      observer.observe({ type: "longtask", buffered: true });
+    } catch (error) {
+      /* longtask 非対応のブラウザでは記録しない */
+    }
+
+    const device = () => {
+      const nav = global.navigator || {};
+      let pointer = "fine";
+      try {
+        pointer = global.matchMedia("(pointer: coarse)").matches ? "coarse" : "fine";
+      } catch (error) {
+        /* ignore */
+      }
+      return {
+        pointer,
+        cores: nav.hardwareConcurrency || 0,
+        memory: nav.deviceMemory || 0,
+        dpr: global.devicePixelRatio || 1,
+        renderer: opts.renderer || "dom",
+        view: opts.view || "",
+      };
+    };
+
+    const drain = () => {
+      if (!dirty) {
+        return null;
+      }
+      const snapshot = {
+        v: 1,
+        latency: Array.from(latency),
+        frame: Array.from(frame),
+        longtask: Array.from(longTask),
+        drags,
+        drag_ms: Math.round(dragMs),
+        frames,
+        device: device(),
+      };
+      latency = histogram();
+      frame = histogram();
+      longTask = histogram();
+      drags = 0;
+      dragMs = 0;
+      frames = 0;
+      dirty = false;
+      return snapshot;
+    };
+
+    return { dragStart, input, dragEnd, drain };
+  };
+
+  global.CephTelemetry = { create };
+})(window);
@@ -0,0 +1,235 @@
+"""輪郭トレース (軟組織側貌・下顎下縁・切歯外形) と輪郭ベースの計測。
+
+輪郭はステージ比率の折れ線 ``[[x_ratio, y_ratio], ...]`` として保持する。
+コンポーネント側でストローク中に逐次簡略化済みだが、取り込み時にも
+Douglas–Peucker をかけ直して点数の上限を保証する。
+"""
+
+import math
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+CONTOUR_DEFINITIONS = [
+    {"id": "soft_profile", "name": "軟組織側貌", "color": "#22d3ee"},
+    {"id": "mandibular_border", "name": "下顎下縁", "color": "#4ade80"},
+    {"id": "u1_outline", "name": "上顎中切歯外形", "color": "#38bdf8"},
+    {"id": "l1_outline", "name": "下顎中切歯外形", "color": "#2dd4bf"},
+]
+CONTOUR_IDS = [definition["id"] for definition in CONTOUR_DEFINITIONS]
+
+CONTOUR_RESULT_ORDER = [
+    "E-line to upper lip",
+    "E-line to lower lip",
+    "Nasolabial angle",
+    "Soft profile curvature",
+    "Mandibular border curvature",
+]
+CONTOUR_UNITS = {
+    "E-line to upper lip": "px",
+    "E-line to lower lip": "px",
+    "Nasolabial angle": "°",
+    "Soft profile curvature": "°",
+    "Mandibular border curvature": "°",
+}
+LENGTH_RESULTS = ("E-line to upper lip", "E-line to lower lip")
+
+SIMPLIFY_TOLERANCE_RATIO = 0.0015
+MAX_CONTOUR_POINTS = 400
+
+
+def simplify_polyline(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas–Peucker。区間ごとの距離計算を numpy でまとめて行う。"""
+    points = np.asarray(points, dtype=float)
+    count = len(points)
+    if count <= 2:
+        return points
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1 : last]
+        direction = end - start
+        length_sq = float(direction @ direction)
+        if length_sq == 0.0:
+            distances = np.hypot(*(inner - start).T)
+        else:
+            t = np.clip((inner - start) @ direction / length_sq, 0.0, 1.0)
+            distances = np.hypot(*(inner - (start + t[:, None] * direction)).T)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def normalize_contour(raw: Sequence[Sequence[float]]) -> List[List[float]]:
+    """コンポーネントから届いた輪郭を検証・簡略化して保存形式にする。"""
+    points = np.asarray(
+        [pt[:2] for pt in raw if isinstance(pt, (list, tuple)) and len(pt) >= 2],
+        dtype=float,
+    ).reshape(-1, 2)
+    points = points[np.isfinite(points).all(axis=1)]
+    points = np.clip(points, 0.0, 1.0)
+    if len(points) < 2:
+        return []
+    tolerance = SIMPLIFY_TOLERANCE_RATIO
+    simplified = simplify_polyline(points, tolerance)
+    while len(simplified) > MAX_CONTOUR_POINTS:
+        tolerance *= 2
+        simplified = simplify_polyline(points, tolerance)
+    return np.round(simplified, 5).tolist()
+
+
+def contour_to_px(ratios: Sequence[Sequence[float]], stage: Dict[str, float]) -> np.ndarray:
+    points = np.asarray(ratios, dtype=float).reshape(-1, 2)
+    return points * np.array([stage.get("width") or 1.0, stage.get("height") or 1.0])
+
+
+def turning_angles(points: np.ndarray) -> np.ndarray:
+    """各内部頂点での進行方向の変化角 (度, 符号付き)。"""
+    if len(points) < 3:
+        return np.zeros(0)
+    segments = np.diff(points, axis=0)
+    headings = np.arctan2(segments[:, 1], segments[:, 0])
+    turns = np.diff(headings)
+    return np.degrees((turns + np.pi) % (2 * np.pi) - np.pi)
+
+
+def total_curvature(points: np.ndarray) -> float:
+    """輪郭全体の曲がり具合 (変化角の絶対値の総和, 度)。縮尺に依存しない。"""
+    if len(points) < 3:
+        return float("nan")
+    return float(np.abs(turning_angles(points)).sum())
+
+
+def anterior_direction(points_px: Dict[str, Sequence[float]]) -> float:
+    """顔の向き。N が S より右なら +1 (右向き)。"""
+    if "N" in points_px and "S" in points_px:
+        return 1.0 if points_px["N"][0] >= points_px["S"][0] else -1.0
+    return 1.0
+
+
+def _argbest(values: np.ndarray, mask: np.ndarray, largest: bool) -> Optional[int]:
+    if not mask.any():
+        return None
+    candidates = np.where(mask, values, -np.inf if largest else np.inf)
+    return int(np.argmax(candidates) if largest else np.argmin(candidates))
+
+
+def soft_tissue_landmarks(profile: np.ndarray, facing: float) -> Dict[str, int]:
+    """側貌輪郭から Pn / Sn / Ls / Li / Pog' のインデックスを推定する。
+
+    前方座標 a = facing * x と高さ y の区間だけを使う簡易な推定で、
+    額から顎までを 1 本でなぞった輪郭を想定している。
+    """
+    if len(profile) < 5:
+        return {}
+    anterior = profile[:, 0] * facing
+    y = profile[:, 1]
+    y_min, y_max = float(y.min()), float(y.max())
+    span = y_max - y_min
+    if span <= 0:
+        return {}
+    landmarks: Dict[str, int] = {}
+    pn = _argbest(anterior, y <= y_min + 0.6 * span, largest=True)
+    pog = _argbest(anterior, y >= y_min + 0.65 * span, largest=True)
+    if pn is None or pog is None or y[pog] <= y[pn]:
+        return {}
+    landmarks["Pn"] = pn
+    landmarks["Pog'"] = pog
+    y_pn, y_pog = y[pn], y[pog]
+    sn = _argbest(anterior, (y > y_pn) & (y < y_pn + 0.35 * (y_pog - y_pn)), largest=False)
+    if sn is None:
+        return landmarks
+    landmarks["Sn"] = sn
+    ls = _argbest(anterior, (y > y[sn]) & (y < y[sn] + 0.5 * (y_pog - y[sn])), largest=True)
+    if ls is None:
+        return landmarks
+    landmarks["Ls"] = ls
+    li = _argbest(anterior, (y > y[ls]) & (y < y[ls] + 0.5 * (y_pog - y[ls])), largest=True)
+    if li is not None:
+        landmarks["Li"] = li
+    return landmarks
+
+
+def signed_line_distance(points: np.ndarray, start: np.ndarray, end: np.ndarray, facing: float) -> np.ndarray:
+    """直線 start→end までの距離。facing 方向 (前方) にあれば正。"""
+    direction = end - start
+    length = float(np.hypot(*direction))
+    if length == 0:
+        return np.full(len(points), np.nan)
+    normal = np.array([direction[1], -direction[0]]) / length
+    if normal[0] * facing < 0:
+        normal = -normal
+    return (points - start) @ normal
+
+
+def vertex_angle(vertex: np.ndarray, a: np.ndarray, b: np.ndarray) -> float:
+    va, vb = a - vertex, b - vertex
+    denom = float(np.hypot(*va) * np.hypot(*vb))
+    if denom == 0:
+        return float("nan")
+    return math.degrees(math.acos(float(np.clip(va @ vb / denom, -1.0, 1.0))))
+
+
+def contour_units(calibrated: bool) -> Dict[str, str]:
+    units = dict(CONTOUR_UNITS)
+    if calibrated:
+        units.update({name: "mm" for name in LENGTH_RESULTS})
+    return units
+
+
+def compute_contour_measurements(
+    contours: Dict[str, List[List[float]]],
+    stage: Dict[str, float],
+    points_px: Dict[str, Sequence[float]],
+    mm_per_px: Optional[float] = None,
+) -> Dict[str, float]:
+    """輪郭ベースの計測値。stage は比率を掛ける座標系の幅・高さ、mm_per_px (その px あたり) があれば距離を mm で返す。"""
+    results = {name: float("nan") for name in CONTOUR_RESULT_ORDER}
+    facing = anterior_direction(points_px)
+
+    profile_ratios = contours.get("soft_profile") or []
+    if len(profile_ratios) >= 5:
+        profile = contour_to_px(profile_ratios, stage)
+        results["Soft profile curvature"] = total_curvature(profile)
+        marks = soft_tissue_landmarks(profile, facing)
+        if "Pn" in marks and "Pog'" in marks:
+            lip_names = [
+                (name, key)
+                for name, key in (("E-line to upper lip", "Ls"), ("E-line to lower lip", "Li"))
+                if key in marks
+            ]
+            if lip_names:
+                distances = signed_line_distance(
+                    profile[[marks[key] for _, key in lip_names]],
+                    profile[marks["Pn"]],
+                    profile[marks["Pog'"]],
+                    facing,
+                )
+                for (name, _), distance in zip(lip_names, distances):
+                    results[name] = float(distance)
+        if "Sn" in marks and "Ls" in marks and "Pn" in marks:
+            # 鼻柱側は Sn と Pn の間 (Sn 寄り 4 割) の点で接線を近似する
+            sn, pn = marks["Sn"], marks["Pn"]
+            columella = sn + int(round((pn - sn) * 0.4)) if pn != sn else pn
+            if columella == sn:
+                columella = pn
+            results["Nasolabial angle"] = vertex_angle(profile[sn], profile[columella], profile[marks["Ls"]])
+
+    if mm_per_px:
+        for name in LENGTH_RESULTS:
+            results[name] *= mm_per_px
+
+    border_ratios = contours.get("mandibular_border") or []
+    if len(border_ratios) >= 3:
+        results["Mandibular border curvature"] = total_curvature(contour_to_px(border_ratios, stage))
+    return results
@@ -0,0 +1,225 @@
+"""DICOM (セファロ撮影装置の出力) の読み込み。
+
+ヘッダーは読み込み時にすぐ読み、画素データは表示画像を作るときに初めて復号する
+(pydicom の ``defer_size`` で大きな要素の読み込みそのものも遅らせる)。
+表示画像は保存されたウィンドウ (中心・幅) を適用した 8bit グレースケール。
+リスケール・ウィンドウ・MONOCHROME1 の反転は格納値からの 1 つのルックアップ表にまとめ、
+帯状に分けて引くので、16bit 画像でも浮動小数点や int64 の全面コピーは作らない。
+
+pydicom が必要 (``pip install pydicom``。JPEG などの圧縮転送構文には pylibjpeg などのプラグインも)。
+"""
+
+import io
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+DICOM_EXTENSIONS = ("dcm", "dicom")
+DICOM_MAGIC = b"DICM"
+MAGIC_OFFSET = 128
+DEFER_SIZE = "64 KB"  # これより大きい要素は使うときに読む
+STRIP_ROWS = 256  # ルックアップ表を引くときの一時配列を行数で抑える
+PNG_COMPRESS_LEVEL = 3
+MONOCHROME = ("MONOCHROME1", "MONOCHROME2")
+
+
+def is_dicom(data: bytes, name: str = "") -> bool:
+    """プリアンブルの "DICM" か拡張子で DICOM とみなす。"""
+    if data[MAGIC_OFFSET : MAGIC_OFFSET + len(DICOM_MAGIC)] == DICOM_MAGIC:
+        return True
+    return name.lower().rsplit(".", 1)[-1] in DICOM_EXTENSIONS
+
+
+def _import_pydicom():
+    try:
+        import pydicom
+    except ImportError as exc:
+        raise RuntimeError("DICOM の読み込みには `pip install pydicom` が必要です。") from exc
+    return pydicom
+
+
+def _first_float(value: Any) -> Optional[float]:
+    """多値 (VM > 1) の要素は最初の値を使う。"""
+    if value is None or value == "":
+        return None
+    if not isinstance(value, (str, bytes, int, float)):
+        if not len(value):
+            return None
+        value = value[0]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _spacing(dataset: Any) -> Tuple[Optional[float], str]:
+    """原画像 1 px あたりの mm と、その出典の要素名。
+
+    PixelSpacing (患者面で校正済み) を優先し、無ければ検出器面の ImagerPixelSpacing を
+    推定拡大率で割る。縦横が違う場合は平均を使う (アプリの校正は 1 つの値のため)。
+    """
+    for name in ("PixelSpacing", "ImagerPixelSpacing"):
+        value = dataset.get(name)
+        if not value or len(value) < 2:
+            continue
+        try:
+            row, col = float(value[0]), float(value[1])
+        except (TypeError, ValueError):
+            continue
+        if row <= 0 or col <= 0:
+            continue
+        mm_per_px = (row + col) / 2
+        if name == "ImagerPixelSpacing":
+            magnification = _first_float(dataset.get("EstimatedRadiographicMagnificationFactor"))
+            if magnification and magnification > 0:
+                mm_per_px /= magnification
+        return mm_per_px, name
+    return None, ""
+
+
+@dataclass(frozen=True)
+class DicomHeader:
+    rows: int
+    columns: int
+    frames: int
+    samples_per_pixel: int
+    bits_stored: int
+    signed: bool
+    photometric: str
+    rescale_slope: float
+    rescale_intercept: float
+    window_center: Optional[float]
+    window_width: Optional[float]
+    mm_per_px: Optional[float]
+    spacing_source: str  # "PixelSpacing" / "ImagerPixelSpacing" / ""
+    modality: str = ""
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.columns, self.rows
+
+
+def read_header(dataset: Any) -> DicomHeader:
+    mm_per_px, source = _spacing(dataset)
+    bits_allocated = int(dataset.get("BitsAllocated") or 16)
+    return DicomHeader(
+        rows=int(dataset.get("Rows") or 0),
+        columns=int(dataset.get("Columns") or 0),
+        frames=int(dataset.get("NumberOfFrames") or 1),
+        samples_per_pixel=int(dataset.get("SamplesPerPixel") or 1),
+        bits_stored=int(dataset.get("BitsStored") or bits_allocated),
+        signed=int(dataset.get("PixelRepresentation") or 0) == 1,
+        photometric=str(dataset.get("PhotometricInterpretation") or "MONOCHROME2").strip(),
+        rescale_slope=_first_float(dataset.get("RescaleSlope")) or 1.0,
+        rescale_intercept=_first_float(dataset.get("RescaleIntercept")) or 0.0,
+        window_center=_first_float(dataset.get("WindowCenter")),
+        window_width=_first_float(dataset.get("WindowWidth")),
+        mm_per_px=mm_per_px,
+        spacing_source=source,
+        modality=str(dataset.get("Modality") or ""),
+    )
+
+
+def window_bounds(header: DicomHeader) -> Optional[Tuple[float, float]]:
+    """保存されたウィンドウの [下端, 上端] (モダリティ値, DICOM PS3.3 C.11.2.1.2 の線形 VOI)。"""
+    if header.window_center is None or header.window_width is None or header.window_width < 1:
+        return None
+    center, half = header.window_center - 0.5, (header.window_width - 1) / 2
+    return center - half, center + half
+
+
+def _to_display(values: np.ndarray, low: float, high: float) -> np.ndarray:
+    if high > low:
+        return (values - low) * (255.0 / (high - low))
+    return np.where(values > low, 255.0, 0.0)
+
+
+def _modality_range(pixels: np.ndarray, header: DicomHeader) -> Tuple[float, float]:
+    ends = [float(v) * header.rescale_slope + header.rescale_intercept for v in (pixels.min(), pixels.max())]
+    return min(ends), max(ends)
+
+
+def display_lut(header: DicomHeader, dtype: np.dtype, low: float, high: float) -> np.ndarray:
+    """格納値 (dtype の全範囲) → 表示 8bit の表。
+
+    符号付きの格納値は同じビット列の符号なし値で引けるよう並べる。
+    """
+    dtype = np.dtype(dtype)
+    raw = np.arange(2 ** (8 * dtype.itemsize), dtype=np.uint32).astype(dtype.str.replace("i", "u"))
+    values = raw.view(dtype).astype(np.float64) * header.rescale_slope + header.rescale_intercept
+    lut = np.clip(np.rint(_to_display(values, low, high)), 0, 255).astype(np.uint8)
+    if header.photometric == "MONOCHROME1":
+        np.subtract(255, lut, out=lut)
+    return lut
+
+
+def apply_lut(pixels: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """帯ごとに表を引いて 8bit 画像を作る (index の一時配列は STRIP_ROWS 行分だけ)。"""
+    index = pixels.view(pixels.dtype.str.replace("i", "u")) if pixels.dtype.kind == "i" else pixels
+    out = np.empty(pixels.shape, dtype=np.uint8)
+    for start in range(0, pixels.shape[0], STRIP_ROWS):
+        np.take(lut, index[start : start + STRIP_ROWS], out=out[start : start + STRIP_ROWS], mode="clip")
+    return out
+
+
+def window_to_uint8(pixels: np.ndarray, header: DicomHeader) -> np.ndarray:
+    """モノクロの格納値を表示用の 8bit にする。ウィンドウが無ければ画素の値域に伸ばす。"""
+    low, high = window_bounds(header) or _modality_range(pixels, header)
+    if pixels.dtype.kind in "ui" and pixels.dtype.itemsize <= 2:
+        return apply_lut(pixels, display_lut(header, pixels.dtype, low, high))
+    # 32bit や浮動小数点 (まれ) は帯ごとに計算する
+    out = np.empty(pixels.shape, dtype=np.uint8)
+    for start in range(0, pixels.shape[0], STRIP_ROWS):
+        values = pixels[start : start + STRIP_ROWS].astype(np.float64)
+        values = values * header.rescale_slope + header.rescale_intercept
+        out[start : start + STRIP_ROWS] = np.clip(np.rint(_to_display(values, low, high)), 0, 255)
+    if header.photometric == "MONOCHROME1":
+        np.subtract(255, out, out=out)
+    return out
+
+
+class DicomImage:
+    """ヘッダーは作成時に読み、画素は display_image() で初めて復号する。"""
+
+    def __init__(self, data: bytes, name: str = "") -> None:
+        pydicom = _import_pydicom()
+        force = data[MAGIC_OFFSET : MAGIC_OFFSET + len(DICOM_MAGIC)] != DICOM_MAGIC
+        try:
+            self._dataset = pydicom.dcmread(io.BytesIO(data), defer_size=DEFER_SIZE, force=force)
+            self.header = read_header(self._dataset)
+        except Exception as exc:
+            raise ValueError(f"DICOM ファイルを読み込めません ({name or '無名'}): {exc}") from exc
+        if "PixelData" not in self._dataset:
+            raise ValueError(f"DICOM ファイルに画像がありません ({name or '無名'})。")
+        if self.header.photometric not in MONOCHROME + ("RGB",):
+            raise ValueError(f"未対応の色空間です: {self.header.photometric}")
+
+    def _pixels(self) -> np.ndarray:
+        try:
+            pixels = self._dataset.pixel_array
+        except Exception as exc:
+            syntax = getattr(getattr(self._dataset, "file_meta", None), "TransferSyntaxUID", "")
+            raise ValueError(
+                f"DICOM の画素を復号できません (転送構文 {syntax})。圧縮形式には pylibjpeg などが必要です: {exc}"
+            ) from exc
+        # 復号結果は dataset にキャッシュされるので、この画像を作ったら手放す
+        self._dataset = None
+        if self.header.frames > 1:
+            pixels = pixels[0]
+        return pixels
+
+    def display_image(self) -> Image.Image:
+        """ウィンドウを適用した表示用画像 (L または RGB)。復号は 1 回だけ行える。"""
+        if self._dataset is None:
+            raise ValueError("DICOM の画素は既に復号済みです。")
+        pixels = self._pixels()
+        if self.header.samples_per_pixel == 3:
+            return Image.fromarray(np.asarray(pixels, dtype=np.uint8), "RGB")
+        return Image.fromarray(window_to_uint8(pixels, self.header), "L")
+
+    def to_png(self) -> bytes:
+        buffer = io.BytesIO()
+        self.display_image().save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
@@ -0,0 +1,162 @@
+"""ポイント移動の undo / redo 履歴。
+
+各確定操作 (pointerup やリセット) の ``(point_id, old_xy, new_xy)`` 差分だけを
+固定長のリングバッファに持つ。``ceph_points`` の全体コピーは保存しないので、
+何時間編集してもセッションあたりのメモリは一定のまま。
+"""
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+XY = Tuple[float, float]
+PointState = Dict[str, Dict[str, float]]
+
+DEFAULT_CAPACITY = 512
+
+
+class DeltaHistory:
+    """差分のリングバッファ。
+
+    エントリは通し番号 (seq) で管理し、スロットは ``seq % capacity``。
+    ``start <= seq < cursor`` が適用済み、``cursor <= seq < end`` が redo 可能な範囲。
+    同じ操作で動いたエントリは同じ group 番号を持ち、まとめて戻す/進める。
+    """
+
+    def __init__(self, point_ids: Iterable[str] = (), capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity = capacity
+        self.point_ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        for pid in point_ids:
+            self.point_index(pid)
+        self._pid = array("H", bytes(2 * capacity))
+        self._group = array("L", bytes(array("L").itemsize * capacity))
+        self._old = array("d", bytes(16 * capacity))
+        self._new = array("d", bytes(16 * capacity))
+        self.start = 0
+        self.cursor = 0
+        self.end = 0
+        self._next_group = 0
+
+    def point_index(self, pid: str) -> int:
+        if pid not in self.index:
+            self.index[pid] = len(self.point_ids)
+            self.point_ids.append(pid)
+        return self.index[pid]
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    @property
+    def can_undo(self) -> bool:
+        return self.cursor > self.start
+
+    @property
+    def can_redo(self) -> bool:
+        return self.cursor < self.end
+
+    def record(self, deltas: Iterable[Tuple[str, XY, XY]]) -> int:
+        """1 操作ぶんの差分を記録し、記録したエントリ数を返す。redo 範囲は破棄する。"""
+        entries = [(pid, old, new) for pid, old, new in deltas if old != new]
+        if not entries:
+            return 0
+        entries = entries[: self.capacity]
+        self.end = self.cursor
+        group = self._next_group
+        self._next_group += 1
+        for pid, old, new in entries:
+            if self.end - self.start >= self.capacity:
+                self._drop_oldest_group()
+            slot = self.end % self.capacity
+            self._pid[slot] = self.point_index(pid)
+            self._group[slot] = group
+            self._old[2 * slot], self._old[2 * slot + 1] = old
+            self._new[2 * slot], self._new[2 * slot + 1] = new
+            self.end += 1
+        self.cursor = self.end
+        return len(entries)
+
+    def _drop_oldest_group(self) -> None:
+        # バッファが一杯なら最古の操作を丸ごと捨てる (途中で切れたグループを残さない)
+        group = self._group_at(self.start)
+        while self.start < self.end and self._group_at(self.start) == group:
+            self.start += 1
+
+    def _group_at(self, seq: int) -> int:
+        return self._group[seq % self.capacity]
+
+    def _entry(self, seq: int) -> Tuple[str, XY, XY]:
+        slot = seq % self.capacity
+        return (
+            self.point_ids[self._pid[slot]],
+            (self._old[2 * slot], self._old[2 * slot + 1]),
+            (self._new[2 * slot], self._new[2 * slot + 1]),
+        )
+
+    def _step_back(self, state: PointState) -> List[str]:
+        group = self._group_at(self.cursor - 1)
+        moved: List[str] = []
+        while self.cursor > self.start and self._group_at(self.cursor - 1) == group:
+            self.cursor -= 1
+            pid, old, _ = self._entry(self.cursor)
+            set_xy(state, pid, old)
+            moved.append(pid)
+        return moved
+
+    def _step_forward(self, state: PointState) -> List[str]:
+        group = self._group_at(self.cursor)
+        moved: List[str] = []
+        while self.cursor < self.end and self._group_at(self.cursor) == group:
+            pid, _, new = self._entry(self.cursor)
+            set_xy(state, pid, new)
+            moved.append(pid)
+            self.cursor += 1
+        return moved
+
+    def undo(self, state: PointState) -> List[str]:
+        """直前の操作を state に逆適用し、動いたポイント ID を返す。"""
+        return self._step_back(state) if self.can_undo else []
+
+    def redo(self, state: PointState) -> List[str]:
+        return self._step_forward(state) if self.can_redo else []
+
+    def state_at(self, state: PointState, steps_back: int) -> PointState:
+        """現在の state から steps_back 操作前の状態を復元したコピーを返す (履歴は動かさない)。"""
+        snapshot = {pid: dict(info) for pid, info in state.items()}
+        seq = self.cursor
+        for _ in range(steps_back):
+            if seq <= self.start:
+                break
+            group = self._group_at(seq - 1)
+            while seq > self.start and self._group_at(seq - 1) == group:
+                seq -= 1
+                pid, old, _ = self._entry(seq)
+                set_xy(snapshot, pid, old)
+        return snapshot
+
+
+def get_xy(state: PointState, pid: str) -> Optional[XY]:
+    info = state.get(pid)
+    if not info or info.get("x_ratio") is None or info.get("y_ratio") is None:
+        return None
+    return (float(info["x_ratio"]), float(info["y_ratio"]))
+
+
+def set_xy(state: PointState, pid: str, xy: XY) -> None:
+    # 状態は比率だけを持つ (px はステージ寸法から都度求める)。古い状態に残った px も捨てる
+    info = state.setdefault(pid, {})
+    info.update({"x_ratio": xy[0], "y_ratio": xy[1]})
+    info.pop("x_px", None)
+    info.pop("y_px", None)
+
+
+def diff_states(before: PointState, after: PointState, epsilon: float = 0.0) -> List[Tuple[str, XY, XY]]:
+    """2 つのポイント状態の差分 (point_id, old_xy, new_xy) を返す。"""
+    deltas: List[Tuple[str, XY, XY]] = []
+    for pid in after:
+        old = get_xy(before, pid)
+        new = get_xy(after, pid)
+        if old is None or new is None:
+            continue
+        if abs(old[0] - new[0]) > epsilon or abs(old[1] - new[1]) > epsilon:
+            deltas.append((pid, old, new))
+    return deltas
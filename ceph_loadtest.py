@@ -0,0 +1,229 @@
+"""1 プロセスで何セッションをさばけるかを測るローカル負荷試験 (ネットワーク不要)。
+
+``streamlit.testing.v1.AppTest`` でセッションを N 個作り、スレッドから同時に再実行する。
+各セッションは sample.png を表示画像として読み込み、ドラッグ確定相当のコンポーネント値を
+``update_state_from_component`` に流してから ``CEF03.main`` / ``streamlit_event01.slim_main``
+を再実行する。再実行レイテンシのパーセンタイル、スループット、セッションあたりの RSS を出す。
+
+AppTest はファイルアップローダーとカスタムコンポーネントを操作できないため、
+画像は ``default_image_data_url`` に、コンポーネント値はセッション状態経由で渡す。
+
+    python ceph_loadtest.py --sessions 16 --reruns 30 --target both
+"""
+
+import argparse
+import json
+import logging
+import mimetypes
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from streamlit import config
+from streamlit.logger import set_log_level
+from streamlit.testing.v1 import AppTest
+
+from ceph_memory import current_rss_mb
+
+
+SAMPLE_IMAGE = Path(__file__).with_name("sample.png")
+COMPONENT_VALUE_KEY = "loadtest_component_value"
+DEFAULT_TIMEOUT = 60.0
+
+
+# AppTest.from_function は関数のソースだけを実行するので、import とキー名は関数内に書く
+def run_main_session() -> None:
+    import streamlit as st
+
+    import CEF03
+
+    CEF03.ensure_session_state()
+    value = st.session_state.pop("loadtest_component_value", None)
+    if value:
+        CEF03.update_state_from_component(value)
+    CEF03.main()
+
+
+def run_slim_session() -> None:
+    import streamlit as st
+
+    import CEF03
+    import streamlit_event01
+
+    CEF03.ensure_session_state()
+    value = st.session_state.pop("loadtest_component_value", None)
+    if value:
+        CEF03.update_state_from_component(value)
+    streamlit_event01.slim_main()
+
+
+TARGETS: Dict[str, Callable[[], None]] = {"main": run_main_session, "slim": run_slim_session}
+
+
+@dataclass(frozen=True)
+class LoadTestReport:
+    target: str
+    sessions: int
+    reruns: int
+    errors: int
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+    throughput_rps: float
+    rss_before_mb: float
+    rss_after_mb: float
+    rss_per_session_mb: float
+
+
+def drag_value(app: AppTest, session: int, seq: int, rng: random.Random) -> Dict:
+    """ポイント 1 つをドラッグして離したときのコンポーネント値を作る。"""
+    import CEF03
+
+    pid = rng.choice(CEF03.POINT_IDS)
+    stage = {"width": CEF03.BASE_CANVAS_WIDTH, "height": CEF03.BASE_CANVAS_HEIGHT}
+    x_ratio, y_ratio = rng.uniform(0.1, 0.9), rng.uniform(0.1, 0.9)
+    return {
+        "version": app.session_state["ceph_state_version"],
+        "instance": f"loadtest-{session}",
+        "seq": seq,
+        "event": "pointerup",
+        "active_id": pid,
+        "stage": stage,
+        "points": [
+            {
+                "id": pid,
+                "x_ratio": x_ratio,
+                "y_ratio": y_ratio,
+                "x_px": x_ratio * stage["width"],
+                "y_px": y_ratio * stage["height"],
+            }
+        ],
+    }
+
+
+def start_session(target: str, image_data_url: str, timeout: float) -> AppTest:
+    app = AppTest.from_function(TARGETS[target], default_timeout=timeout)
+    app.session_state["default_image_data_url"] = image_data_url
+    app.run()
+    return app
+
+
+def drive_session(
+    app: AppTest,
+    session: int,
+    reruns: int,
+    latencies: List[float],
+    errors: List[str],
+    lock: threading.Lock,
+    seed: int,
+) -> None:
+    rng = random.Random(seed + session)
+    for seq in range(1, reruns + 1):
+        app.session_state[COMPONENT_VALUE_KEY] = drag_value(app, session, seq, rng)
+        started = time.perf_counter()
+        app.run()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if app.exception:
+                errors.append(str(app.exception[0].value))
+
+
+def run_load_test(
+    target: str,
+    sessions: int,
+    reruns: int,
+    image_path: Path = SAMPLE_IMAGE,
+    workers: Optional[int] = None,
+    timeout: float = DEFAULT_TIMEOUT,
+    seed: int = 0,
+) -> LoadTestReport:
+    import CEF03
+
+    mime = mimetypes.guess_type(image_path.name)[0] or "image/png"
+    image_data_url = CEF03.to_data_url(image_path.read_bytes(), mime)
+    rss_before = current_rss_mb()
+    apps = [start_session(target, image_data_url, timeout) for _ in range(sessions)]
+
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or sessions) as pool:
+        futures = [
+            pool.submit(drive_session, app, index, reruns, latencies, errors, lock, seed)
+            for index, app in enumerate(apps)
+        ]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+    rss_after = current_rss_mb()
+
+    samples = np.array(latencies) * 1000.0 if latencies else np.array([np.nan])
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return LoadTestReport(
+        target=target,
+        sessions=sessions,
+        reruns=len(latencies),
+        errors=len(errors),
+        p50_ms=float(p50),
+        p90_ms=float(p90),
+        p99_ms=float(p99),
+        max_ms=float(samples.max()),
+        throughput_rps=len(latencies) / wall if wall > 0 else float("nan"),
+        rss_before_mb=rss_before,
+        rss_after_mb=rss_after,
+        rss_per_session_mb=(rss_after - rss_before) / max(sessions, 1),
+    )
+
+
+def format_report(report: LoadTestReport) -> str:
+    return (
+        f"[{report.target}] sessions={report.sessions} reruns={report.reruns} errors={report.errors}\n"
+        f"  latency ms  p50={report.p50_ms:.1f}  p90={report.p90_ms:.1f}  "
+        f"p99={report.p99_ms:.1f}  max={report.max_ms:.1f}\n"
+        f"  throughput  {report.throughput_rps:.1f} reruns/s\n"
+        f"  RSS MB      before={report.rss_before_mb:.1f}  after={report.rss_after_mb:.1f}  "
+        f"per session={report.rss_per_session_mb:.2f}"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="AppTest ベースの同時セッション負荷試験")
+    parser.add_argument("--sessions", type=int, default=8, help="同時セッション数")
+    parser.add_argument("--reruns", type=int, default=20, help="セッションあたりの再実行回数")
+    parser.add_argument("--target", choices=["main", "slim", "both"], default="both")
+    parser.add_argument("--image", type=Path, default=SAMPLE_IMAGE)
+    parser.add_argument("--workers", type=int, default=None, help="スレッド数 (既定はセッション数)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="1 回の再実行のタイムアウト (秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # AppTest をスレッドから回すと ScriptRunContext の警告が大量に出るので抑える。
+    # streamlit のロガーは子ごとにレベルを持ち、設定の読み込み時に logger.level で上書きされるので、
+    # 親ロガーではなく設定値として指定し、作成済みのロガーにも反映する
+    config.set_option("logger.level", "error")
+    set_log_level(logging.ERROR)
+    targets = ["main", "slim"] if args.target == "both" else [args.target]
+    reports = [
+        run_load_test(target, args.sessions, args.reruns, args.image, args.workers, args.timeout, args.seed)
+        for target in targets
+    ]
+    if args.json:
+        print(json.dumps([asdict(report) for report in reports], indent=2))
+    else:
+        print("\n".join(format_report(report) for report in reports))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""セッションごとのメモリ計上と上限。
+
+各セッションは再実行の終わりに自分のセッション状態を種類別 (画像・キャッシュ・履歴など) に
+計り、プロセス共通のレジストリへ報告する。セッション上限を超えたら再計算できるキャッシュを
+大きい順に捨て、それでも超えるなら画像を内容キーのファイルへ退避する (次の操作で読み戻す)。
+プロセス全体の上限を超えたら、しばらく操作のない他セッションの画像を大きい順に退避する。
+さらに一定時間操作のないセッションは、背景スレッドが画像とランドマーク状態をまとめて退避する。
+レジストリは各セッションの状態を参照で持つので、閉じたセッションは報告のたびと背景スレッドの
+周回ごとに外す (退避を無効にしていても状態が残り続けないように)。
+退避はレジストリのロックの中で行い、再実行の開始 (begin) もそのロックを取るので、
+実行中のセッションを退避したり、退避の途中で再実行が状態を読んだりすることはない。
+
+上限は環境変数で変えられる (MB, 0 で無効)。
+    CEPH_SESSION_MEMORY_MB  (既定 64)
+    CEPH_PROCESS_MEMORY_MB  (既定 1024)
+    CEPH_IDLE_SPILL_SECONDS (既定 900, 秒)
+退避先は ``CEPH_SPILL_DIR`` (既定 ``.ceph_spill``)。
+"""
+
+import logging
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+SESSION_BUDGET_ENV = "CEPH_SESSION_MEMORY_MB"
+PROCESS_BUDGET_ENV = "CEPH_PROCESS_MEMORY_MB"
+SPILL_DIR_ENV = "CEPH_SPILL_DIR"
+IDLE_SPILL_ENV = "CEPH_IDLE_SPILL_SECONDS"
+DEFAULT_SESSION_BUDGET_MB = 64
+DEFAULT_PROCESS_BUDGET_MB = 1024
+DEFAULT_IDLE_SPILL_SECONDS = 900
+REAPER_INTERVAL = 30.0
+SPILL_RETENTION = 7 * 24 * 3600  # 秒。これより長く読まれていない退避ファイルは消す
+DEFAULT_SPILL_DIR = ".ceph_spill"
+IDLE_GRACE = 5.0  # 秒。これより最近に報告したセッションは実行中とみなして触らない
+MB = 2**20
+
+logger = logging.getLogger(__name__)
+
+
+def budget_bytes(env: str, default_mb: float) -> int:
+    try:
+        return int(float(os.environ.get(env, default_mb)) * MB)
+    except ValueError:
+        return int(default_mb * MB)
+
+
+def current_rss_mb() -> float:
+    """現在の RSS (MB)。/proc が無い環境ではピーク RSS で代用する。"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / MB
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """オブジェクトが参照先も含めて保持しているバイト数の概算。同じオブジェクトは 1 回だけ数える。"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None), array)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        # ビューは元の配列の持ち主だけが数える
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else deep_sizeof(obj.base, seen))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        for slot in obj.__slots__:
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+@dataclass(frozen=True)
+class SessionUsage:
+    session_id: str
+    total: int
+    by_kind: Dict[str, int]
+    items: Tuple[Tuple[str, str, int], ...]  # (キー, 種類, バイト数) の大きい順
+    updated: float
+    evicted: Tuple[str, ...] = ()
+
+    def kind_bytes(self, kind: str) -> int:
+        return self.by_kind.get(kind, 0)
+
+
+def measure_items(
+    session_id: str,
+    items: Iterable[Tuple[str, Any]],
+    classify: Callable[[str], str],
+    extra: Optional[Dict[str, int]] = None,
+    evicted: Tuple[str, ...] = (),
+) -> SessionUsage:
+    """(キー, 値) の列を種類別に計る。extra はセッション状態の外にあるもの (種類: バイト数)。"""
+    seen: set = set()
+    measured = []
+    for key, value in items:
+        measured.append((key, classify(key), deep_sizeof(value, seen)))
+    for kind, size in (extra or {}).items():
+        measured.append((f"<{kind}>", kind, int(size)))
+    measured.sort(key=lambda item: item[2], reverse=True)
+    by_kind: Dict[str, int] = {}
+    for _, kind, size in measured:
+        by_kind[kind] = by_kind.get(kind, 0) + size
+    return SessionUsage(session_id, sum(by_kind.values()), by_kind, tuple(measured), time.time(), evicted)
+
+
+@dataclass
+class _Entry:
+    usage: Optional[SessionUsage]
+    state: Any
+    busy: bool = False
+    seen: float = field(default_factory=time.time)
+
+
+class MemoryRegistry:
+    """全セッションの最新の計上結果。state は他セッションの状態を退避するときに使う。"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _Entry] = {}
+        self.spilled_sessions = 0
+
+    def begin(self, session_id: str) -> None:
+        """再実行の開始。退避中ならそれが終わるまで待つ。"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.busy = True
+                entry.seen = time.time()
+
+    def report(self, usage: SessionUsage, state: Any, is_active: Optional[Callable[[str], bool]] = None) -> None:
+        """計上結果を登録する。is_active があれば、閉じたセッションをついでに外す。"""
+        with self._lock:
+            if is_active is not None:
+                self._drop_inactive(is_active)
+            self._sessions[usage.session_id] = _Entry(usage, state)
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def prune(self, is_active: Callable[[str], bool]) -> None:
+        with self._lock:
+            self._drop_inactive(is_active)
+
+    def _drop_inactive(self, is_active: Callable[[str], bool]) -> None:
+        for session_id in [sid for sid in self._sessions if not is_active(sid)]:
+            del self._sessions[session_id]
+
+    def usages(self) -> List[SessionUsage]:
+        with self._lock:
+            usages = [entry.usage for entry in self._sessions.values() if entry.usage is not None]
+        return sorted(usages, key=lambda u: u.total, reverse=True)
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(entry.usage.total for entry in self._sessions.values() if entry.usage is not None)
+
+    def spill_sessions(
+        self,
+        spill: Callable[[str, Any], int],
+        idle_for: float,
+        exclude: Optional[str] = None,
+        order_kind: Optional[str] = None,
+        limit_bytes: Optional[int] = None,
+    ) -> int:
+        """idle_for 秒以上操作のないセッションを spill(session_id, state) で退避し、解放したバイト数を返す。
+
+        order_kind があればその種類の大きい順、limit_bytes があればその分を解放したところで止める。
+        退避したセッションはレジストリから外す (次の再実行で計上し直される)。
+        """
+        now = time.time()
+        freed = 0
+        with self._lock:
+            candidates = [
+                (sid, entry)
+                for sid, entry in self._sessions.items()
+                if sid != exclude and not entry.busy and now - entry.seen > idle_for and entry.usage is not None
+            ]
+            if order_kind is not None:
+                candidates = [item for item in candidates if item[1].usage.kind_bytes(order_kind) > 0]
+                candidates.sort(key=lambda item: item[1].usage.kind_bytes(order_kind), reverse=True)
+            for sid, entry in candidates:
+                if limit_bytes is not None and freed >= limit_bytes:
+                    break
+                freed += spill(sid, entry.state)
+                del self._sessions[sid]
+                self.spilled_sessions += 1
+        return freed
+
+
+class SpillStore:
+    """内容キーで名前を付けたファイル。同じ内容は 1 回だけ書く。"""
+
+    def __init__(self, root: Optional[Path] = None) -> None:
+        self.root = Path(root or os.environ.get(SPILL_DIR_ENV) or DEFAULT_SPILL_DIR)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.root / f"{key}.bin"
+
+    def write(self, key: str, data: bytes) -> Path:
+        path = self.path(key)
+        if not path.exists():
+            with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as handle:
+                handle.write(data)
+            os.replace(handle.name, path)
+        return path
+
+    def read(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def prune(self, older_than: float) -> int:
+        """older_than 秒以上使われていないファイルを消し、消した数を返す。"""
+        limit = time.time() - older_than
+        removed = 0
+        for path in self.root.iterdir():
+            try:
+                if path.stat().st_mtime < limit:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def state_path(self, session_id: str) -> Path:
+        return self.root / f"session-{session_id}.pkl"
+
+    def write_state(self, session_id: str, state: Dict[str, Any]) -> int:
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as handle:
+            handle.write(data)
+        os.replace(handle.name, self.state_path(session_id))
+        return len(data)
+
+    def pop_state(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """退避した状態を読み、ファイルは消す。"""
+        path = self.state_path(session_id)
+        try:
+            state = pickle.loads(path.read_bytes())
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        path.unlink(missing_ok=True)
+        return state
+
+    def usage(self) -> Tuple[int, int]:
+        """(ファイル数, 合計バイト数)。"""
+        files = [path for path in self.root.iterdir() if path.suffix in (".bin", ".pkl")]
+        return len(files), sum(path.stat().st_size for path in files)
+
+
+class IdleReaper:
+    """一定時間操作のないセッションを定期的に退避する背景スレッド。"""
+
+    def __init__(
+        self,
+        registry: "MemoryRegistry",
+        store: SpillStore,
+        spill: Callable[[str, Any], int],
+        timeout: float,
+        is_active: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        self.registry = registry
+        self.store = store
+        self.spill = spill
+        self.timeout = timeout
+        self.is_active = is_active
+        self.thread = threading.Thread(target=self._run, name="ceph-idle-reaper", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(min(REAPER_INTERVAL, self.timeout))
+            try:
+                if self.is_active is not None:
+                    self.registry.prune(self.is_active)
+                self.registry.spill_sessions(self.spill, self.timeout)
+                self.store.prune(SPILL_RETENTION)
+            except Exception:
+                logger.exception("idle spill failed")
+
+
+MEMORY_REGISTRY = MemoryRegistry()
+_spill_store: Optional[SpillStore] = None
+_spill_lock = threading.Lock()
+_reaper: Optional[IdleReaper] = None
+
+
+def start_idle_reaper(
+    spill: Callable[[str, Any], int], is_active: Optional[Callable[[str], bool]] = None
+) -> Optional[IdleReaper]:
+    """``CEPH_IDLE_SPILL_SECONDS`` が 0 でなければ退避スレッドを (1 回だけ) 起動する。"""
+    global _reaper
+    store = default_spill_store()
+    with _spill_lock:
+        if _reaper is None:
+            try:
+                timeout = float(os.environ.get(IDLE_SPILL_ENV, DEFAULT_IDLE_SPILL_SECONDS))
+            except ValueError:
+                timeout = DEFAULT_IDLE_SPILL_SECONDS
+            if timeout > 0:
+                _reaper = IdleReaper(MEMORY_REGISTRY, store, spill, timeout, is_active)
+        return _reaper
+
+
+def default_spill_store() -> SpillStore:
+    global _spill_store
+    with _spill_lock:
+        if _spill_store is None:
+            _spill_store = SpillStore()
+        return _spill_store
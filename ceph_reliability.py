@@ -0,0 +1,287 @@
+"""複数評価者のトレースから評価者間信頼性を求める。
+
+症例 C × 評価者 k × ランドマーク L の配列をまとめて計測し、次を一度に出す。
+  - ランドマークごとの評価者間の平均放射誤差 (MRE, 全評価者ペアをプール)
+  - 計測項目ごとの ICC(1,1) (一元配置) と ICC(2,1) (二元配置ランダム, 絶対一致)
+  - 評価者ペアごとの Bland–Altman (バイアスと 95% 一致限界)
+どれも症例ごとに足し引きできる十分統計量 (和・平方和) から計算するので、
+トレースが追加・修正されたら変更前の寄与を引いて変更後を足すだけで更新できる。
+評価者は症例ごとに名前順で並べ、先頭 k 人を使う (k = 2, 3 を別々に集計)。
+
+    python ceph_reliability.py --rebuild
+"""
+
+import argparse
+import json
+import math
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ceph_cases import CaseArchive, Tracing, default_archive
+from ceph_uncertainty import DEFAULT_PX_PER_MM
+
+RATER_COUNTS = (2, 3)
+CHUNK_CASES = 4096
+LOA_Z = 1.96
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reliability (
+    raters INTEGER PRIMARY KEY,
+    state TEXT NOT NULL
+);
+"""
+
+Measure = Callable[[np.ndarray], Dict[str, np.ndarray]]
+
+
+def rater_pairs(k: int) -> Tuple[np.ndarray, np.ndarray]:
+    return np.triu_indices(k, 1)
+
+
+def tracing_arrays(
+    groups: Sequence[Sequence[Tracing]], point_ids: Sequence[str], k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """評価者別トレースの列を (C, k, L, 2) の座標と (C,) の mm/px にする。欠けた点は NaN。"""
+    index = {pid: i for i, pid in enumerate(point_ids)}
+    points = np.full((len(groups), k, len(point_ids), 2), np.nan)
+    mm_per_px = np.full(len(groups), 1.0 / DEFAULT_PX_PER_MM)
+    for c, tracings in enumerate(groups):
+        scales = [t.mm_per_px for t in tracings[:k] if t.mm_per_px]
+        if scales:
+            mm_per_px[c] = float(np.mean(scales))
+        for r, tracing in enumerate(tracings[:k]):
+            for pid, xy in tracing.points.items():
+                if pid in index:
+                    points[c, r, index[pid]] = xy
+    return points, mm_per_px
+
+
+class ReliabilityStats:
+    """評価者 k 人での十分統計量。``+=`` / ``-=`` で症例の寄与を足し引きする。"""
+
+    FIELDS = ("icc_n", "icc_s", "icc_ss", "icc_r2", "icc_c", "ba_n", "ba_s", "ba_ss", "mre_n", "mre_s", "mre_ss")
+
+    def __init__(self, measures: Sequence[str], point_ids: Sequence[str], k: int) -> None:
+        self.measures = tuple(measures)
+        self.point_ids = tuple(point_ids)
+        self.k = k
+        m, p, l = len(self.measures), len(rater_pairs(k)[0]), len(self.point_ids)
+        self.cases = 0
+        self.icc_n = np.zeros(m)
+        self.icc_s = np.zeros(m)
+        self.icc_ss = np.zeros(m)
+        self.icc_r2 = np.zeros(m)
+        self.icc_c = np.zeros((m, k))
+        self.ba_n = np.zeros((m, p))
+        self.ba_s = np.zeros((m, p))
+        self.ba_ss = np.zeros((m, p))
+        self.mre_n = np.zeros(l)
+        self.mre_s = np.zeros(l)
+        self.mre_ss = np.zeros(l)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        points: np.ndarray,
+        mm_per_px: np.ndarray,
+        measures: Sequence[str],
+        point_ids: Sequence[str],
+        measure: Measure,
+    ) -> "ReliabilityStats":
+        """points (C, k, L, 2) の全症例をまとめて集計する。"""
+        count, k = points.shape[:2]
+        stats = cls(measures, point_ids, k)
+        stats.cases = count
+        if count == 0:
+            return stats
+        ia, ib = rater_pairs(k)
+        values = measure(points)
+        y = np.stack([np.broadcast_to(values[name], (count, k)) for name in stats.measures])  # (M, C, k)
+        valid = np.isfinite(y).all(axis=-1)
+        yv = np.where(valid[..., None], y, 0.0)
+        stats.icc_n = valid.sum(axis=1).astype(float)
+        stats.icc_s = yv.sum(axis=(1, 2))
+        stats.icc_ss = (yv * yv).sum(axis=(1, 2))
+        stats.icc_r2 = (yv.sum(axis=2) ** 2).sum(axis=1)
+        stats.icc_c = yv.sum(axis=1)
+
+        diff = y[..., ib] - y[..., ia]  # (M, C, P)
+        diff_valid = np.isfinite(diff)
+        dv = np.where(diff_valid, diff, 0.0)
+        stats.ba_n = diff_valid.sum(axis=1).astype(float)
+        stats.ba_s = dv.sum(axis=1)
+        stats.ba_ss = (dv * dv).sum(axis=1)
+
+        delta = points[:, ib] - points[:, ia]  # (C, P, L, 2)
+        radial = np.hypot(delta[..., 0], delta[..., 1]) * mm_per_px[:, None, None]
+        radial_valid = np.isfinite(radial)
+        rv = np.where(radial_valid, radial, 0.0)
+        stats.mre_n = radial_valid.sum(axis=(0, 1)).astype(float)
+        stats.mre_s = rv.sum(axis=(0, 1))
+        stats.mre_ss = (rv * rv).sum(axis=(0, 1))
+        return stats
+
+    def __iadd__(self, other: "ReliabilityStats") -> "ReliabilityStats":
+        self.cases += other.cases
+        for name in self.FIELDS:
+            getattr(self, name)[...] += getattr(other, name)
+        return self
+
+    def __isub__(self, other: "ReliabilityStats") -> "ReliabilityStats":
+        self.cases -= other.cases
+        for name in self.FIELDS:
+            getattr(self, name)[...] -= getattr(other, name)
+        return self
+
+    def to_json(self) -> str:
+        data = {name: getattr(self, name).tolist() for name in self.FIELDS}
+        data.update(cases=self.cases, measures=self.measures, point_ids=self.point_ids, k=self.k)
+        return json.dumps(data)
+
+    @classmethod
+    def from_json(cls, text: str) -> "ReliabilityStats":
+        data = json.loads(text)
+        stats = cls(data["measures"], data["point_ids"], int(data["k"]))
+        stats.cases = int(data["cases"])
+        for name in cls.FIELDS:
+            setattr(stats, name, np.asarray(data[name], dtype=float).reshape(getattr(stats, name).shape))
+        return stats
+
+    def icc(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(ICC(1,1), ICC(2,1))。症例が 2 未満の項目は NaN。"""
+        k = self.k
+        n = self.icc_n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correction = self.icc_s**2 / (n * k)
+            sst = self.icc_ss - correction
+            ssr = self.icc_r2 / k - correction
+            ssc = (self.icc_c**2).sum(axis=1) / n - correction
+            sse = sst - ssr - ssc
+            msr = ssr / (n - 1)
+            msc = ssc / (k - 1)
+            mse = sse / ((n - 1) * (k - 1))
+            msw = (sst - ssr) / (n * (k - 1))
+            icc1 = (msr - msw) / (msr + (k - 1) * msw)
+            icc2 = (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n)
+        enough = n >= 2
+        return np.where(enough, icc1, np.nan), np.where(enough, icc2, np.nan)
+
+    def bland_altman(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(バイアス, SD)。形は (M, P)。"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bias = self.ba_s / self.ba_n
+            sd = np.sqrt(np.maximum(self.ba_ss - self.ba_s * bias, 0.0) / (self.ba_n - 1))
+        return np.where(self.ba_n >= 1, bias, np.nan), np.where(self.ba_n >= 2, sd, np.nan)
+
+    def radial_error(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ランドマークごとの (MRE, SD) (mm)。"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mre = self.mre_s / self.mre_n
+            sd = np.sqrt(np.maximum(self.mre_ss - self.mre_s * mre, 0.0) / (self.mre_n - 1))
+        return np.where(self.mre_n >= 1, mre, np.nan), np.where(self.mre_n >= 2, sd, np.nan)
+
+
+class ReliabilityStore:
+    """評価者数 k ごとの十分統計量を SQLite に持ち、トレースの保存時に差分更新する。"""
+
+    def __init__(self, archive: CaseArchive, point_ids: Sequence[str], measures: Sequence[str], measure: Measure) -> None:
+        self.archive = archive
+        self.point_ids = tuple(point_ids)
+        self.measures = tuple(measures)
+        self.measure = measure
+        archive.add_schema(SCHEMA)
+
+    def _empty(self, k: int) -> ReliabilityStats:
+        return ReliabilityStats(self.measures, self.point_ids, k)
+
+    def _contribution(self, tracings: Sequence[Tracing], k: int) -> ReliabilityStats:
+        points, mm_per_px = tracing_arrays([tracings], self.point_ids, k)
+        return ReliabilityStats.from_arrays(points, mm_per_px, self.measures, self.point_ids, self.measure)
+
+    def _read(self, conn: sqlite3.Connection, k: int) -> ReliabilityStats:
+        row = conn.execute("SELECT state FROM reliability WHERE raters = ?", (k,)).fetchone()
+        if row is None:
+            return self._empty(k)
+        stats = ReliabilityStats.from_json(row[0])
+        if stats.measures != self.measures or stats.point_ids != self.point_ids:
+            return self._empty(k)
+        return stats
+
+    def _write(self, conn: sqlite3.Connection, stats: ReliabilityStats) -> None:
+        conn.execute("INSERT OR REPLACE INTO reliability (raters, state) VALUES (?, ?)", (stats.k, stats.to_json()))
+
+    def fold(self, conn: sqlite3.Connection, case_id: str, before: List[Tracing], after: List[Tracing]) -> None:
+        """``CaseArchive.save`` の on_tracing。変更前の寄与を引いて変更後を足す。"""
+        for k in RATER_COUNTS:
+            if len(before) < k and len(after) < k:
+                continue
+            stats = self._read(conn, k)
+            if len(before) >= k:
+                stats -= self._contribution(before, k)
+            if len(after) >= k:
+                stats += self._contribution(after, k)
+            self._write(conn, stats)
+
+    def stats(self, k: int) -> ReliabilityStats:
+        with self.archive.connect() as conn:
+            return self._read(conn, k)
+
+    def rebuild(self) -> Dict[int, int]:
+        """アーカイブ全体から作り直す。症例をチャンクごとに配列化してまとめて計算する。"""
+        counts: Dict[int, int] = {}
+        for k in RATER_COUNTS:
+            total = self._empty(k)
+            groups: List[List[Tracing]] = []
+            for _, tracings in self.archive.iter_multi_rater(k):
+                groups.append(tracings)
+                if len(groups) >= CHUNK_CASES:
+                    total += self._batch(groups, k)
+                    groups = []
+            if groups:
+                total += self._batch(groups, k)
+            with self.archive.transaction() as conn:
+                self._write(conn, total)
+            counts[k] = total.cases
+        return counts
+
+    def _batch(self, groups: Sequence[Sequence[Tracing]], k: int) -> ReliabilityStats:
+        points, mm_per_px = tracing_arrays(groups, self.point_ids, k)
+        return ReliabilityStats.from_arrays(points, mm_per_px, self.measures, self.point_ids, self.measure)
+
+
+_default_store: Optional[ReliabilityStore] = None
+_default_lock = threading.Lock()
+
+
+def default_reliability_store(point_ids: Sequence[str], measures: Sequence[str], measure: Measure) -> ReliabilityStore:
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = ReliabilityStore(default_archive(), point_ids, measures, measure)
+        return _default_store
+
+
+def main() -> None:
+    from CEF03 import POINT_IDS, RESULT_ORDER, compute_angles_batch
+
+    parser = argparse.ArgumentParser(description="評価者間信頼性の集計")
+    parser.add_argument("--rebuild", action="store_true", help="アーカイブ全体から作り直す")
+    args = parser.parse_args()
+    store = default_reliability_store(POINT_IDS, RESULT_ORDER, compute_angles_batch)
+    if args.rebuild:
+        print(", ".join(f"k={k}: {count} cases" for k, count in store.rebuild().items()))
+    for k in RATER_COUNTS:
+        stats = store.stats(k)
+        icc1, icc2 = stats.icc()
+        print(f"--- {k} raters, {stats.cases} cases")
+        for name, a, b in zip(stats.measures, icc1, icc2):
+            print(f"{name:>14}  ICC(1,1)={a:.3f}  ICC(2,1)={b:.3f}")
+        mre, _ = stats.radial_error()
+        print("  MRE mm: " + "  ".join(f"{pid}={value:.2f}" for pid, value in zip(stats.point_ids, mre) if math.isfinite(value)))
+
+
+if __name__ == "__main__":
+    main()
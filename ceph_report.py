@@ -0,0 +1,372 @@
+"""症例のトレース図とレポートの描画 (サーバー側, Pillow)。
+
+ランドマークと計測平面は原画像の座標にそのまま描き (線幅・文字は画像の大きさに合わせる)、
+計測表と標準偏差ポリゴンを横に並べた 1 枚の PNG / PDF にする。
+出力のファイル名は画像キー・ランドマーク・計測値・症例情報・レイアウトのハッシュなので、
+同じ状態の 2 回目以降はファイルを返すだけで済む (``<CEPH_ARCHIVE_DIR>/reports``)。
+
+一括モードはアーカイブの症例をプロセスプールで描く。各ワーカーは 1 症例ずつ画像ファイルを読み、
+描いて書き出し、結果は症例 ID だけを返す。投入中の件数は workers の数倍までに抑え、
+ワーカーも一定件数ごとに入れ替えるので、症例数によらずメモリはワーカー数 × 画像 1 枚分で済む。
+計測表とポリゴンの値は保存時の計測値ではなく、measure でランドマーク (原画像 px) から計算し直す。
+既定のフォントはラテン文字だけ (σ も無い) なので、レポートの文字は英数字にしている。
+
+    python ceph_report.py --workers 4 --format pdf   # アーカイブ全体 (描画済みは飛ばす)
+    python ceph_report.py --case C001 --case C002
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass, field, replace
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from PIL import Image, ImageDraw, ImageFont
+
+from ceph_cases import ARCHIVE_ENV, DEFAULT_ARCHIVE_DIR, CaseArchive, CaseRecord, default_archive
+from ceph_thumbnails import CaseImageStore, default_image_store
+from ceph_tiles import content_key, normalize_for_display
+
+REPORT_DIR = "reports"
+REPORT_FORMATS = {"png": "image/png", "pdf": "application/pdf"}
+RENDER_VERSION = 1  # 描画を変えたら上げる (キャッシュを無効にする)
+REPORT_HEIGHT = 1600  # レポートの高さ (px)。トレース図はこの高さに合わせて縮小・拡大する
+REPORT_DPI = 150
+PNG_COMPRESS_LEVEL = 3  # 6 以上は 2 倍近く遅く、縮むのは 1 割ほど
+PANEL_RATIO = 0.75  # 計測表とポリゴンの欄の幅 (高さに対する比)
+TRACING_REFERENCE_SIZE = 1000.0  # 線幅・点の大きさはこの長辺を基準に画像に合わせる
+MARKER_RADIUS = 6.0
+LABEL_SIZE = 16.0
+IN_FLIGHT_PER_WORKER = 2
+WORKER_TASKS = 200  # ワーカーをこの件数ごとに作り直す (断片化したメモリを返す)
+SIGMA_RANGE = 3.2
+SIGMA_COLORS = ((2.0, "#dc2626"), (1.0, "#d97706"))  # |σ| がこれを超えたら色を付ける
+TEXT_COLOR = "#0f172a"
+
+Source = Union[Path, bytes]
+Measure = Callable[[CaseRecord], Dict[str, float]]
+
+
+@dataclass(frozen=True)
+class ReportLayout:
+    """描く内容の定義。プロセス間で渡せるよう値だけで持つ。"""
+
+    points: Tuple[Tuple[str, str], ...]  # (ランドマーク, 色)
+    planes: Tuple[Tuple[str, str, str, float], ...]  # (始点, 終点, 色, 線幅)
+    measures: Tuple[str, ...]  # 計測表の行
+    reference: Tuple[Tuple[str, float, float], ...]  # (計測項目, 平均, SD)
+    polygon: Tuple[Tuple[str, float, float, float], ...]  # ポリゴンの行 (計測項目, 平均, SD, sd_ratio)
+    polygon_scale: float
+
+    def key(self) -> str:
+        return content_key(json.dumps(asdict(self)).encode("utf-8"))
+
+
+@dataclass
+class BulkResult:
+    rendered: int = 0
+    cached: int = 0
+    failed: List[Tuple[str, str]] = field(default_factory=list)  # (症例 ID, 理由)
+
+
+def report_key(record: CaseRecord, layout: ReportLayout, fmt: str) -> str:
+    """ランドマーク状態のハッシュ。描画に効く値だけを入れる (保存日時などは入れない)。"""
+    state = {
+        "version": RENDER_VERSION,
+        "format": fmt,
+        "layout": layout.key(),
+        "image": record.image_key,
+        "points": {pid: [round(float(x), 2), round(float(y), 2)] for pid, (x, y) in sorted(record.points.items())},
+        "measurements": {
+            name: round(value, 4) if value is not None and math.isfinite(value) else None
+            for name, value in sorted(record.measurements.items())
+        },
+        "case": [record.case_id, record.age, record.sex, record.mm_per_px],
+    }
+    return content_key(json.dumps(state, sort_keys=True).encode("utf-8"))
+
+
+@lru_cache(maxsize=32)
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.load_default(size=max(8, size))
+
+
+def _sigma_color(sigma: Optional[float]) -> str:
+    if sigma is None:
+        return TEXT_COLOR
+    return next((color for limit, color in SIGMA_COLORS if abs(sigma) > limit), TEXT_COLOR)
+
+
+def _sigma(value: Optional[float], mean: float, sd: float) -> Optional[float]:
+    if value is None or not math.isfinite(value) or not sd:
+        return None
+    return (value - mean) / sd
+
+
+def draw_tracing(image: Image.Image, points: Dict[str, Tuple[float, float]], layout: ReportLayout) -> Image.Image:
+    """原画像の座標に計測平面とランドマークを描いた RGB 画像。"""
+    image = normalize_for_display(image).convert("RGB")
+    scale = max(image.size) / TRACING_REFERENCE_SIZE
+    outline = max(1, round(scale))
+    draw = ImageDraw.Draw(image)
+    for start, end, color, width in layout.planes:
+        if start in points and end in points:
+            draw.line([tuple(points[start]), tuple(points[end])], fill=color, width=max(1, round(width * scale)))
+    radius = MARKER_RADIUS * scale
+    font = _font(round(LABEL_SIZE * scale))
+    for pid, color in layout.points:
+        if pid not in points:
+            continue
+        x, y = points[pid]
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=color, outline=TEXT_COLOR, width=outline)
+        draw.text(
+            (x + radius * 1.4, y - radius * 1.4), pid, fill="white", font=font, stroke_width=outline, stroke_fill=TEXT_COLOR
+        )
+    return image
+
+
+def draw_table(measurements: Dict[str, float], layout: ReportLayout, size: Tuple[int, int]) -> Image.Image:
+    """計測値・標準値・偏差 (σ) の表。|σ| が 1 / 2 を超える行は色を変える。"""
+    width, height = size
+    panel = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(panel)
+    reference = {name: (mean, sd) for name, mean, sd in layout.reference}
+    row_height = height / (len(layout.measures) + 1)
+    font = _font(round(row_height * 0.5))
+    columns = (0.03, 0.45, 0.64, 0.86)
+    for col, text in zip(columns, ("Measure", "Value", "Mean ± SD", "Dev (SD)")):
+        draw.text((width * col, row_height * 0.25), text, fill="#475569", font=font)
+    draw.line([(0, row_height - 1), (width, row_height - 1)], fill="#94a3b8", width=2)
+    for idx, name in enumerate(layout.measures, start=1):
+        top = row_height * idx
+        if idx % 2 == 0:
+            draw.rectangle([0, top, width, top + row_height], fill="#f1f5f9")
+        value = measurements.get(name)
+        mean, sd = reference.get(name, (0.0, 0.0))
+        sigma = _sigma(value, mean, sd)
+        cells = (
+            name,
+            f"{value:.2f}" if value is not None and math.isfinite(value) else "-",
+            f"{mean:.1f} ± {sd:.1f}" if sd else "-",
+            f"{sigma:+.2f}" if sigma is not None else "-",
+        )
+        color = _sigma_color(sigma)
+        for col, text in zip(columns, cells):
+            draw.text((width * col, top + row_height * 0.25), text, fill=color, font=font)
+    return panel
+
+
+def draw_polygon(measurements: Dict[str, float], layout: ReportLayout, size: Tuple[int, int]) -> Image.Image:
+    """標準偏差ポリゴン (画面の図と同じ横軸: σ × sd_ratio × polygon_scale)。"""
+    width, height = size
+    panel = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(panel, "RGBA")
+    rows = layout.polygon
+    font = _font(round(height / (len(rows) + 2) * 0.45))
+    left, right = width * 0.3, width * 0.95
+    top, bottom = height * 0.06, height * 0.92
+    step = (bottom - top) / len(rows)
+
+    def x_at(value: float) -> float:
+        return left + (value + SIGMA_RANGE) / (2 * SIGMA_RANGE) * (right - left)
+
+    def y_at(idx: int) -> float:
+        return top + step * (idx + 0.5)
+
+    draw.rectangle([left, top, right, bottom], fill=(163, 163, 163, 64))
+    for band, alpha in ((3, 20), (2, 36), (1, 56)):
+        draw.rectangle([x_at(-band), top, x_at(band), bottom], fill=(148, 163, 184, alpha))
+    draw.line([(x_at(0), top), (x_at(0), bottom)], fill="#475569", width=2)
+    for tick in range(-3, 4):
+        draw.text((x_at(tick), bottom + step * 0.2), f"{tick:d}", fill="#475569", font=font, anchor="mt")
+    for label, x in (("-1 SD", x_at(-1)), ("+1 SD", x_at(1))):
+        draw.text((x, top - step * 0.1), label, fill="#1f2937", font=font, anchor="mb")
+
+    frame, patient, markers = [], [], []
+    for idx, (label, mean, sd, ratio) in enumerate(rows):
+        y = y_at(idx)
+        frame.append((x_at(ratio * layout.polygon_scale), y))
+        sigma = _sigma(measurements.get(label), mean, sd) if mean else None
+        offset = sigma * ratio * layout.polygon_scale if sigma is not None else 0.0
+        patient.append((x_at(max(-SIGMA_RANGE, min(SIGMA_RANGE, offset))), y))
+        if mean:
+            draw.text((left - step * 0.3, y), label, fill=TEXT_COLOR, font=font, anchor="rm")
+        if sigma is not None:
+            markers.append((patient[-1], sigma))
+    frame += [(2 * x_at(0) - x, y) for x, y in reversed(frame)]
+    draw.polygon(frame, fill=(30, 64, 175, 64), outline="#1e40af", width=2)
+    # 中心線から測定値までを塗り、測定値を線で結ぶ
+    draw.polygon(patient + [(x_at(0), y) for _, y in reversed(patient)], fill=(249, 115, 22, 46))
+    draw.line(patient, fill=(249, 115, 22, 166), width=3, joint="curve")
+    radius = step * 0.18
+    for (x, y), sigma in markers:
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill="#f97316", outline=TEXT_COLOR)
+        draw.text((x + radius * 1.6, y), f"{sigma:.2f}", fill=_sigma_color(sigma), font=font, anchor="lm")
+    return panel
+
+
+def compose_report(record: CaseRecord, image: Image.Image, layout: ReportLayout) -> Image.Image:
+    """見出し・トレース図・計測表・ポリゴンを 1 枚にまとめる。"""
+    tracing = draw_tracing(image, record.points, layout)
+    tracing_width = max(1, round(tracing.width * REPORT_HEIGHT / tracing.height))
+    tracing = tracing.resize((tracing_width, REPORT_HEIGHT), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    header = REPORT_HEIGHT // 20
+    panel_width = round(REPORT_HEIGHT * PANEL_RATIO)
+    table_height = round(REPORT_HEIGHT * 0.4)
+    page = Image.new("RGB", (tracing_width + panel_width, REPORT_HEIGHT + header), "white")
+    page.paste(tracing, (0, header))
+    page.paste(draw_table(record.measurements, layout, (panel_width, table_height)), (tracing_width, header))
+    page.paste(
+        draw_polygon(record.measurements, layout, (panel_width, REPORT_HEIGHT - table_height)),
+        (tracing_width, header + table_height),
+    )
+    details = [
+        f"Case {record.case_id or '-'}",
+        f"Age {record.age:g}" if record.age is not None else "",
+        {"M": "Male", "F": "Female"}.get(record.sex, ""),
+        f"{record.mm_per_px:.4f} mm/px" if record.mm_per_px else "uncalibrated",
+    ]
+    title = "   ".join(item for item in details if item)
+    ImageDraw.Draw(page).text((header * 0.4, header / 2), title, fill=TEXT_COLOR, font=_font(round(header * 0.5)), anchor="lm")
+    return page
+
+
+def render_report_file(record: CaseRecord, source: Source, layout: ReportLayout, fmt: str, target: Path) -> Path:
+    """source (画像ファイルかバイト列) からレポートを作り、target に原子的に書く。"""
+    with Image.open(source if isinstance(source, Path) else io.BytesIO(source)) as image:
+        page = compose_report(record, image, layout)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=target.parent, suffix=f".{fmt}", delete=False) as handle:
+        if fmt == "pdf":
+            page.save(handle, format="PDF", resolution=REPORT_DPI)
+        else:
+            page.save(handle, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    os.replace(handle.name, target)
+    return target
+
+
+def _render_task(record: CaseRecord, source: Path, layout: ReportLayout, fmt: str, target: Path) -> Tuple[str, str]:
+    """ワーカーで 1 症例を描く。失敗しても一括処理は止めず、理由を返す。"""
+    try:
+        render_report_file(record, source, layout, fmt, target)
+    except Exception as exc:
+        return record.case_id, f"{type(exc).__name__}: {exc}"
+    return record.case_id, ""
+
+
+class ReportRenderer:
+    def __init__(self, layout: ReportLayout, root: Optional[Path] = None, measure: Optional[Measure] = None) -> None:
+        self.layout = layout
+        self.measure = measure
+        self.root = Path(root or os.environ.get(ARCHIVE_ENV) or DEFAULT_ARCHIVE_DIR) / REPORT_DIR
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def measured(self, record: CaseRecord) -> CaseRecord:
+        """描く計測値をランドマークから求め直した症例 (measure が無ければそのまま)。"""
+        if self.measure is None:
+            return record
+        return replace(record, measurements=self.measure(record))
+
+    def path(self, record: CaseRecord, fmt: str = "png") -> Path:
+        return self.root / f"{report_key(record, self.layout, fmt)}.{fmt}"
+
+    def render(self, record: CaseRecord, source: Source, fmt: str = "png") -> Path:
+        """1 症例のレポート。同じ状態のものが既にあれば描かずにそのパスを返す。"""
+        record = self.measured(record)
+        target = self.path(record, fmt)
+        if not target.exists():
+            render_report_file(record, source, self.layout, fmt, target)
+        return target
+
+    def render_archive(
+        self,
+        archive: CaseArchive,
+        images: CaseImageStore,
+        fmt: str = "png",
+        workers: int = 1,
+        case_ids: Optional[Sequence[str]] = None,
+    ) -> BulkResult:
+        """保存済み症例 (case_ids が無ければ全件) のレポートを描く。描画済みのものは数えるだけ。"""
+        result = BulkResult()
+        records: Iterable[Optional[CaseRecord]] = (
+            (archive.get(case_id) for case_id in case_ids) if case_ids else archive.iter_records()
+        )
+
+        def tasks() -> Iterable[Tuple[CaseRecord, Path, Path]]:
+            for record in records:
+                if record is None:
+                    continue
+                record = self.measured(record)
+                target = self.path(record, fmt)
+                if target.exists():
+                    result.cached += 1
+                    continue
+                source = images.image_path(record.image_key) if record.image_key else None
+                if source is None:
+                    result.failed.append((record.case_id, "画像が保存されていません"))
+                    continue
+                yield record, source, target
+
+        def collect(outcome: Tuple[str, str]) -> None:
+            case_id, error = outcome
+            if error:
+                result.failed.append((case_id, error))
+            else:
+                result.rendered += 1
+
+        if workers <= 1:
+            for record, source, target in tasks():
+                collect(_render_task(record, source, self.layout, fmt, target))
+            return result
+        with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=WORKER_TASKS) as pool:
+            pending: set = set()
+            for record, source, target in tasks():
+                pending.add(pool.submit(_render_task, record, source, self.layout, fmt, target))
+                if len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+            for future in pending:
+                collect(future.result())
+        return result
+
+
+_default_renderer: Optional[ReportRenderer] = None
+_default_lock = threading.Lock()
+
+
+def default_report_renderer(layout: ReportLayout, measure: Optional[Measure] = None) -> ReportRenderer:
+    global _default_renderer
+    with _default_lock:
+        if _default_renderer is None:
+            _default_renderer = ReportRenderer(layout, measure=measure)
+        return _default_renderer
+
+
+def main() -> None:
+    from CEF03 import REPORT_LAYOUT, measure_record
+
+    parser = argparse.ArgumentParser(description="保存済み症例のトレース図レポートを一括で描く")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--format", default="png", choices=list(REPORT_FORMATS))
+    parser.add_argument("--case", action="append", help="症例 ID (複数指定可, 省略時は全件)")
+    args = parser.parse_args()
+    renderer = default_report_renderer(REPORT_LAYOUT, measure_record)
+    started = time.perf_counter()
+    result = renderer.render_archive(default_archive(), default_image_store(), args.format, args.workers, args.case)
+    elapsed = time.perf_counter() - started
+    print(f"{result.rendered} rendered, {result.cached} cached, {len(result.failed)} failed in {elapsed:.1f} s -> {renderer.root}")
+    for case_id, error in result.failed:
+        print(f"  {case_id}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""似た骨格パターンの過去症例を探す (計測値の σ ベクトルの最近傍)。
+
+各症例の標準値からの偏差 σ (計測項目の順に並べたベクトル, 欠測は 0 = 平均とみなす) を
+症例と同じ SQLite に保存し (保存と同じトランザクション)、プロセス内ではそれを kd 木に載せて引く。
+kd 木の葉は連続した配列で、問い合わせは境界箱までの距離で葉を並べ、近い葉からまとめて numpy で走査し、
+k 番目の距離より遠い葉が出たところで止める (厳密な k 近傍)。
+追加された症例はまず追記用の小さな配列に入れて総当たりで引き、それが木の大きさに比べて
+大きくなったら木を作り直す (作り直しは償却 O(log n) / 症例)。他のプロセスが保存した症例も
+問い合わせの前に seq の差分を読んで取り込む。
+多数の問い合わせ (一括 API) は木を使わず、ブロックごとの行列積で全件との距離を求める。
+measure を渡すと、保存時の計測値ではなくランドマーク (原画像 px) から計算し直した値で索引を作る。
+
+    python ceph_similar.py --rebuild            # 既存の症例から σ ベクトルを作り直す
+    python ceph_similar.py --case C001 -k 5     # 一括問い合わせ (--case は複数指定可)
+"""
+
+import argparse
+import math
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ceph_cases import CaseArchive, CaseRecord, default_archive
+
+Reference = Dict[str, Tuple[float, float]]
+Measure = Callable[[CaseRecord], Dict[str, float]]
+
+LEAF_SIZE = 64
+FIRST_BATCH = 8  # 最初にまとめて走査する葉の数 (以後 2 倍ずつ)
+REBUILD_MIN = 512  # 追記用の配列がこれと木の REBUILD_RATIO 倍の大きい方を超えたら木を作り直す
+REBUILD_RATIO = 0.125
+REBUILD_BATCH = 5000
+DEFAULT_K = 5
+MATRIX_MIN_QUERIES = 32  # これ以上の一括問い合わせは行列積で総当たりする
+MATRIX_BLOCK = 64  # 行列積の 1 ブロックの問い合わせ数 (一時配列は ブロック × 症例数)
+
+VECTOR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS case_vectors (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    case_id TEXT NOT NULL UNIQUE,
+    vector BLOB NOT NULL
+);
+"""
+
+
+def sigma_vectors(measurements: Iterable[Dict[str, float]], reference: Reference, measures: Sequence[str]) -> np.ndarray:
+    """(症例数, 計測項目数) の σ。欠測や SD の無い項目は 0。"""
+    mean = np.array([reference.get(name, (0.0, 0.0))[0] for name in measures])
+    sd = np.array([reference.get(name, (0.0, 0.0))[1] for name in measures])
+    values = np.array(
+        [[row.get(name, math.nan) for name in measures] for row in measurements], dtype=np.float64
+    ).reshape(-1, len(measures))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigmas = (values - mean) / sd
+    sigmas[~np.isfinite(sigmas)] = 0.0
+    return sigmas.astype(np.float32)
+
+
+class KDTree:
+    """葉をまとめて numpy で走査する kd 木。点は葉の順に並べ替えて連続に持つ。"""
+
+    def __init__(self, points: np.ndarray, slots: np.ndarray, leaf_size: int = LEAF_SIZE) -> None:
+        order = np.arange(len(points))
+        bounds: List[Tuple[int, int]] = []
+        stack = [(0, len(points))]
+        while stack:
+            start, stop = stack.pop()
+            if stop - start <= leaf_size:
+                bounds.append((start, stop))
+                continue
+            block = points[order[start:stop]]
+            axis = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+            half = (stop - start) // 2
+            order[start:stop] = order[start:stop][np.argpartition(block[:, axis], half)]
+            stack += [(start + half, stop), (start, start + half)]
+        self.points = points[order]
+        self.slots = slots[order]
+        bounds.sort()
+        self.starts = np.array([start for start, _ in bounds], dtype=np.int64)
+        self.stops = np.array([stop for _, stop in bounds], dtype=np.int64)
+        self.low = np.minimum.reduceat(self.points, self.starts) if len(points) else np.empty((0, points.shape[1]))
+        self.high = np.maximum.reduceat(self.points, self.starts) if len(points) else np.empty((0, points.shape[1]))
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def query(self, point: np.ndarray, k: int, alive: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(距離の 2 乗, スロット) を近い順に最大 k 個。alive が False のスロットは除く。"""
+        best_d = np.empty(0, dtype=np.float32)
+        best_s = np.empty(0, dtype=np.int64)
+        if not len(self.points):
+            return best_d, best_s
+        gap = np.maximum(self.low - point, 0) + np.maximum(point - self.high, 0)
+        bound = np.einsum("ij,ij->i", gap, gap)
+        leaves = np.argsort(bound)
+        done, batch = 0, FIRST_BATCH
+        while done < len(leaves):
+            if len(best_d) == k and bound[leaves[done]] > best_d[-1]:
+                break
+            chosen = leaves[done : done + batch]
+            # 選んだ葉の [start, stop) をつなげた添字 (葉ごとの arange を 1 回で作る)
+            lengths = self.stops[chosen] - self.starts[chosen]
+            index = np.repeat(self.starts[chosen] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            index = index[alive[self.slots[index]]]
+            diff = self.points[index] - point
+            best_d, best_s = _top_k(
+                np.concatenate([best_d, np.einsum("ij,ij->i", diff, diff)]),
+                np.concatenate([best_s, self.slots[index]]),
+                k,
+            )
+            done += batch
+            batch *= 2
+        return best_d, best_s
+
+
+def _top_k(distances: np.ndarray, slots: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(distances) > k:
+        keep = np.argpartition(distances, k - 1)[:k]
+        distances, slots = distances[keep], slots[keep]
+    order = np.argsort(distances, kind="stable")
+    return distances[order], slots[order]
+
+
+class SimilarityIndex:
+    """保存済み症例の σ ベクトルの索引。保存時に fold し、問い合わせの前に差分を取り込む。"""
+
+    def __init__(
+        self, archive: CaseArchive, reference: Reference, measures: Sequence[str], measure: Optional[Measure] = None
+    ) -> None:
+        self.archive = archive
+        self.reference = dict(reference)
+        self.measures = tuple(measures)
+        self.measure = measure
+        archive.add_schema(VECTOR_SCHEMA)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._ids: List[str] = []
+        self._slots: Dict[str, int] = {}
+        self._vectors = np.empty((0, len(self.measures)), dtype=np.float32)
+        self._alive = np.empty(0, dtype=bool)
+        self._tree = KDTree(self._vectors, np.empty(0, dtype=np.int64))
+        self._tree_size = 0  # これより前のスロットは木に載っている
+        self._seq = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._slots)
+
+    def vector(self, measurements: Dict[str, float]) -> np.ndarray:
+        return sigma_vectors([measurements], self.reference, self.measures)[0]
+
+    def measurements(self, record: CaseRecord) -> Dict[str, float]:
+        return self.measure(record) if self.measure is not None else record.measurements
+
+    def fold(self, conn: sqlite3.Connection, record: CaseRecord) -> None:
+        """1 症例のベクトルを書く (置き換え)。``CaseArchive.save`` の on_insert として呼べる。"""
+        conn.execute(
+            "INSERT OR REPLACE INTO case_vectors (case_id, vector) VALUES (?, ?)",
+            (record.case_id, self.vector(self.measurements(record)).tobytes()),
+        )
+
+    def update(self, record: CaseRecord) -> None:
+        """既存症例の計測値が変わったとき。"""
+        with self.archive.transaction() as conn:
+            self.fold(conn, record)
+
+    def _refresh(self) -> None:
+        """前回から書かれたベクトルを取り込む。置き換えられた症例の古いスロットは無効にする。"""
+        with self.archive.connect() as conn:
+            rows = conn.execute(
+                "SELECT seq, case_id, vector FROM case_vectors WHERE seq > ? ORDER BY seq", (self._seq,)
+            ).fetchall()
+        if not rows:
+            return
+        first = len(self._ids)
+        added = np.frombuffer(b"".join(row["vector"] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        self._vectors = np.concatenate([self._vectors, added])
+        self._alive = np.concatenate([self._alive, np.ones(len(rows), dtype=bool)])
+        for slot, row in enumerate(rows, start=first):
+            previous = self._slots.get(row["case_id"])
+            if previous is not None:
+                self._alive[previous] = False
+            self._slots[row["case_id"]] = slot
+            self._ids.append(row["case_id"])
+        self._seq = rows[-1]["seq"]
+        pending = len(self._ids) - self._tree_size
+        dead = len(self._ids) - len(self._slots)
+        if pending + dead > max(REBUILD_MIN, REBUILD_RATIO * self._tree_size):
+            self._rebuild_tree()
+
+    def _rebuild_tree(self) -> None:
+        """無効なスロットを詰めて、全件で木を作り直す。"""
+        keep = np.flatnonzero(self._alive)
+        self._ids = [self._ids[slot] for slot in keep]
+        self._slots = {case_id: slot for slot, case_id in enumerate(self._ids)}
+        self._vectors = self._vectors[keep]
+        self._alive = np.ones(len(keep), dtype=bool)
+        self._tree = KDTree(self._vectors, np.arange(len(keep), dtype=np.int64))
+        self._tree_size = len(keep)
+
+    def _search(self, point: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_d, best_s = self._tree.query(point, k, self._alive)
+        pending = np.arange(self._tree_size, len(self._ids))
+        pending = pending[self._alive[pending]]
+        if len(pending):
+            diff = self._vectors[pending] - point
+            best_d, best_s = _top_k(
+                np.concatenate([best_d, np.einsum("ij,ij->i", diff, diff)]), np.concatenate([best_s, pending]), k
+            )
+        return best_d, best_s
+
+    def query_vectors(
+        self, vectors: np.ndarray, k: int = DEFAULT_K, exclude: Sequence[Optional[str]] = ()
+    ) -> List[List[Tuple[str, float]]]:
+        """一括問い合わせ。vectors は (m, 計測項目数)、exclude[i] は i 番目の結果から除く症例 ID。
+
+        結果は問い合わせごとに (症例 ID, ユークリッド距離 [σ]) の近い順。
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, len(self.measures))
+        results = []
+        with self._lock:
+            self._refresh()
+            skips = [exclude[idx] if idx < len(exclude) else None for idx in range(len(vectors))]
+            wanted = k + any(skip in self._slots for skip in skips)
+            if len(vectors) >= MATRIX_MIN_QUERIES:
+                found = self._search_matrix(vectors, wanted)
+            else:
+                found = (self._search(point, wanted) for point in vectors)
+            for skip, (distances, slots) in zip(skips, found):
+                hits = [(self._ids[slot], math.sqrt(max(float(d), 0.0))) for d, slot in zip(distances, slots)]
+                results.append([hit for hit in hits if hit[0] != skip][:k])
+        return results
+
+    def _search_matrix(self, vectors: np.ndarray, k: int) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+        """|q - x|^2 = |q|^2 + |x|^2 - 2 q·x をブロックごとの行列積で求める。"""
+        alive = np.flatnonzero(self._alive)
+        points = self._vectors[alive]
+        norms = np.einsum("ij,ij->i", points, points)
+        k = min(k, len(alive))
+        for start in range(0, len(vectors), MATRIX_BLOCK):
+            block = vectors[start : start + MATRIX_BLOCK]
+            distances = norms[None, :] - 2 * (block @ points.T) + np.einsum("ij,ij->i", block, block)[:, None]
+            if not k:
+                yield from ((np.empty(0, dtype=np.float32), alive[:0]) for _ in block)
+                continue
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            for row, columns in zip(distances, nearest):
+                yield _top_k(row[columns], alive[columns], k)
+
+    def query(
+        self, measurements: Dict[str, float], k: int = DEFAULT_K, exclude: Optional[str] = None
+    ) -> List[Tuple[str, float]]:
+        return self.query_vectors(self.vector(measurements)[None], k, [exclude])[0]
+
+    def similar_cases(self, case_ids: Sequence[str], k: int = DEFAULT_K) -> Dict[str, List[Tuple[str, float]]]:
+        """保存済み症例ごとの似た症例 (自分は除く)。索引に無い症例は結果に入れない。"""
+        with self._lock:
+            self._refresh()
+            known = [case_id for case_id in case_ids if case_id in self._slots]
+            vectors = self._vectors[[self._slots[case_id] for case_id in known]]
+        return dict(zip(known, self.query_vectors(vectors, k, known)))
+
+    def rebuild(self) -> int:
+        """アーカイブの全症例からベクトルを作り直す。"""
+        with self.archive.transaction() as conn:
+            conn.execute("DELETE FROM case_vectors")
+            batch: List[CaseRecord] = []
+            for record in self.archive.iter_records():
+                batch.append(record)
+                if len(batch) >= REBUILD_BATCH:
+                    self._insert_batch(conn, batch)
+                    batch = []
+            self._insert_batch(conn, batch)
+            count = conn.execute("SELECT COUNT(*) FROM case_vectors").fetchone()[0]
+        with self._lock:
+            self._reset()
+        return count
+
+    def _insert_batch(self, conn: sqlite3.Connection, records: List[CaseRecord]) -> None:
+        vectors = sigma_vectors([self.measurements(record) for record in records], self.reference, self.measures)
+        conn.executemany(
+            "INSERT INTO case_vectors (case_id, vector) VALUES (?, ?)",
+            [(record.case_id, vector.tobytes()) for record, vector in zip(records, vectors)],
+        )
+
+
+_default_index: Optional[SimilarityIndex] = None
+_default_lock = threading.Lock()
+
+
+def default_similarity_index(
+    reference: Reference, measures: Sequence[str], measure: Optional[Measure] = None
+) -> SimilarityIndex:
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = SimilarityIndex(default_archive(), reference, measures, measure)
+        return _default_index
+
+
+def main() -> None:
+    from CEF03 import REFERENCE_DATA, RESULT_ORDER, measure_record
+
+    parser = argparse.ArgumentParser(description="σ ベクトルが近い保存済み症例")
+    parser.add_argument("--rebuild", action="store_true", help="既存の症例からベクトルを作り直す")
+    parser.add_argument("--case", action="append", default=[], help="問い合わせる症例 ID (複数指定可)")
+    parser.add_argument("-k", type=int, default=DEFAULT_K)
+    args = parser.parse_args()
+    index = default_similarity_index(REFERENCE_DATA, RESULT_ORDER, measure_record)
+    if args.rebuild:
+        print(f"{index.rebuild()} vectors")
+    if args.case:
+        started = time.perf_counter()
+        results = index.similar_cases(args.case, args.k)
+        elapsed = time.perf_counter() - started
+        for case_id in args.case:
+            hits = results.get(case_id)
+            if hits is None:
+                print(f"{case_id}: not indexed")
+                continue
+            print(f"{case_id}: " + "  ".join(f"{other} ({distance:.2f})" for other, distance in hits))
+        print(f"{len(results)} queries over {len(index)} cases in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""セッション状態の外部保存 (複数ノード・再起動をまたいで作業を引き継ぐ)。
+
+セッションはクエリパラメータ ``sid`` で識別し、ランドマークなどの小さな状態を JSON で、
+画像は内容キー (``ceph_tiles.content_key``) ごとに 1 回だけキー・バリューストアへ書く。
+読み出しはライトスルーのキャッシュを通し、書き込みは背景スレッドがまとめて送る
+(同じキーへの連続した書き込みは最後の 1 件だけ送る)。
+
+バックエンドは環境変数 ``CEPH_STATE_BACKEND`` で選ぶ。未設定なら外部保存しない。
+    memory://                  プロセス内 (テスト用)
+    sqlite:///path/to/state.db SQLite (標準ライブラリ)
+    redis://host:6379/0        Redis 互換サーバー (redis パッケージが必要)
+"""
+
+import abc
+import atexit
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+BACKEND_ENV = "CEPH_STATE_BACKEND"
+FLUSH_INTERVAL = 0.2  # 秒。この間の書き込みを 1 回にまとめる
+CACHE_ENTRIES = 1024
+REDIS_TTL = 7 * 24 * 3600
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(abc.ABC):
+    """キー・バリューストアの最小インターフェース。exists は必要なら速いものに置き換える。"""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    def exists(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    @abc.abstractmethod
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+
+class MemoryBackend(StateBackend):
+    def __init__(self) -> None:
+        self._data: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._data.get(key)
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        with self._lock:
+            self._data.update(items)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteBackend(StateBackend):
+    SCHEMA = "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, updated REAL NOT NULL)"
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self.SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def exists(self, key: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM kv WHERE key = ?", (key,)).fetchone() is not None
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO kv (key, value, updated) VALUES (?, ?, ?)",
+                [(key, sqlite3.Binary(value), now) for key, value in items.items()],
+            )
+            conn.execute("COMMIT")
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+
+class RedisBackend(StateBackend):
+    def __init__(self, url: str, ttl: int = REDIS_TTL) -> None:
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError("redis バックエンドには `pip install redis` が必要です。") from exc
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def exists(self, key: str) -> bool:
+        return bool(self.client.exists(key))
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(key, value, ex=self.ttl)
+        pipeline.execute()
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+
+def backend_from_url(url: str) -> StateBackend:
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(Path(url[len("sqlite:///") :]))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"未対応の状態バックエンドです: {url}")
+
+
+class StateStore:
+    """ライトスルーのキャッシュと、まとめて非同期に書く背景スレッド。"""
+
+    def __init__(self, backend: StateBackend, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._pending: Dict[str, bytes] = {}
+        self._in_flight: Dict[str, bytes] = {}
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+
+    def _remember(self, key: str, value: bytes) -> None:
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > CACHE_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def get(self, key: str, cache: bool = True) -> Optional[bytes]:
+        with self._cond:
+            for source in (self._pending, self._in_flight, self._cache):
+                if key in source:
+                    return source[key]
+        value = self.backend.get(key)
+        if value is not None and cache:
+            with self._cond:
+                self._remember(key, value)
+        return value
+
+    def exists(self, key: str) -> bool:
+        with self._cond:
+            if key in self._pending or key in self._in_flight or key in self._cache:
+                return True
+        return self.backend.exists(key)
+
+    def put(self, key: str, value: bytes, cache: bool = True) -> None:
+        with self._cond:
+            if cache:
+                self._remember(key, value)
+            self._pending[key] = value
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="ceph-state-writer", daemon=True)
+                self._writer.start()
+            self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.flush_interval)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._in_flight = batch
+            try:
+                self.backend.set_many(batch)
+            except Exception:
+                logger.exception("failed to write %d state entries; retrying", len(batch))
+                with self._cond:
+                    # 失敗した分は、その後に新しい値が来ていなければ戻す
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                time.sleep(1.0)
+            with self._cond:
+                self._in_flight = {}
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """保留中の書き込みが終わるまで待つ。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def put_blob_once(self, key: str, value: bytes) -> None:
+        """内容キーで引く大きな値 (画像)。既にあれば書かず、キャッシュにも載せない。"""
+        if not self.exists(key):
+            self.put(key, value, cache=False)
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(18)
+
+
+def valid_session_id(value: Optional[str]) -> bool:
+    return bool(value) and SESSION_ID_PATTERN.match(value) is not None
+
+
+def state_key(session_id: str) -> str:
+    return f"ceph:state:{session_id}"
+
+
+def image_key(content: str) -> str:
+    return f"ceph:image:{content}"
+
+
+_default_store: Optional[StateStore] = None
+_default_loaded = False
+_default_lock = threading.Lock()
+
+
+def default_state_store() -> Optional[StateStore]:
+    """``CEPH_STATE_BACKEND`` から作った共有ストア。未設定なら None。"""
+    global _default_store, _default_loaded
+    with _default_lock:
+        if not _default_loaded:
+            url = os.environ.get(BACKEND_ENV, "").strip()
+            _default_store = StateStore(backend_from_url(url)) if url else None
+            if _default_store is not None:
+                atexit.register(_default_store.flush)
+            _default_loaded = True
+        return _default_store
@@ -0,0 +1,154 @@
+"""治療前後など連続したセファロトレースの重ね合わせ。
+
+ランドマークは ``(N, L, 2)`` 配列 (N 組 × L 点 × xy) として扱い、
+相似変換 (回転・平行移動・任意で拡縮) を組ごとにまとめて求める。
+post を pre の座標系へ写し、点ごとの移動量を pre 基準で出す。
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+REGISTRATIONS: Dict[str, Dict[str, Optional[str]]] = {
+    "SN_S": {"name": "S-N 平面 (S で一致)", "origin": "S", "axis": "N"},
+    "FH_Po": {"name": "FH 平面 (Po で一致)", "origin": "Po", "axis": "Or"},
+    "Mandibular_Me": {"name": "下顎下縁平面 (Me で一致)", "origin": "Me", "axis": "Am"},
+    "best_fit": {"name": "全ランドマーク最小二乗", "origin": None, "axis": None},
+}
+
+SERIAL_CSV_COLUMNS = ("case_id", "timepoint", "point", "x", "y")
+
+
+@dataclass(frozen=True)
+class SimilarityTransform:
+    """組ごとの相似変換 ``x' = scale * R @ x + t``。"""
+
+    scale: np.ndarray  # (N,)
+    rotation: np.ndarray  # (N, 2, 2)
+    translation: np.ndarray  # (N, 2)
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        rotated = np.einsum("nij,nlj->nli", self.rotation, points)
+        return self.scale[:, None, None] * rotated + self.translation[:, None, :]
+
+    def inverse(self) -> "SimilarityTransform":
+        rotation_t = np.transpose(self.rotation, (0, 2, 1))
+        scale = 1.0 / self.scale
+        translation = -scale[:, None] * np.einsum("nij,nj->ni", rotation_t, self.translation)
+        return SimilarityTransform(scale, rotation_t, translation)
+
+    @property
+    def angle_deg(self) -> np.ndarray:
+        return np.degrees(np.arctan2(self.rotation[:, 1, 0], self.rotation[:, 0, 0]))
+
+
+def rotation_matrices(angles: np.ndarray) -> np.ndarray:
+    cos, sin = np.cos(angles), np.sin(angles)
+    return np.stack([np.stack([cos, -sin], axis=-1), np.stack([sin, cos], axis=-1)], axis=-2)
+
+
+def two_point_transform(
+    src: np.ndarray, dst: np.ndarray, origin: int, axis: int, allow_scale: bool = False
+) -> SimilarityTransform:
+    """src の origin を dst の origin に重ね、origin→axis の向きをそろえる。"""
+    src_vec = src[:, axis] - src[:, origin]
+    dst_vec = dst[:, axis] - dst[:, origin]
+    angles = np.arctan2(dst_vec[:, 1], dst_vec[:, 0]) - np.arctan2(src_vec[:, 1], src_vec[:, 0])
+    rotation = rotation_matrices(angles)
+    if allow_scale:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.hypot(*dst_vec.T) / np.hypot(*src_vec.T)
+    else:
+        scale = np.ones(len(src))
+    translation = dst[:, origin] - scale[:, None] * np.einsum("nij,nj->ni", rotation, src[:, origin])
+    return SimilarityTransform(scale, rotation, translation)
+
+
+def procrustes_transform(src: np.ndarray, dst: np.ndarray, allow_scale: bool = False) -> SimilarityTransform:
+    """Umeyama 法による最小二乗の相似変換。欠損 (NaN) の点は組ごとに除外する。"""
+    weights = np.isfinite(src).all(axis=-1) & np.isfinite(dst).all(axis=-1)
+    w = weights.astype(float)[:, :, None]
+    count = np.maximum(w.sum(axis=1), 1.0)
+    src0 = np.where(weights[:, :, None], src, 0.0)
+    dst0 = np.where(weights[:, :, None], dst, 0.0)
+    src_mean = (w * src0).sum(axis=1) / count
+    dst_mean = (w * dst0).sum(axis=1) / count
+    src_c = (src0 - src_mean[:, None, :]) * w
+    dst_c = (dst0 - dst_mean[:, None, :]) * w
+    covariance = np.einsum("nli,nlj->nij", dst_c, src_c) / count[:, :, None]
+    u, sigma, vt = np.linalg.svd(covariance)
+    reflect = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    reflect = np.where(reflect == 0, 1.0, reflect)
+    correction = np.ones((len(src), 2))
+    correction[:, 1] = reflect
+    rotation = np.einsum("nij,nj,njk->nik", u, correction, vt)
+    if allow_scale:
+        variance = (src_c ** 2).sum(axis=(1, 2)) / count[:, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = (sigma * correction).sum(axis=1) / variance
+    else:
+        scale = np.ones(len(src))
+    translation = dst_mean - scale[:, None] * np.einsum("nij,nj->ni", rotation, src_mean)
+    return SimilarityTransform(scale, rotation, translation)
+
+
+def register_batch(
+    pre: np.ndarray,
+    post: np.ndarray,
+    point_ids: Sequence[str],
+    registration: str,
+    allow_scale: bool = False,
+) -> Tuple[np.ndarray, SimilarityTransform]:
+    """post を pre の座標系に重ね合わせ、変換後の post と変換を返す。"""
+    spec = REGISTRATIONS[registration]
+    if spec["origin"] is None:
+        transform = procrustes_transform(post, pre, allow_scale)
+    else:
+        index = {pid: i for i, pid in enumerate(point_ids)}
+        transform = two_point_transform(post, pre, index[spec["origin"]], index[spec["axis"]], allow_scale)
+    return transform.apply(post), transform
+
+
+def displacements(pre: np.ndarray, registered_post: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """点ごとの移動量 (dx, dy, 距離)。各 (N, L)。"""
+    delta = registered_post - pre
+    return delta[..., 0], delta[..., 1], np.hypot(delta[..., 0], delta[..., 1])
+
+
+def points_to_array(points_px: Dict[str, Sequence[float]], point_ids: Sequence[str]) -> np.ndarray:
+    return np.array(
+        [points_px.get(pid, (np.nan, np.nan)) for pid in point_ids], dtype=float
+    ).reshape(len(point_ids), 2)
+
+
+def load_serial_csv(data, point_ids: Sequence[str]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """縦持ち CSV (case_id, timepoint, point, x, y) を pre / post の配列にする。
+
+    timepoint は ``pre`` / ``post`` (T0 / T1 も可)。両方そろった症例だけを返す。
+    """
+    frame = pd.read_csv(data)
+    missing = [column for column in SERIAL_CSV_COLUMNS if column not in frame.columns]
+    if missing:
+        raise ValueError(f"CSV に列がありません: {', '.join(missing)}")
+    frame["timepoint"] = (
+        frame["timepoint"].astype(str).str.strip().str.lower().replace({"t0": "pre", "t1": "post"})
+    )
+    frame = frame[frame["timepoint"].isin(["pre", "post"]) & frame["point"].isin(point_ids)]
+    frame["case_id"] = frame["case_id"].astype(str)
+    cases = sorted(
+        set(frame.loc[frame["timepoint"] == "pre", "case_id"])
+        & set(frame.loc[frame["timepoint"] == "post", "case_id"])
+    )
+    shape = (len(cases), len(point_ids), 2)
+    arrays = {"pre": np.full(shape, np.nan), "post": np.full(shape, np.nan)}
+    case_index = pd.Index(cases)
+    point_index = pd.Index(list(point_ids))
+    frame = frame[frame["case_id"].isin(cases)]
+    for timepoint, group in frame.groupby("timepoint"):
+        rows = case_index.get_indexer(group["case_id"])
+        cols = point_index.get_indexer(group["point"])
+        arrays[timepoint][rows, cols] = group[["x", "y"]].to_numpy(dtype=float)
+    return cases, arrays["pre"], arrays["post"]
@@ -0,0 +1,143 @@
+"""ブラウザから送られるドラッグ計測 (遅延・フレーム間隔・ロングタスク) の集計。
+
+フロントエンド (``ceph_component/frontend/telemetry.js``) は固定バケットのヒストグラムを
+次のコンポーネント値に相乗りさせて送る。ここではそれを端末クラス × サイト単位で
+プロセス全体に足し込み、パーセンタイルや FPS に要約する。
+環境変数 ``CEPH_TELEMETRY_LOG`` を指定すると受信したスナップショットを JSONL で追記する。
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# バケット境界 (ms)。フロントエンドにもペイロードで渡すので定義はここだけ。
+BUCKET_EDGES_MS: Tuple[float, ...] = (4, 8, 12, 16, 20, 25, 33, 50, 75, 100, 150, 250, 500, 1000)
+HISTOGRAMS = ("latency", "frame", "longtask")
+SNAPSHOT_VERSION = 1
+MAX_COUNT = 1_000_000  # 1 スナップショット内の 1 バケットの上限 (壊れた値を弾く)
+LOG_ENV = "CEPH_TELEMETRY_LOG"
+
+
+@dataclass
+class MetricsGroup:
+    latency: np.ndarray = field(default_factory=lambda: np.zeros(len(BUCKET_EDGES_MS) + 1, dtype=np.int64))
+    frame: np.ndarray = field(default_factory=lambda: np.zeros(len(BUCKET_EDGES_MS) + 1, dtype=np.int64))
+    longtask: np.ndarray = field(default_factory=lambda: np.zeros(len(BUCKET_EDGES_MS) + 1, dtype=np.int64))
+    snapshots: int = 0
+    drags: int = 0
+    drag_ms: float = 0.0
+    frames: int = 0
+
+
+def parse_histogram(values) -> Optional[np.ndarray]:
+    if not isinstance(values, list) or len(values) != len(BUCKET_EDGES_MS) + 1:
+        return None
+    try:
+        counts = np.array([int(v) for v in values], dtype=np.int64)
+    except (TypeError, ValueError):
+        return None
+    if (counts < 0).any() or (counts > MAX_COUNT).any():
+        return None
+    return counts
+
+
+def device_class(device) -> str:
+    """端末を粗く分類する (ポインタ種別 / コア数 / 画素密度 / 描画方式)。"""
+    if not isinstance(device, dict):
+        return "unknown"
+    pointer = "coarse" if device.get("pointer") == "coarse" else "fine"
+    try:
+        cores = int(device.get("cores") or 0)
+        dpr = float(device.get("dpr") or 1)
+    except (TypeError, ValueError):
+        cores, dpr = 0, 1.0
+    core_class = "?" if cores <= 0 else ("<=4" if cores <= 4 else ("<=8" if cores <= 8 else ">8"))
+    renderer = "canvas" if device.get("renderer") == "canvas" else "dom"
+    view = str(device.get("view") or "")[:16]
+    return f"{view}/{pointer}/{core_class}c/{'hidpi' if dpr >= 2 else 'lodpi'}/{renderer}"
+
+
+def histogram_quantile(counts: np.ndarray, q: float) -> float:
+    """q 分位点が入るバケットの上端 (ms)。最後のバケットは inf、空なら NaN。"""
+    total = int(counts.sum())
+    if total == 0:
+        return float("nan")
+    index = int(np.searchsorted(np.cumsum(counts), q * total, side="left"))
+    return float(BUCKET_EDGES_MS[index]) if index < len(BUCKET_EDGES_MS) else math.inf
+
+
+class MetricsSink:
+    """プロセス全体で共有する集計先。セッションのスレッドから同時に呼ばれる。"""
+
+    def __init__(self, log_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._groups: Dict[Tuple[str, str], MetricsGroup] = {}
+        self._log_path = log_path
+
+    def record(self, snapshot, site: str = "") -> bool:
+        if not isinstance(snapshot, dict) or snapshot.get("v") != SNAPSHOT_VERSION:
+            return False
+        histograms = {name: parse_histogram(snapshot.get(name)) for name in HISTOGRAMS}
+        if any(counts is None for counts in histograms.values()):
+            return False
+        try:
+            drags = max(0, int(snapshot.get("drags") or 0))
+            drag_ms = max(0.0, float(snapshot.get("drag_ms") or 0.0))
+            frames = max(0, int(snapshot.get("frames") or 0))
+        except (TypeError, ValueError):
+            return False
+        key = (device_class(snapshot.get("device")), site)
+        with self._lock:
+            group = self._groups.setdefault(key, MetricsGroup())
+            for name, counts in histograms.items():
+                getattr(group, name)[:] += counts
+            group.snapshots += 1
+            group.drags += drags
+            group.drag_ms += drag_ms
+            group.frames += frames
+            if self._log_path:
+                self._append_log(key, snapshot)
+        return True
+
+    def _append_log(self, key: Tuple[str, str], snapshot: Dict) -> None:
+        entry = {"time": time.time(), "device_class": key[0], "site": key[1], **snapshot}
+        try:
+            with open(self._log_path, "a", encoding="utf-8") as log:
+                log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+
+    def summary(self) -> List[Dict[str, object]]:
+        rows = []
+        with self._lock:
+            items = sorted(self._groups.items())
+            for (device, site), group in items:
+                seconds = group.drag_ms / 1000.0
+                rows.append(
+                    {
+                        "端末": device,
+                        "サイト": site,
+                        "ドラッグ数": group.drags,
+                        "FPS": round(group.frames / seconds, 1) if seconds > 0 else float("nan"),
+                        "遅延 p50 (ms)": histogram_quantile(group.latency, 0.5),
+                        "遅延 p95 (ms)": histogram_quantile(group.latency, 0.95),
+                        "フレーム p95 (ms)": histogram_quantile(group.frame, 0.95),
+                        "ロングタスク": int(group.longtask.sum()),
+                        "ロングタスク p95 (ms)": histogram_quantile(group.longtask, 0.95),
+                    }
+                )
+        return rows
+
+    def reset(self) -> None:
+        with self._lock:
+            self._groups.clear()
+
+
+METRICS_SINK = MetricsSink(os.environ.get(LOG_ENV) or None)
@@ -0,0 +1,146 @@
+"""症例画像の保存とサムネイル生成。
+
+症例を保存するとき、原画像を内容キー (``ceph_tiles.content_key``) のファイルとして
+アーカイブの隣 (``<CEPH_ARCHIVE_DIR>/images``) に 1 回だけ書き、サムネイル
+(``thumbs/<キー>.jpg``) は背景のワーカープールで作る。Pillow は復号・縮小の間 GIL を
+手放すのでスレッドで並列に動く。ギャラリーはページに出す分のサムネイルだけを読み、
+原画像は症例を開いたときに初めて読む。
+"""
+
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from PIL import Image
+
+from ceph_cases import ARCHIVE_ENV, DEFAULT_ARCHIVE_DIR
+from ceph_tiles import normalize_for_display
+
+IMAGE_DIR = "images"
+THUMB_DIR = "thumbs"
+THUMB_SIZE = (240, 240)
+THUMB_QUALITY = 80
+THUMB_WORKERS = 2
+DEFAULT_MIME = "image/png"
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/bmp": ".bmp",
+}
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as handle:
+        handle.write(data)
+    os.replace(handle.name, path)
+
+
+def make_thumbnail(source: Path, target: Path, size: Tuple[int, int] = THUMB_SIZE) -> Path:
+    """source を size に収まるよう縮小した JPEG を target に書く。"""
+    with Image.open(source) as image:
+        # JPEG は復号時に 1/2^n へ縮小できる (全画素を復号しない)
+        image.draft(image.mode, (size[0] * 2, size[1] * 2))
+        image = normalize_for_display(image)
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=target.parent, suffix=".jpg", delete=False) as handle:
+            image.save(handle, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+    os.replace(handle.name, target)
+    return target
+
+
+class CaseImageStore:
+    def __init__(self, root: Optional[Path] = None, workers: int = THUMB_WORKERS) -> None:
+        self.root = Path(root or os.environ.get(ARCHIVE_ENV) or DEFAULT_ARCHIVE_DIR)
+        self.image_root = self.root / IMAGE_DIR
+        self.thumb_root = self.root / THUMB_DIR
+        self.image_root.mkdir(parents=True, exist_ok=True)
+        self.thumb_root.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[str, Future] = {}
+        self._failed: Set[str] = set()  # 読めなかった画像は再試行しない
+        self._lock = threading.Lock()
+
+    def image_path(self, key: str) -> Optional[Path]:
+        for extension in IMAGE_EXTENSIONS.values():
+            path = self.image_root / f"{key}{extension}"
+            if path.exists():
+                return path
+        return None
+
+    def thumb_path(self, key: str) -> Path:
+        return self.thumb_root / f"{key}.jpg"
+
+    def put(self, key: str, data: bytes, mime: str = DEFAULT_MIME) -> None:
+        """原画像を (無ければ) 書き、サムネイルの生成を予約する。"""
+        if self.image_path(key) is None:
+            extension = IMAGE_EXTENSIONS.get(mime, IMAGE_EXTENSIONS[DEFAULT_MIME])
+            _write_atomic(self.image_root / f"{key}{extension}", data)
+        self.schedule(key)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """原画像のバイト列と MIME。"""
+        path = self.image_path(key)
+        if path is None:
+            return None
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        mime = next((m for m, extension in IMAGE_EXTENSIONS.items() if path.suffix == extension), DEFAULT_MIME)
+        return data, mime
+
+    def thumbnail(self, key: str) -> Optional[Path]:
+        """できていればサムネイルのパス。無ければ生成を予約して None。"""
+        path = self.thumb_path(key)
+        if path.exists():
+            return path
+        self.schedule(key)
+        return None
+
+    def schedule(self, key: str) -> Optional[Future]:
+        source = self.image_path(key)
+        if source is None or self.thumb_path(key).exists():
+            return None
+        with self._lock:
+            if key in self._failed:
+                return None
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ceph-thumb")
+            future = self._pool.submit(make_thumbnail, source, self.thumb_path(key))
+            self._pending[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key: str, future: Future) -> None:
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is not None:
+                self._failed.add(key)
+
+    def wait(self, keys: Iterable[str], timeout: Optional[float] = None) -> None:
+        with self._lock:
+            futures = [self._pending[key] for key in keys if key in self._pending]
+        for future in futures:
+            future.exception(timeout)
+
+
+_default_store: Optional[CaseImageStore] = None
+_default_lock = threading.Lock()
+
+
+def default_image_store() -> CaseImageStore:
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = CaseImageStore()
+        return _default_store
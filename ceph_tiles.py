@@ -0,0 +1,230 @@
+"""コンポーネント内ズーム用のタイルピラミッドを生成する。
+
+タイルは Streamlit の静的配信 (``server.enableStaticServing``) で ``static/`` 以下から
+配信し、コンポーネントは表示範囲・倍率に必要なタイルだけを取得する。
+同じ画像は内容ハッシュで共有するため、二度生成しない。
+複数のセッションが同じ画像を同時に生成しても壊れないよう、ファイルはすべて
+一意な一時ファイルに書いてから置き換える。
+
+注意: ``static/tiles/`` は認証なしで配信されるので、URL (内容ハッシュ 20 桁) を知っていれば
+セッションの外からも原寸の画像を取得できる。患者画像を残し続けないよう、
+``CEPH_TILE_RETENTION_SECONDS`` (既定 86400 秒, 0 で無効) 使われていないピラミッドは
+新しい画像のタイルを作るついでに消す。表示中のセッションは再実行のたびに使用時刻を更新する。
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+
+TILE_SIZE = 256
+TILE_FORMAT = "jpg"
+TILE_QUALITY = 85
+PREVIEW_MAX_WIDTH = 1024
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+TILE_ROOT = STATIC_DIR / "tiles"
+# 静的配信のパス。コンポーネントの iframe はアプリと別の URL から読まれるので、
+# サーバーのベースパス (server.baseUrlPath) を付けた絶対パスで指す
+TILE_URL_PREFIX = "app/static/tiles"
+TILE_RETENTION_ENV = "CEPH_TILE_RETENTION_SECONDS"
+DEFAULT_TILE_RETENTION = 24 * 3600
+PRUNE_INTERVAL = 600  # 秒。古いピラミッドの掃除はこれより頻繁には行わない
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+
+@dataclass(frozen=True)
+class TilePyramid:
+    key: str
+    width: int
+    height: int
+    tile_size: int
+    level_sizes: Tuple[Tuple[int, int], ...]  # level 0 = 原寸、以降 1/2 ずつ
+
+    def base_url(self, base_path: str = "") -> str:
+        """配信 URL。base_path はサーバーのベースパス (``server.baseUrlPath``, 空ならルート)。"""
+        prefix = "/".join(part for part in (base_path.strip("/"), TILE_URL_PREFIX) if part)
+        return f"/{prefix}/{self.key}"
+
+    def to_payload(self, base_path: str = "") -> Dict[str, Any]:
+        base_url = self.base_url(base_path)
+        return {
+            "key": self.key,
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "levels": [list(size) for size in self.level_sizes],
+            "url": f"{base_url}/{{z}}/{{x}}_{{y}}.{TILE_FORMAT}",
+            "preview": f"{base_url}/preview.{TILE_FORMAT}",
+        }
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+def normalize_for_display(image: Image.Image) -> Image.Image:
+    """表示用に 8bit の L / RGB へそろえる。"""
+    if image.mode in ("L", "RGB"):
+        return image
+    if image.mode in ("1", "P", "LA", "PA", "RGBA", "CMYK", "YCbCr"):
+        return image.convert("RGB" if image.mode not in ("1", "LA") else "L")
+    # I;16 / I / F などの高ビット深度は最小〜最大を 8bit に伸ばす
+    if image.mode.startswith("I;16"):
+        image = image.convert("I")
+    low, high = image.getextrema()
+    scale = 255.0 / (high - low) if high > low else 1.0
+    return image.point(lambda value: value * scale - low * scale).convert("L")
+
+
+def _replace_with(path: Path, write) -> None:
+    """write(handle) で同じディレクトリの一意な一時ファイルに書き、path へ原子的に置き換える。"""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", delete=False) as handle:
+        try:
+            write(handle)
+        except BaseException:
+            handle.close()
+            os.unlink(handle.name)
+            raise
+    os.replace(handle.name, path)
+
+
+def save_image(image: Image.Image, path: Path) -> None:
+    _replace_with(path, lambda handle: image.save(handle, format="JPEG", quality=TILE_QUALITY))
+
+
+def write_tiles(level_image: Image.Image, level_dir: Path, tile_size: int) -> None:
+    level_dir.mkdir(parents=True, exist_ok=True)
+    width, height = level_image.size
+    for row in range((height + tile_size - 1) // tile_size):
+        for col in range((width + tile_size - 1) // tile_size):
+            box = (
+                col * tile_size,
+                row * tile_size,
+                min((col + 1) * tile_size, width),
+                min((row + 1) * tile_size, height),
+            )
+            save_image(level_image.crop(box), level_dir / f"{col}_{row}.{TILE_FORMAT}")
+
+
+def touch_pyramid(key: str) -> bool:
+    """使用時刻 (meta.json の mtime) を更新する。ピラミッドが無ければ (掃除済みなど) False。"""
+    try:
+        os.utime(TILE_ROOT / key / "meta.json")
+    except OSError:
+        return False
+    return True
+
+
+def tile_retention() -> float:
+    try:
+        return float(os.environ.get(TILE_RETENTION_ENV, DEFAULT_TILE_RETENTION))
+    except ValueError:
+        return float(DEFAULT_TILE_RETENTION)
+
+
+def prune_tiles(older_than: float) -> int:
+    """older_than 秒以上使われていないピラミッドを消し、消した数を返す。
+
+    使用時刻は meta.json の mtime。生成途中 (meta.json がまだ無い) ならディレクトリの mtime で見る。
+    """
+    if not TILE_ROOT.exists():
+        return 0
+    limit = time.time() - older_than
+    removed = 0
+    for root in TILE_ROOT.iterdir():
+        try:
+            meta_path = root / "meta.json"
+            used = (meta_path if meta_path.exists() else root).stat().st_mtime
+        except OSError:
+            continue
+        if used < limit:
+            shutil.rmtree(root, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def maybe_prune_tiles() -> int:
+    """保持期間を過ぎたピラミッドを、PRUNE_INTERVAL に 1 回まで消す。"""
+    global _last_prune
+    retention = tile_retention()
+    if retention <= 0:
+        return 0
+    with _prune_lock:
+        now = time.time()
+        if now - _last_prune < PRUNE_INTERVAL:
+            return 0
+        _last_prune = now
+    return prune_tiles(retention)
+
+
+def load_pyramid(key: str) -> Optional[TilePyramid]:
+    meta_path = TILE_ROOT / key / "meta.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    return TilePyramid(
+        key=key,
+        width=meta["width"],
+        height=meta["height"],
+        tile_size=meta["tile_size"],
+        level_sizes=tuple(tuple(size) for size in meta["levels"]),
+    )
+
+
+def build_tile_pyramid(image_bytes: bytes, tile_size: int = TILE_SIZE) -> TilePyramid:
+    """画像からタイルピラミッドを生成する (生成済みなら読み込むだけ)。"""
+    key = content_key(image_bytes)
+    existing = load_pyramid(key)
+    if existing is not None:
+        touch_pyramid(key)
+        return existing
+    maybe_prune_tiles()
+
+    root = TILE_ROOT / key
+    level_sizes: List[Tuple[int, int]] = []
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        current = normalize_for_display(source)
+        width, height = current.size
+
+        preview = current.copy()
+        preview.thumbnail((PREVIEW_MAX_WIDTH, PREVIEW_MAX_WIDTH * height // max(width, 1) + 1))
+        root.mkdir(parents=True, exist_ok=True)
+        save_image(preview, root / f"preview.{TILE_FORMAT}")
+
+        level = 0
+        while True:
+            write_tiles(current, root / str(level), tile_size)
+            level_sizes.append(current.size)
+            if max(current.size) <= tile_size:
+                break
+            current = current.reduce(2)
+            level += 1
+
+    # meta.json はタイルを書き終えてから置く (存在 = 生成完了)
+    meta = {"width": width, "height": height, "tile_size": tile_size, "levels": level_sizes}
+    _replace_with(root / "meta.json", lambda handle: handle.write(json.dumps(meta).encode("utf-8")))
+    return TilePyramid(key, width, height, tile_size, tuple(tuple(size) for size in level_sizes))
+
+
+def data_url_to_bytes(data_url: str) -> bytes:
+    _, _, encoded = data_url.partition(",")
+    return base64.b64decode(encoded)
+
+
+def tile_pyramid_for_data_url(data_url: str) -> TilePyramid:
+    return build_tile_pyramid(data_url_to_bytes(data_url))
+
@@ -0,0 +1,181 @@
+"""ランドマーク位置の誤差を計測値へ伝播させるモンテカルロ推定。
+
+各ランドマークに楕円形 (主軸・副軸の SD と主軸の向き) の誤差モデルを持たせ、
+点群をまとめて摂動してベクトル化した角度計算に流す。
+サンプルはチャンクごとに float32 で生成するので、10^6 サンプルでもメモリは一定。
+乱数は対称変量 (z と -z の組) で半分だけ引き、チャンクは独立な乱数列でスレッドに分ける
+(numpy の乱数生成と配列演算は GIL を放すので、コア数に応じて速くなる)。
+信頼区間の両端は全体を partition せず、間引いたサンプルで挟んだ裾の値だけから求める。
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class LandmarkError:
+    sd_major_mm: float
+    sd_minor_mm: float
+    angle_deg: float = 0.0  # 主軸の向き (画像 x 軸から, 下向きが正)
+
+
+@dataclass(frozen=True)
+class IntervalEstimate:
+    mean: float
+    sd: float
+    low: float
+    high: float
+
+
+# 文献上のおおよその再現誤差 (mm)。水平 0°, 垂直 90°。
+LANDMARK_ERRORS: Dict[str, LandmarkError] = {
+    "N": LandmarkError(1.0, 0.6, 90.0),
+    "S": LandmarkError(0.6, 0.5),
+    "Or": LandmarkError(1.6, 0.9),
+    "Po": LandmarkError(1.8, 1.1),
+    "Ar": LandmarkError(1.5, 1.0, 90.0),
+    "A": LandmarkError(1.6, 0.7, 90.0),
+    "U1": LandmarkError(0.5, 0.4),
+    "L1": LandmarkError(0.6, 0.4),
+    "B": LandmarkError(1.6, 0.7, 90.0),
+    "Pog": LandmarkError(1.2, 0.7, 90.0),
+    "Me": LandmarkError(1.3, 0.6),
+    "Am": LandmarkError(1.8, 1.2),
+    "Pm": LandmarkError(1.8, 1.2, 90.0),
+    "U1r": LandmarkError(1.5, 1.0, 70.0),
+    "L1r": LandmarkError(1.5, 1.0, 110.0),
+}
+DEFAULT_ERROR = LandmarkError(1.0, 1.0)
+
+DEFAULT_PX_PER_MM = 10.0  # 原画像の px (一般的なセファロは 0.1 mm/px 前後)
+DEFAULT_SAMPLES = 100_000
+CHUNK_SIZE = 1 << 17
+QUANTILE_STRIDE = 64  # 分位点の当たりを付けるのに使う間引き間隔
+QUANTILE_MARGIN = 0.01  # 当たりの外側にとる確率の余裕 (足りなければ全体で求め直す)
+
+
+def noise_factors(point_ids: Sequence[str], px_per_mm: float) -> np.ndarray:
+    """各ランドマークの ``R @ diag(sd)`` (px)。標準正規ベクトルに掛けると誤差になる。"""
+    errors = [LANDMARK_ERRORS.get(pid, DEFAULT_ERROR) for pid in point_ids]
+    theta = np.radians([error.angle_deg for error in errors])
+    sds = np.array([[error.sd_major_mm, error.sd_minor_mm] for error in errors]) * px_per_mm
+    cos, sin = np.cos(theta), np.sin(theta)
+    rotation = np.stack([np.stack([cos, -sin], axis=-1), np.stack([sin, cos], axis=-1)], axis=-2)
+    return rotation * sds[:, None, :]
+
+
+def sample_landmarks(center: np.ndarray, factors: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    """center (L, 2) を摂動したサンプル (count, L, 2) を float32 で返す。
+
+    前半は center + 誤差、後半は同じ誤差を引いた center - 誤差 (対称変量) なので、
+    乱数は半分で済み、各サンプルの分布は変わらない。
+    実体は ``(2, L, count)`` で持ち、転置ビューを返す (成分ごとの演算が連続アクセスになる)。
+    """
+    half = (count + 1) // 2
+    z = rng.standard_normal((2, len(center), half), dtype=np.float32)
+    f = factors.astype(np.float32)[:, :, :, None]
+    c = center.astype(np.float32).T[:, :, None]
+    noise = np.empty_like(z)
+    np.multiply(f[:, 0, 0], z[0], out=noise[0])
+    noise[0] += f[:, 0, 1] * z[1]
+    np.multiply(f[:, 1, 1], z[1], out=noise[1])
+    noise[1] += f[:, 1, 0] * z[0]
+    out = np.empty((2, len(center), count), dtype=np.float32)
+    np.add(c, noise, out=out[:, :, :half])
+    np.subtract(c, noise[:, :, : count - half], out=out[:, :, half:])
+    return out.transpose(2, 1, 0)
+
+
+def _order_statistics(data: np.ndarray, probe: np.ndarray, rank: int, from_top: bool) -> Tuple[float, float]:
+    """昇順で rank 番目と rank + 1 番目の値。
+
+    probe (間引いて並べたサンプル) で端から QUANTILE_MARGIN だけ内側の値を当たりにし、
+    それより外側の値だけを部分ソートする。
+    """
+    n = data.size
+    p = (n - 1 - rank if from_top else rank) / n + QUANTILE_MARGIN
+    edge = min(len(probe) - 1, int(p * len(probe)))
+    if from_top:
+        window = data[data >= probe[len(probe) - 1 - edge]]
+        local = rank - (n - len(window))
+    else:
+        window = data[data <= probe[edge]]
+        local = rank
+    if local < 0 or local + 1 >= len(window):
+        # 当たりが外れたら全体で求める (裾がまとまって同じ値のときなど)
+        window, local = data, rank
+    part = np.partition(window, (local, local + 1))
+    return float(part[local]), float(part[local + 1])
+
+
+def tail_quantiles(data: np.ndarray, tail: float) -> Tuple[float, float]:
+    """tail と 1 - tail の分位点 (``np.quantile`` の線形補間と同じ値)。"""
+    n = data.size
+    if n < 4 * QUANTILE_STRIDE:
+        low, high = np.quantile(data, [tail, 1.0 - tail])
+        return float(low), float(high)
+    probe = np.sort(data[::QUANTILE_STRIDE])
+    bounds = []
+    for q, from_top in ((tail, False), (1.0 - tail, True)):
+        position = q * (n - 1)
+        rank = min(int(position), n - 2)
+        lower, upper = _order_statistics(data, probe, rank, from_top)
+        bounds.append(lower + (upper - lower) * (position - rank))
+    return bounds[0], bounds[1]
+
+
+def monte_carlo_intervals(
+    center: np.ndarray,
+    point_ids: Sequence[str],
+    measure: Callable[[np.ndarray], Dict[str, np.ndarray]],
+    samples: int = DEFAULT_SAMPLES,
+    px_per_mm: float = DEFAULT_PX_PER_MM,
+    level: float = 0.95,
+    seed: int = 0,
+) -> Dict[str, IntervalEstimate]:
+    """measure (``(n, L, 2) -> {name: (n,)}``) の分布から平均・SD・信頼区間を求める。
+
+    チャンクごとに seed から派生させた乱数列を使うので、結果はスレッド数によらず同じ。
+    """
+    factors = noise_factors(point_ids, px_per_mm)
+    starts = range(0, samples, CHUNK_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    values: Dict[str, np.ndarray] = {}
+
+    def run(start: int, chunk_seed: np.random.SeedSequence) -> Tuple[int, Dict[str, np.ndarray]]:
+        count = min(CHUNK_SIZE, samples - start)
+        return start, measure(sample_landmarks(center, factors, count, np.random.default_rng(chunk_seed)))
+
+    with ThreadPoolExecutor(max_workers=min(len(starts), os.cpu_count() or 1) or 1) as pool:
+        for start, chunk in pool.map(run, starts, seeds):
+            for name, result in chunk.items():
+                if name not in values:
+                    values[name] = np.empty(samples, dtype=np.float32)
+                values[name][start : start + len(result)] = result
+    tail = (1.0 - level) / 2.0
+    estimates: Dict[str, IntervalEstimate] = {}
+    for name, data in values.items():
+        finite = np.isfinite(data)
+        if not finite.all():
+            data = data[finite]
+        if data.size == 0:
+            nan = float("nan")
+            estimates[name] = IntervalEstimate(nan, nan, nan, nan)
+            continue
+        low, high = tail_quantiles(data, tail)
+        # 平均は float64 で足し、偏差は float32 のまま内積で二乗和にする (一時配列が 1 本で済む)
+        mean = float(data.sum(dtype=np.float64)) / data.size
+        deviation = data - np.float32(mean)
+        sd = math.sqrt(float(np.dot(deviation, deviation)) / data.size)
+        estimates[name] = IntervalEstimate(mean, sd, low, high)
+    return estimates
+
+
+def state_key(points_px: Dict[str, Tuple[float, float]], *options) -> Tuple:
+    """キャッシュ用のキー。0.01px 未満の揺れは同じ状態とみなす。"""
+    return tuple((pid, round(x, 2), round(y, 2)) for pid, (x, y) in sorted(points_px.items())) + options
@@ -6,14 +6,23 @@
 # - (#) タッチは setPointerCapture を使わず、2本指以上はドラッグ無効           // ★
 # - (#) releasePointerCapture の event 参照バグ修正（pointerId保持）           // ★
 
+import copy
 import json
+from typing import Optional
+
 import streamlit as st
-import streamlit.components.v1 as components
 import CEF03 as base
+from ceph_component import html_component, load_frontend_script
+from ceph_tiles import tile_pyramid_for_data_url, touch_pyramid
 
 SD_BASE = 4.0
 POLY_WIDTH_SCALE = 2.0
 ANGLE_STACK_BASE_WIDTH = 900
+LIVE_SYNC_INTERVAL_MS = 250
+SYNC_ACK_TIMEOUT_MS = 2000
+TELEMETRY_FLUSH_MS = 5000
+COMPONENT_KEY = "ceph-slim"
+MAX_ZOOM = 8
 
 ANGLE_STACK_CONFIG = [
     {"id": "Facial", "label": "Facial", "type": "angle", "vectors": [["Pog", "N"], ["Po", "Or"]]},
@@ -52,13 +61,65 @@ POLYGON_ROWS = [
     ["VBOT", 0.0, 0.0, 0.0],
 ]
 
-def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bool, point_state: dict):
+def get_render_snapshot(point_state: dict) -> dict:
+    """描画に使うポイント状態とステージ寸法。バージョンが進むまでは同じスナップショットを返す。
+
+    ライブ同期中の値で payload が変わると iframe が作り直されてドラッグが途切れるため、
+    確定イベントでバージョンが進んだときだけ描画内容を更新する。
+    """
+    version = st.session_state.get("ceph_state_version", 0)
+    snapshot = st.session_state.get("ceph_render_snapshot")
+    if not snapshot or snapshot["version"] != version or "stage" not in snapshot:
+        snapshot = {
+            "version": version,
+            "points": copy.deepcopy(point_state),
+            "stage": copy.deepcopy(st.session_state.get("ceph_stage")),
+        }
+        st.session_state.ceph_render_snapshot = snapshot
+    return snapshot
+
+
+def get_sync_ack() -> Optional[dict]:
+    """反映済みの同期値 {instance, seq}。iframe はこれを見てから次のライブ同期値を送る。"""
+    sync_key = st.session_state.get("ceph_sync_key")
+    if not sync_key:
+        return None
+    return {"instance": sync_key[0], "seq": sync_key[1]}
+
+
+def get_tile_payload(image_data_url: str) -> dict:
+    """表示中の画像のタイル情報。画像が変わったとき (または保持期間切れで消されたとき) だけピラミッドを引く。"""
+    cached = st.session_state.get("ceph_tile_payload")
+    if cached and cached[0] == image_data_url and touch_pyramid(cached[1]["key"]):
+        return cached[1]
+    tiles = tile_pyramid_for_data_url(image_data_url).to_payload(st.get_option("server.baseUrlPath") or "")
+    st.session_state.ceph_tile_payload = (image_data_url, tiles)
+    return tiles
+
+
+def render_ceph_component(
+    image_data_url: str,
+    marker_size: int,
+    show_labels: bool,
+    point_state: dict,
+    renderer: str = "dom",
+    live_sync: bool = False,
+    tiles: Optional[dict] = None,
+):
+    snapshot = get_render_snapshot(point_state) if live_sync else None
     payload_json = base.build_component_payload(
         image_data_url=image_data_url,
         marker_size=marker_size,
         show_labels=show_labels,
-        point_state=point_state,
+        point_state=snapshot["points"] if snapshot else point_state,
+        renderer=renderer,
+        state_version=st.session_state.get("ceph_state_version", 0),
+        stage=snapshot["stage"] if snapshot else st.session_state.get("ceph_stage"),
     )
+    resize_script = load_frontend_script("resize_observer.js")
+    canvas_script = load_frontend_script("canvas_renderer.js") if renderer == "canvas" else ""
+    geometry_script = load_frontend_script("geometry_worker.js")
+    telemetry_script = load_frontend_script("telemetry.js")
 
     angle_rows_html = "".join(
         f'<div class="angle-row" data-angle="{cfg["id"]}">'
@@ -74,8 +135,12 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
         position:relative;width:min(100%,960px);margin:0 auto;
         overscroll-behavior: contain; /* ★ ラバーバンド軽減 */
       }
+      #ceph-zoom-layer{position:relative;transform-origin:0 0;}
       #ceph-image{width:100%;height:auto;display:block;pointer-events:none;user-select:none;-webkit-user-select:none;}
+      #ceph-tiles{position:absolute;inset:0;pointer-events:none;overflow:hidden;}
+      .ceph-tile{position:absolute;display:block;pointer-events:none;}
       #ceph-planes{position:absolute;inset:0;pointer-events:none;z-index:1;}
+      #ceph-planes line{vector-effect:non-scaling-stroke;}
       #ceph-overlay{position:absolute;inset:0;pointer-events:none;z-index:2;}
       #ceph-stage{
         position:absolute;inset:0;pointer-events:auto;z-index:3;
@@ -104,7 +169,12 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
       .std-hline{stroke:#ffffff;stroke-width:1.1;}
       .std-patient{stroke:#ef4444;stroke-width:2;fill:none;}
 
-      .ceph-marker{position:absolute;transform:translate(-50%,0);cursor:grab;}
+      /* ズームモード: ピンチ/パンはコンポーネント内で処理（GPU 合成の transform） */
+      .ceph-wrapper.zoom-mode{overflow:hidden;touch-action:none;}
+      .ceph-wrapper.zoom-mode #ceph-zoom-layer{will-change:transform;z-index:1;}
+      .ceph-wrapper.zoom-mode #ceph-stage{touch-action:none;}
+
+      .ceph-marker{position:absolute;transform:translate(-50%,0) scale(var(--inv-zoom,1));transform-origin:50% 0;cursor:grab;}
       .ceph-marker.dragging{cursor:grabbing;}
       .ceph-marker .pin{width:0;height:0;margin:0 auto;}
       .ceph-label{margin-top:2px;font-size:11px;font-weight:700;color:#f8fafc;text-shadow:0 1px 2px rgba(0,0,0,.6);text-align:center;}
@@ -123,26 +193,41 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
     </script>
 
     <div class="ceph-wrapper">
-      <img id="ceph-image" src="__IMAGE_DATA_URL__" alt="cephalometric background"/>
-      <svg id="ceph-planes"></svg>
+      <div id="ceph-zoom-layer">
+        <img id="ceph-image" src="__IMAGE_DATA_URL__" alt="cephalometric background"/>
+        <div id="ceph-tiles"></div>
+        <svg id="ceph-planes"></svg>
+        <div id="ceph-stage"></div>
+      </div>
       <svg id="ceph-overlay"></svg>
-      <div id="ceph-stage"></div>
       <div id="angle-stack">
         __ANGLE_ROWS_HTML__
         <div id="coord-stack"></div>
       </div>
     </div>
 
+    <script>__RESIZE_SCRIPT__</script>
+    <script>__CANVAS_SCRIPT__</script>
+    <script>__GEOMETRY_SCRIPT__</script>
+    <script>__TELEMETRY_SCRIPT__</script>
     <script>
       const ANGLE_CONFIG = __ANGLE_CONFIG_JSON__;
       const POLYGON_ROWS = __POLY_ROWS_JSON__;
       const SD_BASE = __SD_BASE__;
       const POLY_WIDTH_SCALE = __POLY_WIDTH_SCALE__;
       const ANGLE_STACK_BASE_WIDTH = __ANGLE_STACK_BASE_WIDTH__;
+      const LIVE_SYNC = __LIVE_SYNC__;
+      const LIVE_SYNC_INTERVAL_MS = __LIVE_SYNC_INTERVAL_MS__;
+      const SYNC_ACK_TIMEOUT_MS = __SYNC_ACK_TIMEOUT_MS__;
+      const TELEMETRY_FLUSH_MS = __TELEMETRY_FLUSH_MS__;
+      const ZOOM = __ZOOM_JSON__;
+      const MAX_ZOOM = __MAX_ZOOM__;
       const payload = __PAYLOAD_JSON__;
 
       (function(){
         const wrapper = document.querySelector(".ceph-wrapper");
+        const zoomLayer = document.getElementById("ceph-zoom-layer");
+        const tileLayer = document.getElementById("ceph-tiles");
         const image   = document.getElementById("ceph-image");
         const stage   = document.getElementById("ceph-stage");
         const planesSvg = document.getElementById("ceph-planes");
@@ -163,6 +248,230 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
         const clamp=(v,lo,hi)=>Math.min(Math.max(v,lo),hi);
         const xy = m => (!m?null:{x:parseFloat(m.dataset.left||"0"), y:parseFloat(m.dataset.top||"0")});
 
+        // Canvas 描画モード: マーカー/平面は renderer が1枚の canvas に描く
+        const renderer = (payload.renderer==="canvas" && window.CephCanvasRenderer) ? window.CephCanvasRenderer.create({
+          container: zoomLayer, image,
+          points: payload.points||[], planes: payload.planes||[],
+          markerSize: 28, halfWidthFactor: 0.25, showLabels: payload.showLabels!==false,
+          touchAction: ZOOM ? "none" : "pinch-zoom",
+          onDragStart: ()=>{ if(telemetry) telemetry.dragStart(); },
+          onDrag: (id, ev)=>{ updateGeometry(); updateCoordStack(); if(telemetry) telemetry.input(ev ? ev.timeStamp : 0); queueSync("drag", id); },
+          onDragEnd: (id, eventType)=>{ updateGeometry(); updateCoordStack(); if(telemetry) telemetry.dragEnd(); queueSync(eventType, id); },
+        }) : null;
+        const pointXY = id => renderer ? renderer.getPixel(id) : xy(markerById[id]);
+        const pointIds = () => renderer ? renderer.ids.slice() : Object.keys(markerById);
+        const pointRatio = id => {
+          if(renderer) return renderer.getRatio(id);
+          const m=markerById[id]; if(!m || m.dataset.ratioX===undefined) return null;
+          return {x:parseFloat(m.dataset.ratioX), y:parseFloat(m.dataset.ratioY)};
+        };
+        const stageSize = () => renderer ? renderer.size() : {width:stage.clientWidth||0, height:stage.clientHeight||0};
+        // 画面座標 → ステージ座標（ズームの transform を打ち消す）
+        const toLocal = ev => {
+          const r=stage.getBoundingClientRect();
+          const sx=r.width ? (stage.clientWidth||r.width)/r.width : 1;
+          const sy=r.height ? (stage.clientHeight||r.height)/r.height : 1;
+          return {x:(ev.clientX-r.left)*sx, y:(ev.clientY-r.top)*sy};
+        };
+        // ステージ座標 → 原画像のピクセル座標
+        const toNative = p => {
+          const size=stageSize();
+          if(!ZOOM || !p || !size.width || !size.height) return p;
+          return {x:p.x*ZOOM.width/size.width, y:p.y*ZOOM.height/size.height};
+        };
+
+        // ===== コンポーネント内ズーム / パン（タイル表示）=====
+        // 変形は zoomLayer の CSS transform だけで行い（GPU 合成）、表示範囲と倍率に
+        // 必要な解像度のタイルだけを読み込む。
+        let zoomScale=1, zoomTx=0, zoomTy=0, tileFrame=null;
+        const tileEls=new Map();
+        function clampPan(){
+          const w=wrapper.clientWidth||0, h=zoomLayer.clientHeight||0;
+          zoomTx=Math.min(0, Math.max(w-w*zoomScale, zoomTx));
+          zoomTy=Math.min(0, Math.max(h-h*zoomScale, zoomTy));
+        }
+        function applyZoom(){
+          clampPan();
+          zoomLayer.style.transform='translate('+zoomTx+'px,'+zoomTy+'px) scale('+zoomScale+')';
+          wrapper.style.setProperty("--inv-zoom", String(1/zoomScale));
+          if(renderer) renderer.setZoom(zoomScale);
+          scheduleTiles();
+        }
+        function zoomAt(cx, cy, nextScale){
+          const s=clamp(nextScale, 1, MAX_ZOOM);
+          zoomTx=cx-(cx-zoomTx)*s/zoomScale;
+          zoomTy=cy-(cy-zoomTy)*s/zoomScale;
+          zoomScale=s; applyZoom();
+        }
+        function scheduleTiles(){
+          if(!ZOOM || tileFrame!==null) return;
+          tileFrame=requestAnimationFrame(()=>{ tileFrame=null; updateTiles(); });
+        }
+        function updateTiles(){
+          const w=image.clientWidth||0, h=image.clientHeight||0;
+          if(!w || !h) return;
+          const needed=w*zoomScale*(window.devicePixelRatio||1);
+          let level=0;
+          while(level+1<ZOOM.levels.length && ZOOM.levels[level+1][0]>=needed) level++;
+          const want=new Set();
+          const lw=ZOOM.levels[level][0], lh=ZOOM.levels[level][1];
+          // プレビュー画像で足りる倍率ではタイルを読まない
+          if(lw>(image.naturalWidth||0)){
+            const k=w/lw, ts=ZOOM.tile_size;
+            const vx0=-zoomTx/zoomScale, vy0=-zoomTy/zoomScale;
+            const vx1=vx0+(wrapper.clientWidth||w)/zoomScale, vy1=vy0+h/zoomScale;
+            const c0=Math.max(0, Math.floor(vx0/k/ts)), c1=Math.min(Math.ceil(lw/ts)-1, Math.floor(vx1/k/ts));
+            const r0=Math.max(0, Math.floor(vy0/k/ts)), r1=Math.min(Math.ceil(lh/ts)-1, Math.floor(vy1/k/ts));
+            for(let r=r0;r<=r1;r++){
+              for(let c=c0;c<=c1;c++){
+                const key=level+"/"+c+"_"+r;
+                want.add(key);
+                if(tileEls.has(key)) continue;
+                const img=new Image();
+                img.className="ceph-tile"; img.decoding="async"; img.alt="";
+                img.style.left=(c*ts*k)+"px"; img.style.top=(r*ts*k)+"px";
+                img.style.width=(Math.min(ts, lw-c*ts)*k)+"px"; img.style.height=(Math.min(ts, lh-r*ts)*k)+"px";
+                img.src=ZOOM.url.replace("{z}", level).replace("{x}", c).replace("{y}", r);
+                tileLayer.appendChild(img); tileEls.set(key, img);
+              }
+            }
+          }
+          tileEls.forEach((el,key)=>{ if(!want.has(key)){ el.remove(); tileEls.delete(key); } });
+        }
+
+        const gesturePointers=new Map();
+        let gestureStart=null;
+        const wrapperPoint = ev => { const r=wrapper.getBoundingClientRect(); return {x:ev.clientX-r.left, y:ev.clientY-r.top}; };
+        function markerDragging(){ return activeMarker!==null || (renderer!==null && renderer.isDragging()); }
+        function beginGesture(){
+          const pts=Array.from(gesturePointers.values());
+          if(pts.length>=2){
+            const mid={x:(pts[0].x+pts[1].x)/2, y:(pts[0].y+pts[1].y)/2};
+            gestureStart={type:"pinch", dist:Math.hypot(pts[0].x-pts[1].x, pts[0].y-pts[1].y)||1, mid,
+                          scale:zoomScale, tx:zoomTx, ty:zoomTy};
+          }else if(pts.length===1 && !markerDragging()){
+            gestureStart={type:"pan", start:pts[0], tx:zoomTx, ty:zoomTy};
+          }else{
+            gestureStart=null;
+          }
+        }
+        function cancelMarkerDrag(){
+          if(renderer){ renderer.cancelDrag(); return; }
+          if(activeMarker){
+            const id=activeMarker.dataset.id; activeMarker.classList.remove("dragging"); activeMarker=null;
+            queueSync("pointercancel", id);
+          }
+        }
+        if(ZOOM){
+          wrapper.classList.add("zoom-mode");
+          image.addEventListener("load", scheduleTiles);
+          wrapper.addEventListener("pointerdown", ev=>{
+            gesturePointers.set(ev.pointerId, wrapperPoint(ev));
+            if(gesturePointers.size>=2) cancelMarkerDrag();
+            beginGesture();
+          });
+          wrapper.addEventListener("pointermove", ev=>{
+            if(!gesturePointers.has(ev.pointerId)) return;
+            gesturePointers.set(ev.pointerId, wrapperPoint(ev));
+            if(!gestureStart) return;
+            const pts=Array.from(gesturePointers.values());
+            if(gestureStart.type==="pinch" && pts.length>=2){
+              const mid={x:(pts[0].x+pts[1].x)/2, y:(pts[0].y+pts[1].y)/2};
+              const dist=Math.hypot(pts[0].x-pts[1].x, pts[0].y-pts[1].y);
+              const s=clamp(gestureStart.scale*dist/gestureStart.dist, 1, MAX_ZOOM);
+              // ピンチ開始時に中点の下にあった画像上の点を、現在の中点へ追従させる
+              const ax=(gestureStart.mid.x-gestureStart.tx)/gestureStart.scale;
+              const ay=(gestureStart.mid.y-gestureStart.ty)/gestureStart.scale;
+              zoomScale=s; zoomTx=mid.x-ax*s; zoomTy=mid.y-ay*s;
+              applyZoom();
+            }else if(gestureStart.type==="pan" && pts.length===1 && !markerDragging()){
+              zoomTx=gestureStart.tx+(pts[0].x-gestureStart.start.x);
+              zoomTy=gestureStart.ty+(pts[0].y-gestureStart.start.y);
+              applyZoom();
+            }
+          });
+          const endGesture = ev=>{
+            if(!gesturePointers.delete(ev.pointerId)) return;
+            beginGesture();
+          };
+          window.addEventListener("pointerup", endGesture);
+          window.addEventListener("pointercancel", endGesture);
+          wrapper.addEventListener("wheel", ev=>{
+            ev.preventDefault();
+            const p=wrapperPoint(ev);
+            zoomAt(p.x, p.y, zoomScale*Math.exp(-ev.deltaY*0.002));
+          }, {passive:false});
+          wrapper.addEventListener("dblclick", ()=>{ zoomScale=1; zoomTx=0; zoomTy=0; applyZoom(); });
+        }
+
+        // ===== Python へのライブ同期（オプトイン）=====
+        // ドラッグ中は送信済みの値が Python に反映された (ack で seq が返ってきた) 後にだけ次を送る。
+        // 送信間隔は LIVE_SYNC_INTERVAL_MS 以上あけ、未送信の古い値は破棄して最新値だけを保留する。
+        // 指を離したときの確定値は即時送信する。ack が届かなくても SYNC_ACK_TIMEOUT_MS で送信を再開する。
+        const syncInstance = Math.random().toString(36).slice(2);
+        let syncSeq=0, pendingSync=null, syncTimer=null, lastSyncAt=-Infinity;
+        let inFlightSeq=null, ackTimer=null;
+        // ドラッグ計測は次に送る値に相乗りさせる。ライブ同期が無効なら、ドラッグ終了後
+        // TELEMETRY_FLUSH_MS まとめてから計測だけを送る（version を付けないのでポイントには触れない）
+        let telemetryTimer=null;
+        const telemetry = window.CephTelemetry
+          ? window.CephTelemetry.create({edges:payload.telemetryBuckets, renderer:payload.renderer, view:"slim"})
+          : null;
+        function emitValue(value){
+          if(!window.parent) return;
+          const report = telemetry ? telemetry.drain() : null;
+          if(report) value = Object.assign({}, value, {telemetry:report});
+          window.parent.postMessage({isStreamlitMessage:true, type:"streamlit:setComponentValue", value}, "*");
+        }
+        function flushTelemetry(){
+          telemetryTimer=null;
+          const report = telemetry ? telemetry.drain() : null;
+          if(!report || !window.parent) return;
+          syncSeq += 1;
+          window.parent.postMessage({isStreamlitMessage:true, type:"streamlit:setComponentValue",
+            value:{instance:syncInstance, seq:syncSeq, telemetry:report}}, "*");
+        }
+        function scheduleSync(){
+          if(syncTimer!==null || inFlightSeq!==null || !pendingSync) return;
+          syncTimer=setTimeout(flushSync, Math.max(0, lastSyncAt + LIVE_SYNC_INTERVAL_MS - performance.now()));
+        }
+        function releaseSync(){
+          inFlightSeq=null;
+          if(ackTimer!==null){ clearTimeout(ackTimer); ackTimer=null; }
+          scheduleSync();
+        }
+        function flushSync(){
+          if(syncTimer!==null){ clearTimeout(syncTimer); syncTimer=null; }
+          if(!pendingSync) return;
+          syncSeq += 1;
+          emitValue(Object.assign({version:payload.version, instance:syncInstance, seq:syncSeq}, pendingSync));
+          pendingSync=null; lastSyncAt=performance.now();
+          inFlightSeq=syncSeq;
+          if(ackTimer!==null) clearTimeout(ackTimer);
+          ackTimer=setTimeout(releaseSync, SYNC_ACK_TIMEOUT_MS);
+        }
+        function queueSync(eventType, id){
+          if(!LIVE_SYNC){
+            if(eventType!=="drag" && telemetry && telemetryTimer===null) telemetryTimer=setTimeout(flushTelemetry, TELEMETRY_FLUSH_MS);
+            return;
+          }
+          const p=pointXY(id), r=pointRatio(id); if(!p || !r) return;
+          const size=stageSize();
+          pendingSync={
+            event:eventType, active_id:id,
+            stage:{width:Math.round(size.width), height:Math.round(size.height)},
+            points:[{id, x_px:p.x, y_px:p.y, x_ratio:r.x, y_ratio:r.y}],
+          };
+          if(eventType!=="drag"){ flushSync(); return; }
+          scheduleSync();
+        }
+        // ブリッジが描画のたびに、Python が反映済みの {instance, seq} を送ってくる
+        window.addEventListener("message", (ev)=>{
+          const data = ev.data || {};
+          if(ev.source!==window.parent || data.type!=="ceph:ack" || !data.ack) return;
+          if(data.ack.instance===syncInstance && inFlightSeq!==null && data.ack.seq>=inFlightSeq) releaseSync();
+        });
+
         function syncAngleStackScale(){
           const base = ANGLE_STACK_BASE_WIDTH || 900;
           const w = image.clientWidth || base;
@@ -170,54 +479,68 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
           angleStack.style.transform = 'scale(' + scale + ')';
         }
 
-        const computeAngle=(pairA,pairB)=>{
-          const a1=markerById[pairA[0]], a2=markerById[pairA[1]], b1=markerById[pairB[0]], b2=markerById[pairB[1]];
-          if(!a1||!a2||!b1||!b2) return null;
-          const A1=xy(a1),A2=xy(a2),B1=xy(b1),B2=xy(b2);
-          const vAx=A1.x-A2.x, vAy=A1.y-A2.y, vBx=B1.x-B2.x, vBy=B1.y-B2.y;
-          const lenA=Math.hypot(vAx,vAy), lenB=Math.hypot(vBx,vBy);
-          if(lenA<1e-6||lenB<1e-6) return null;
-          let r=(vAx*vBx+vAy*vBy)/(lenA*lenB); r=Math.min(1,Math.max(-1,r));
-          return Math.acos(r)*180/Math.PI;
-        };
+        // ===== 角度・ポリゴン (Web Worker) =====
+        // 角度とポリゴン座標はワーカーで計算し、メインスレッドは結果を DOM に反映するだけにする
+        const POINT_ORDER=(payload.points||[]).map(pt=>pt.id);
+        const geometry=window.CephGeometry.createClient({
+          ids:POINT_ORDER, angles:ANGLE_CONFIG, rows:POLYGON_ROWS,
+          sdBase:SD_BASE, widthScale:POLY_WIDTH_SCALE, onResult:applyGeometry,
+        });
+        let latestGeometrySeq=0;
+
+        function updateGeometry(){
+          const coords=new Float64Array(POINT_ORDER.length*2);
+          POINT_ORDER.forEach((id,i)=>{
+            const p=pointXY(id);
+            coords[i*2]=p?p.x:NaN; coords[i*2+1]=p?p.y:NaN;
+          });
+          geometry.update(coords);
+        }
 
-        const angleCurrent=new Map();
-        function updateAngleStack(){
-          const cache=new Map();
-          ANGLE_CONFIG.forEach(cfg=>{
+        function applyGeometry(result){
+          if(result.seq<latestGeometrySeq) return;
+          latestGeometrySeq=result.seq;
+          ANGLE_CONFIG.forEach((cfg,i)=>{
             const entry=angleRowMap[cfg.id]; if(!entry) return;
-            let v=null;
-            if(cfg.type==="angle"){ v=computeAngle(cfg.vectors[0], cfg.vectors[1]); }
-            else if(cfg.type==="difference"){
-              const a=cache.get(cfg.minuend), b=cache.get(cfg.subtrahend);
-              if(a!=null && b!=null) v=a-b;
-            }
-            if(cfg.id==="Convexity" && v!=null) v=180-v;
-            if(v==null || Number.isNaN(v)){
-              entry.row.classList.add("dimmed"); entry.valueEl.textContent="--.-°"; angleCurrent.set(cfg.id,null);
+            const v=result.values[i];
+            if(!Number.isFinite(v)){
+              entry.row.classList.add("dimmed"); entry.valueEl.textContent="--.-°";
             }else{
-              entry.row.classList.remove("dimmed"); entry.valueEl.textContent=v.toFixed(1)+"°"; angleCurrent.set(cfg.id,v);
+              entry.row.classList.remove("dimmed"); entry.valueEl.textContent=v.toFixed(1)+"°";
             }
-            cache.set(cfg.id,v);
           });
+          const nodes=polygonNodes();
+          if(result.outline){
+            nodes.outline.setAttribute("points", pairsToPoints(result.outline));
+            nodes.center.setAttribute("x1",result.center[0]); nodes.center.setAttribute("x2",result.center[0]);
+            nodes.center.setAttribute("y1",result.center[1]); nodes.center.setAttribute("y2",result.center[2]);
+          }
+          if(result.patient.length>=4){
+            nodes.patient.setAttribute("points", pairsToPoints(result.patient));
+            nodes.patient.style.display="";
+          }else{
+            nodes.patient.style.display="none";
+          }
         }
 
         function updateCoordStack(){
-          const ids = Object.keys(markerById).sort();
+          const ids = pointIds().sort();
           coordStack.innerHTML = ids.map(id=>{
-            const m = markerById[id]; if(!m) return "";
-            const x = Math.round(parseFloat(m.dataset.left||"0"));
-            const y = Math.round(parseFloat(m.dataset.top||"0"));
+            const p = toNative(pointXY(id)); if(!p) return "";
+            const x = Math.round(p.x);
+            const y = Math.round(p.y);
             return `<div class="coord-item"><span>${id}</span><span>(${x}, ${y})</span></div>`;
           }).join("");
         }
 
         // ===== markers (thin triangles) =====
-        function setPosition(m,left,top){
+        function setPosition(m,left,top,keepRatio){
           const w=stage.clientWidth||1,h=stage.clientHeight||1;
           const cl=Math.round(clamp(left,0,w));
           const ct=Math.round(clamp(top,0,h));
           m.style.left=cl+"px"; m.style.top=ct+"px"; m.dataset.left=cl; m.dataset.top=ct;
+          // 比率を正とし、リサイズ時はそこから再配置する（丸め誤差を蓄積させない）
+          if(!keepRatio){ m.dataset.ratioX=cl/w; m.dataset.ratioY=ct/h; }
         }
         function createMarker(pt){
           const m=document.createElement("div"); m.className="ceph-marker"; m.dataset.id=pt.id;
@@ -259,19 +582,22 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
               capturedPointerId = ev.pointerId;
             }
 
-            const rect=stage.getBoundingClientRect();
+            const local=toLocal(ev);
             const left=parseFloat(m.dataset.left||"0"), top=parseFloat(m.dataset.top||"0");
-            dragOffset={x:ev.clientX-(rect.left+left), y:ev.clientY-(rect.top+top)};
+            dragOffset={x:local.x-left, y:local.y-top};
             activeMarker=m; m.classList.add("dragging");
+            if(telemetry) telemetry.dragStart();
           }, {passive:true});
 
           m.addEventListener("pointermove",(ev)=>{
             // 2本指以上が乗っている間は動かさない（＝ピンチ優先）
             if (activePointers.size >= 2) return;
             if(activeMarker!==m) return;
-            const rect=stage.getBoundingClientRect();
-            setPosition(m, ev.clientX-rect.left-dragOffset.x, ev.clientY-rect.top-dragOffset.y);
-            updatePlanes(); updateAngleStack(); redrawPolygon(); updateCoordStack();
+            const local=toLocal(ev);
+            setPosition(m, local.x-dragOffset.x, local.y-dragOffset.y);
+            updatePlanes(); updateGeometry(); updateCoordStack();
+            if(telemetry) telemetry.input(ev.timeStamp);
+            queueSync("drag", m.dataset.id);
           }, {passive:true});
 
           const finish=(ev)=>{
@@ -284,23 +610,25 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
               capturedPointerId = null;
             }
             m.classList.remove("dragging"); activeMarker=null;
-            updatePlanes(); updateAngleStack(); redrawPolygon(); updateCoordStack();
+            if(telemetry) telemetry.dragEnd();
+            updatePlanes(); updateGeometry(); updateCoordStack();
+            queueSync(ev?.type==="pointercancel" ? "pointercancel" : "pointerup", m.dataset.id);
           };
           m.addEventListener("pointerup", finish, {passive:true});
           m.addEventListener("pointercancel", finish, {passive:true});
         }
 
-        function placeInitMarkersOnce(){
+        function placeMarkers(){
           const w=stage.clientWidth||0,h=stage.clientHeight||0;
           markers.forEach(m=>{
-            if(m.dataset.initPlaced==="1"){
+            if(m.dataset.initPlaced==="1" && m.dataset.ratioX===undefined){
               setPosition(m, parseFloat(m.dataset.left||"100"), parseFloat(m.dataset.top||"100"));
               return;
             }
             const rx=(m.dataset.ratioX!==undefined)?parseFloat(m.dataset.ratioX):0.5;
             const ry=(m.dataset.ratioY!==undefined)?parseFloat(m.dataset.ratioY):0.5;
-            setPosition(m, rx*w, ry*h);
-            m.dataset.initPlaced="1"; delete m.dataset.ratioX; delete m.dataset.ratioY;
+            setPosition(m, rx*w, ry*h, true);
+            m.dataset.initPlaced="1"; m.dataset.ratioX=rx; m.dataset.ratioY=ry;
           });
         }
 
@@ -317,6 +645,7 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
           });
         }
         function updatePlanes(){
+          if(renderer) return;
           const w=stage.clientWidth||0, h=stage.clientHeight||0;
           planesSvg.setAttribute("viewBox","0 0 "+w+" "+h);
           planesSvg.setAttribute("width", w); planesSvg.setAttribute("height", h);
@@ -342,101 +671,38 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
           return map;
         }
 
-        function redrawPolygon(){
+        const pairsToPoints=arr=>{
+          const parts=[];
+          for(let i=0;i<arr.length;i+=2) parts.push(arr[i]+","+arr[i+1]);
+          return parts.join(" ");
+        };
+
+        let polygonNodeCache=null;
+        function polygonNodes(){
+          if(polygonNodeCache) return polygonNodeCache;
+          const ns="http://www.w3.org/2000/svg";
+          const g=document.createElementNS(ns,"g");
+          const outline=document.createElementNS(ns,"polygon"); outline.setAttribute("id","std-poly-outline");
+          const center=document.createElementNS(ns,"line"); center.setAttribute("class","std-centerline");
+          const patient=document.createElementNS(ns,"polyline"); patient.setAttribute("class","std-patient");
+          g.appendChild(outline); g.appendChild(center); g.appendChild(patient);
+          overlaySvg.innerHTML=""; overlaySvg.appendChild(g);
+          polygonNodeCache={outline, center, patient};
+          return polygonNodeCache;
+        }
+
+        // 行の位置はレイアウト変更時だけ測り、ワーカーへ送る (ドラッグ中は測らない)
+        function layoutPolygon(){
           if(!overlaySvg) return;
           const w=image.clientWidth||800, h=image.clientHeight||600;
           overlaySvg.setAttribute("viewBox","0 0 "+w+" "+h);
-          const offsetX = Math.round(w*0.20) + 60;
-
-          const centersMap = measureRowCentersMap();
-          const ys = new Array(POLYGON_ROWS.length).fill(null);
-
-          for(let i=0;i<POLYGON_ROWS.length;i++){
-            const label = POLYGON_ROWS[i][0];
-            if(label==="00"||label==="01"||label==="ZZ"||label==="VTOP"||label==="VBOT") continue;
-            const cy = centersMap.get(label);
-            if (typeof cy === "number") ys[i] = cy;
-          }
-          for(let i=0;i<ys.length;i++){
-            if(ys[i]==null){
-              let prev=null,next=null;
-              for(let p=i-1;p>=0;p--){ if(ys[p]!=null){ prev=ys[p]; break; } }
-              for(let n=i+1;n<ys.length;n++){ if(ys[n]!=null){ next=ys[n]; break; } }
-              if(prev!=null && next!=null) ys[i]=(prev+next)/2;
-              else if(prev!=null) ys[i]=prev+40;
-              else if(next!=null) ys[i]=next-40;
-              else ys[i]=Math.round(h*0.1);
-            }
-          }
-
-          const gaps=[]; for(let i=1;i<ys.length;i++) gaps.push(Math.abs(ys[i]-ys[i-1]));
-          const median = gaps.length? gaps.sort((a,b)=>a-b)[Math.floor(gaps.length/2)] : 24;
-          const unit = Math.max(14, Math.round(median));
-
-          const idxVTOP = POLYGON_ROWS.findIndex(r=>r[0]==="VTOP");
-          const idxVBOT = POLYGON_ROWS.findIndex(r=>r[0]==="VBOT");
-          let firstRealY=null, lastRealY=null;
-          for(let i=0;i<POLYGON_ROWS.length;i++){
-            const lb=POLYGON_ROWS[i][0];
-            if(lb!=="00"&&lb!=="01"&&lb!=="ZZ"&&lb!=="VTOP"&&lb!=="VBOT"){ firstRealY = ys[i]; break; }
-          }
-          for(let i=POLYGON_ROWS.length-1;i>=0;i--){
-            const lb=POLYGON_ROWS[i][0];
-            if(lb!=="00"&&lb!=="01"&&lb!=="ZZ"&&lb!=="VTOP"&&lb!=="VBOT"){ lastRealY = ys[i]; break; }
-          }
-          if(idxVTOP>=0 && firstRealY!=null) ys[idxVTOP] = firstRealY - unit;
-          if(idxVBOT>=0 && lastRealY!=null)  ys[idxVBOT] = lastRealY + unit;
-
-          const yInt = ys.map(v=>Math.round(v));
-          const offsetXInt = Math.round(offsetX);
-
-          const spread = row => (row[3] * SD_BASE * POLY_WIDTH_SCALE * unit);
-          const leftXs  = POLYGON_ROWS.map(row => Math.round(offsetX - spread(row)));
-          const rightXs = POLYGON_ROWS.map(row => Math.round(offsetX + spread(row)));
-
-          overlaySvg.innerHTML="";
-          const g=document.createElementNS("http://www.w3.org/2000/svg","g");
-          overlaySvg.appendChild(g);
-
-          const pts=[];
-          for(let i=0;i<POLYGON_ROWS.length;i++) pts.push(leftXs[i]+","+yInt[i]);
-          for(let i=POLYGON_ROWS.length-1;i>=0;i--) pts.push(rightXs[i]+","+yInt[i]);
-          const poly=document.createElementNS("http://www.w3.org/2000/svg","polygon");
-          poly.setAttribute("id","std-poly-outline"); poly.setAttribute("points", pts.join(" "));
-          g.appendChild(poly);
-
-          const center=document.createElementNS("http://www.w3.org/2000/svg","line");
-          center.setAttribute("x1",offsetXInt); center.setAttribute("x2",offsetXInt);
-          center.setAttribute("y1",yInt[0]);   center.setAttribute("y2",yInt[yInt.length-1]);  // 同一整数座標
-          center.setAttribute("class","std-centerline"); g.appendChild(center);
-
+          const centersMap=measureRowCentersMap();
+          const centers=new Float64Array(POLYGON_ROWS.length);
           POLYGON_ROWS.forEach((row,i)=>{
-            const label=row[0]; if(label==="00"||"01"||"ZZ"||"VTOP"||"VBOT") return;
-            const hl=document.createElementNS("http://www.w3.org/2000/svg","line");
-            hl.setAttribute("x1", String(leftXs[i])); hl.setAttribute("x2", String(rightXs[i]));
-            hl.setAttribute("y1", String(yInt[i]));   hl.setAttribute("y2", String(yInt[i]));
-            hl.setAttribute("class","std-hline"); g.appendChild(hl);
+            const cy=centersMap.get(row[0]);
+            centers[i]=(typeof cy==="number") ? cy : NaN;
           });
-
-          // 患者 赤ポリライン（端点も整数）
-          const patientPts=[];
-          if(idxVTOP>=0) patientPts.push([offsetXInt, yInt[idxVTOP]]);
-          POLYGON_ROWS.forEach((row,i)=>{
-            const label=row[0]; if(label==="00"||label==="01"||label==="ZZ"||label==="VTOP"||label==="VBOT") return;
-            const mean=row[1], sd=row[2], ratio=row[3];
-            const val = angleCurrent.get(label);
-            if(!sd || !ratio || val==null || !isFinite(val)) return;
-            const sd_px = ratio * SD_BASE * POLY_WIDTH_SCALE * unit;
-            const x = Math.round(offsetX + ((val-mean)/sd) * sd_px);
-            patientPts.push([x, yInt[i]]);
-          });
-          if(idxVBOT>=0) patientPts.push([offsetXInt, yInt[idxVBOT]]);
-          if(patientPts.length>=2){
-            const pl=document.createElementNS("http://www.w3.org/2000/svg","polyline");
-            pl.setAttribute("class","std-patient");
-            pl.setAttribute("points", patientPts.map(p=>p[0]+","+p[1]).join(" "));
-            g.appendChild(pl);
-          }
+          geometry.layout(centers, w, h);
         }
 
         function updateLayout(){
@@ -445,38 +711,52 @@ def render_ceph_component(image_data_url: str, marker_size: int, show_labels: bo
           const base = ANGLE_STACK_BASE_WIDTH || 900;
           const scale = Math.min(1, (image.clientWidth||base)/base);
           angleStack.style.transform = 'scale(' + scale + ')';
-          placeInitMarkersOnce(); initPlanes(); updatePlanes(); updateAngleStack(); redrawPolygon(); updateCoordStack();
+          if(renderer) renderer.layout(); else { placeMarkers(); initPlanes(); updatePlanes(); }
+          layoutPolygon(); updateGeometry(); updateCoordStack();
+          if(ZOOM) applyZoom();
         }
 
         window.addEventListener("pointerup", (ev)=>{
           if (ev?.pointerType === "touch") activePointers.delete(ev.pointerId);
-          if(activeMarker){ activeMarker.classList.remove("dragging"); activeMarker=null;
-            updatePlanes(); updateAngleStack(); redrawPolygon(); updateCoordStack(); }
+          if(activeMarker){ const id=activeMarker.dataset.id; activeMarker.classList.remove("dragging"); activeMarker=null;
+            updatePlanes(); updateGeometry(); updateCoordStack(); queueSync("pointerup", id); }
         }, {passive:true});
         window.addEventListener("pointercancel", (ev)=>{
           if (ev?.pointerType === "touch") activePointers.delete(ev.pointerId);
-          if(activeMarker){ activeMarker.classList.remove("dragging"); activeMarker=null;
-            updatePlanes(); updateAngleStack(); redrawPolygon(); updateCoordStack(); }
+          if(activeMarker){ const id=activeMarker.dataset.id; activeMarker.classList.remove("dragging"); activeMarker=null;
+            updatePlanes(); updateGeometry(); updateCoordStack(); queueSync("pointercancel", id); }
         }, {passive:true});
 
-        (payload.points||[]).forEach(pt=>createMarker(pt));
+        if(renderer){ stage.style.display="none"; planesSvg.style.display="none"; }
+        else (payload.points||[]).forEach(pt=>createMarker(pt));
         if (image.complete && image.naturalWidth) updateLayout();
         else image.addEventListener("load", updateLayout, {once:true});
-        window.addEventListener("resize", updateLayout);
+        window.cephObserveResize(wrapper, updateLayout);
       })();
     </script>
     """
 
-    html = html.replace("__IMAGE_DATA_URL__", image_data_url)
+    html = html.replace("__IMAGE_DATA_URL__", tiles["preview"] if tiles else image_data_url)
+    html = html.replace("__RESIZE_SCRIPT__", resize_script)
+    html = html.replace("__CANVAS_SCRIPT__", canvas_script)
+    html = html.replace("__GEOMETRY_SCRIPT__", geometry_script)
+    html = html.replace("__TELEMETRY_SCRIPT__", telemetry_script)
     html = html.replace("__ANGLE_ROWS_HTML__", angle_rows_html)
     html = html.replace("__ANGLE_CONFIG_JSON__", json.dumps(ANGLE_STACK_CONFIG))
     html = html.replace("__POLY_ROWS_JSON__", json.dumps(POLYGON_ROWS))
     html = html.replace("__SD_BASE__", json.dumps(SD_BASE))
     html = html.replace("__POLY_WIDTH_SCALE__", json.dumps(POLY_WIDTH_SCALE))
     html = html.replace("__ANGLE_STACK_BASE_WIDTH__", json.dumps(ANGLE_STACK_BASE_WIDTH))
+    html = html.replace("__LIVE_SYNC__", json.dumps(live_sync))
+    html = html.replace("__LIVE_SYNC_INTERVAL_MS__", json.dumps(LIVE_SYNC_INTERVAL_MS))
+    html = html.replace("__SYNC_ACK_TIMEOUT_MS__", json.dumps(SYNC_ACK_TIMEOUT_MS))
+    html = html.replace("__TELEMETRY_FLUSH_MS__", json.dumps(TELEMETRY_FLUSH_MS))
+    html = html.replace("__ZOOM_JSON__", json.dumps(tiles))
+    html = html.replace("__MAX_ZOOM__", json.dumps(MAX_ZOOM))
     html = html.replace("__PAYLOAD_JSON__", payload_json)
 
-    return components.html(html, height=1100, scrolling=False)
+    st.session_state.ceph_rendered_html_bytes = len(html)
+    return html_component(html, height=1100, key=COMPONENT_KEY, ack=get_sync_ack())
 
 def slim_main() -> None:
     base.ensure_session_state()
@@ -484,33 +764,48 @@ def slim_main() -> None:
     st.markdown("### 画像の選択")
     uploaded = st.file_uploader(
         "分析したいレントゲン画像をアップロードしてください。",
-        type=["png", "jpg", "jpeg", "gif", "webp"],
+        type=base.IMAGE_UPLOAD_TYPES,
     )
 
+    image_data_url = None
     if uploaded is not None:
-        image_bytes = uploaded.read()
-        mime = uploaded.type or "image/png"
-        image_data_url = base.to_data_url(image_bytes, mime)
-        st.session_state.default_image_data_url = image_data_url
-    else:
+        try:
+            image_data_url = base.uploaded_image_data_url(uploaded)
+        except (RuntimeError, ValueError) as exc:
+            st.error(str(exc))
+        else:
+            st.session_state.default_image_data_url = image_data_url
+    if image_data_url is None:
         image_data_url = st.session_state.default_image_data_url
 
     if not image_data_url:
         st.error("表示画像をuploadしてください。")
+        base.account_session_memory()
         return
 
     marker_size = 26
     show_labels = True
+    renderer = "canvas" if st.toggle("Canvas描画 (多点・タブレット向け)", value=False) else "dom"
+    live_sync = st.toggle("ポイント位置をサーバーへ同期", value=False)
+    zoom_mode = st.toggle("ズーム・パン (タイル表示)", value=False)
+    tiles = get_tile_payload(image_data_url) if zoom_mode else None
 
+    # 届いた値は描画前に反映し、同じ実行の ack に載せる (描画後だと ack が 1 実行遅れて同期が止まる)
+    base.apply_pending_component_value(COMPONENT_KEY)
     component_value = render_ceph_component(
         image_data_url=image_data_url,
         marker_size=marker_size,
         show_labels=show_labels,
         point_state=st.session_state.ceph_points,
+        renderer=renderer,
+        live_sync=live_sync,
+        tiles=tiles,
     )
 
     if isinstance(component_value, dict):
         base.update_state_from_component(component_value)
+    base.persist_session_state()
+    base.account_session_memory()
 
 def main():
     slim_main()
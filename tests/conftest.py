@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# テストはリポジトリ直下のモジュールを import する (パッケージ化していないため)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
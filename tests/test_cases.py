@@ -0,0 +1,69 @@
+"""CaseArchive.save の主トレースの持ち主と、空欄を既存値で補う規則。"""
+
+import sqlite3
+
+from ceph_cases import DB_NAME, CaseArchive, CaseRecord
+
+
+def record(rater, x, **attrs):
+    return CaseRecord("C001", {"S": (x, 1.0)}, {"SNA": x}, rater=rater, **attrs)
+
+
+def test_other_rater_adds_tracing_only(tmp_path):
+    archive = CaseArchive(tmp_path)
+    calls = []
+    hooks = dict(
+        on_insert=lambda conn, rec: calls.append("insert"),
+        on_update=lambda conn, before, after: calls.append("update"),
+        on_tracing=lambda conn, case_id, before, after: calls.append(len(after)),
+    )
+    assert archive.save(record("A", 10.0, age=12.0, sex="F", mm_per_px=0.1), **hooks)
+    assert not archive.save(record("B", 20.0), **hooks)
+    saved = archive.get("C001")
+    assert (saved.rater, saved.age, saved.sex, saved.mm_per_px) == ("A", 12.0, "F", 0.1)
+    assert saved.points == {"S": (10.0, 1.0)} and saved.measurements == {"SNA": 10.0}
+    assert [t.rater for t in archive.tracings("C001")] == ["A", "B"]
+    assert calls == [1, "insert", 2]
+
+
+def test_owner_update_keeps_blank_attributes(tmp_path):
+    archive = CaseArchive(tmp_path)
+    archive.save(record("A", 10.0, age=12.0, sex="F", mm_per_px=0.1))
+    changes = []
+    archive.save(record("A", 11.0), on_update=lambda conn, before, after: changes.append((before, after)))
+    [(before, after)] = changes
+    assert before.measurements == {"SNA": 10.0} and after.measurements == {"SNA": 11.0}
+    assert (after.age, after.sex, after.mm_per_px) == (12.0, "F", 0.1)
+    assert archive.get("C001") == after
+    archive.save(record("A", 11.0, age=13.0, sex="M", mm_per_px=0.2))
+    saved = archive.get("C001")
+    assert (saved.age, saved.sex, saved.mm_per_px) == (13.0, "M", 0.2)
+
+
+def test_migration_assigns_owner(tmp_path):
+    # 評価者列の無い cases を持つ古い DB
+    conn = sqlite3.connect(tmp_path / DB_NAME)
+    conn.executescript(
+        """
+        CREATE TABLE cases (
+            rowid INTEGER PRIMARY KEY, case_id TEXT NOT NULL UNIQUE, age REAL, sex TEXT NOT NULL DEFAULT '',
+            image_key TEXT NOT NULL DEFAULT '', image_width INTEGER NOT NULL DEFAULT 0,
+            image_height INTEGER NOT NULL DEFAULT 0, mm_per_px REAL, points TEXT NOT NULL,
+            measurements TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL
+        );
+        CREATE TABLE tracings (
+            case_id TEXT NOT NULL, rater TEXT NOT NULL, points TEXT NOT NULL, mm_per_px REAL,
+            updated REAL NOT NULL, PRIMARY KEY (case_id, rater)
+        );
+        INSERT INTO cases (case_id, points, measurements, created, updated)
+            VALUES ('C001', '{"S": [2.0, 1.0]}', '{}', 0, 0), ('C002', '{}', '{}', 0, 0);
+        INSERT INTO tracings VALUES
+            ('C001', 'A', '{"S": [1.0, 1.0]}', NULL, 1), ('C001', 'B', '{"S": [2.0, 1.0]}', NULL, 2);
+        """
+    )
+    conn.commit()
+    conn.close()
+    archive = CaseArchive(tmp_path)
+    assert archive.get("C001").rater == "B"
+    assert archive.get("C002").rater == ""
+    assert CaseArchive(tmp_path).get("C001").rater == "B"
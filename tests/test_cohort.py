@@ -0,0 +1,163 @@
+"""コホート統計の逐次計算を numpy の総当たり・再構築と突き合わせる。"""
+
+import math
+import random
+
+import numpy as np
+import pytest
+
+from ceph_cases import CaseArchive, CaseRecord
+from ceph_cohort import (
+    ALL,
+    SIGMA_EDGES,
+    SIGMA_LIMIT,
+    CohortStore,
+    DensityStore,
+    KLLSketch,
+    Moments,
+    SigmaHistogram,
+    case_sigmas,
+)
+
+MEASURES = ("SNA", "SNB")
+REFERENCE = {"SNA": (82.0, 3.5), "SNB": (80.0, 3.0)}
+
+
+def moments_of(values):
+    moments = Moments()
+    for value in values:
+        moments.add(value)
+    return moments
+
+
+def assert_moments(moments, values):
+    assert moments.n == len(values)
+    assert moments.mean == pytest.approx(np.mean(values), rel=1e-9, abs=1e-9)
+    assert moments.sd == pytest.approx(np.std(values, ddof=1), rel=1e-9)
+
+
+def test_moments_add_and_chan_merge():
+    rng = np.random.default_rng(1)
+    values = rng.normal(1e4, 3.0, size=3000)  # 平均が大きくても桁落ちしないこと
+    assert_moments(moments_of(values), values)
+    merged = Moments()
+    for part in np.array_split(values, [5, 6, 400, 2999]):
+        merged.merge(moments_of(part))
+    assert_moments(merged, values)
+    assert merged.minimum == values.min() and merged.maximum == values.max()
+
+
+def test_moments_remove_reverses_add():
+    rng = np.random.default_rng(2)
+    values = list(rng.normal(80.0, 4.0, size=500))
+    moments = moments_of(values)
+    for value in rng.permutation(values)[:450]:
+        moments.remove(value)
+        values.remove(value)
+    assert_moments(moments, values)
+    for value in list(values):
+        moments.remove(value)
+    assert moments.n == 0 and math.isnan(moments.sd)
+
+
+def true_rank(data, value):
+    return np.searchsorted(data, value, side="right") / len(data)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_kll_rank_error(seed):
+    random.seed(seed)
+    data = np.random.default_rng(seed).lognormal(size=50000)
+    sketch = KLLSketch(k=200)
+    for value in data:
+        sketch.update(value)
+    assert sketch._weighted()[1][-1] == sketch.n == len(data)
+    assert sketch._size() < 4 * sketch.k
+    data.sort()
+    qs = np.linspace(0.01, 0.99, 50)
+    for q, value in zip(qs, sketch.quantiles(qs)):
+        assert abs(true_rank(data, value) - q) < 0.03
+    for value in np.quantile(data, qs):
+        assert abs(sketch.rank(value) - true_rank(data, value)) < 0.03
+
+
+def test_kll_merge_matches_single_stream():
+    random.seed(10)
+    rng = np.random.default_rng(10)
+    parts = [rng.normal(loc, 1.0, size=size) for loc, size in ((0, 20000), (5, 3000), (-2, 7))]
+    merged = KLLSketch(k=200)
+    for part in parts:
+        sketch = KLLSketch(k=200)
+        for value in part:
+            sketch.update(value)
+        merged.merge(KLLSketch.from_dict(sketch.to_dict()))
+    data = np.sort(np.concatenate(parts))
+    assert merged.n == len(data) and merged._weighted()[1][-1] == len(data)
+    qs = np.linspace(0.02, 0.98, 25)
+    for q, value in zip(qs, merged.quantiles(qs)):
+        assert abs(true_rank(data, value) - q) < 0.03
+
+
+def random_record(rng, case_id):
+    measurements = {name: float(rng.normal(mean, sd)) for name, (mean, sd) in REFERENCE.items()}
+    if rng.random() < 0.1:
+        measurements.pop("SNB")
+    age = None if rng.random() < 0.1 else float(rng.uniform(6, 40))
+    sex = str(rng.choice(["M", "F", ""]))
+    return CaseRecord(case_id, {}, measurements, age=age, sex=sex)
+
+
+def save_cases(archive, on_insert, on_update, seed=3):
+    rng = np.random.default_rng(seed)
+    for i in range(300):
+        archive.save(random_record(rng, f"C{i:03d}"), on_insert=on_insert, on_update=on_update)
+    # 計測値・年齢・性別を変えた再保存 (セルをまたぐ移動を含む)
+    for i in rng.choice(300, size=80, replace=False):
+        archive.save(random_record(rng, f"C{i:03d}"), on_insert=on_insert, on_update=on_update)
+
+
+def test_cohort_refold_matches_rebuild(tmp_path):
+    archive = CaseArchive(tmp_path)
+    store = CohortStore(archive, MEASURES)
+    save_cases(archive, store.fold, store.refold)
+    folded = {key: store.cells(*key) for key in [(ALL, ALL), ("18+", "M"), (ALL, "F")]}
+    assert any(cell.stale for cells in folded.values() for cell in cells.values())
+    store.rebuild()
+    for key, cells in folded.items():
+        rebuilt = store.cells(*key)
+        assert cells.keys() == rebuilt.keys()
+        for measure, cell in cells.items():
+            expected = rebuilt[measure].moments
+            assert cell.moments.n == expected.n
+            assert cell.moments.mean == pytest.approx(expected.mean, rel=1e-9)
+            assert cell.moments.sd == pytest.approx(expected.sd, rel=1e-9)
+            assert rebuilt[measure].stale == 0
+
+
+def test_sigma_histogram_matches_numpy():
+    values = np.random.default_rng(4).normal(0.0, 3.0, size=5000)
+    histogram = SigmaHistogram()
+    for value in values:
+        histogram.add(value)
+    for value in values[:1000]:
+        histogram.remove(value)
+    rest = values[1000:]
+    inner = rest[(rest >= -SIGMA_LIMIT) & (rest < SIGMA_LIMIT)]
+    np.testing.assert_array_equal(histogram.counts[1:-1], np.histogram(inner, bins=SIGMA_EDGES)[0])
+    assert histogram.counts[0] == (rest < -SIGMA_LIMIT).sum()
+    assert histogram.counts[-1] == (rest >= SIGMA_LIMIT).sum()
+
+
+def test_density_refold_matches_rebuild(tmp_path):
+    archive = CaseArchive(tmp_path)
+    store = DensityStore(archive, REFERENCE)
+    save_cases(archive, store.fold, store.refold)
+    folded = {key: store.histograms(*key) for key in [(ALL, ALL), ("18+", "F"), (ALL, "M")]}
+    store.rebuild()
+    for key, histograms in folded.items():
+        rebuilt = store.histograms(*key)
+        assert histograms.keys() == rebuilt.keys()
+        for measure, histogram in histograms.items():
+            np.testing.assert_array_equal(histogram.counts, rebuilt[measure].counts)
+    expected = sum(len(case_sigmas(record.measurements, REFERENCE)) for record in archive.iter_records())
+    assert sum(histogram.n for histogram in store.histograms().values()) == expected
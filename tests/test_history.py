@@ -0,0 +1,86 @@
+"""DeltaHistory をリスト (操作ごとの差分) で持つ素朴なモデルと突き合わせる。"""
+
+import random
+
+import pytest
+
+from ceph_history import DeltaHistory, diff_states, get_xy
+
+
+class ListHistory:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ops = []
+        self.cursor = 0
+
+    def record(self, deltas):
+        entries = [d for d in deltas if d[1] != d[2]][: self.capacity]
+        if not entries:
+            return
+        del self.ops[self.cursor :]
+        # 入りきるまで最古の操作を丸ごと捨てる
+        while sum(len(op) for op in self.ops) + len(entries) > self.capacity:
+            self.ops.pop(0)
+        self.ops.append(entries)
+        self.cursor = len(self.ops)
+
+    def undo(self, state):
+        if not self.cursor:
+            return
+        self.cursor -= 1
+        for pid, old, _ in reversed(self.ops[self.cursor]):
+            state[pid] = old
+
+    def redo(self, state):
+        if self.cursor == len(self.ops):
+            return
+        for pid, _, new in self.ops[self.cursor]:
+            state[pid] = new
+        self.cursor += 1
+
+
+def xy_state(state):
+    return {pid: get_xy(state, pid) for pid in state}
+
+
+@pytest.mark.parametrize("capacity", [1, 4, 7, 32])
+def test_matches_list_model(capacity):
+    rng = random.Random(capacity)
+    pids = [f"P{i}" for i in range(6)]
+    history = DeltaHistory(pids, capacity=capacity)
+    model = ListHistory(capacity)
+    state = {pid: {"x_ratio": 0.5, "y_ratio": 0.5} for pid in pids}
+    expected = {pid: (0.5, 0.5) for pid in pids}
+    for _ in range(2000):
+        action = rng.random()
+        if action < 0.5:
+            moved = rng.sample(pids, rng.randint(1, len(pids)))
+            after = {pid: dict(info) for pid, info in state.items()}
+            for pid in moved:
+                after[pid] = {"x_ratio": rng.random(), "y_ratio": rng.random()}
+            deltas = diff_states(state, after)
+            history.record(deltas)
+            model.record(deltas)
+            state = after
+            expected = xy_state(state)
+        elif action < 0.8:
+            history.undo(state)
+            model.undo(expected)
+        else:
+            history.redo(state)
+            model.redo(expected)
+        assert xy_state(state) == expected
+        assert history.can_undo == (model.cursor > 0)
+        assert history.can_redo == (model.cursor < len(model.ops))
+        assert len(history) == sum(len(op) for op in model.ops)
+        assert len(history) <= capacity
+
+
+def test_state_at_does_not_move_history():
+    history = DeltaHistory(["A"], capacity=8)
+    state = {"A": {"x_ratio": 0.0, "y_ratio": 0.0}}
+    for step in range(1, 4):
+        history.record([("A", (step - 1.0, 0.0), (float(step), 0.0))])
+        state["A"] = {"x_ratio": float(step), "y_ratio": 0.0}
+    assert get_xy(history.state_at(state, 2), "A") == (1.0, 0.0)
+    assert history.cursor == history.end
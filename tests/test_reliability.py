@@ -0,0 +1,118 @@
+"""十分統計量からの ICC・Bland–Altman・MRE を分散分析の定義どおりの計算と突き合わせる。"""
+
+import numpy as np
+import pytest
+
+from ceph_cases import CaseArchive, CaseRecord
+from ceph_reliability import RATER_COUNTS, ReliabilityStats, ReliabilityStore
+
+POINT_IDS = ("A", "B")
+MEASURES = ("AX", "BY")
+
+
+def measure(points):
+    """(C, k, L, 2) → 項目ごとの (C, k)。A の x と B の y をそのまま計測値にする。"""
+    return {"AX": points[:, :, 0, 0], "BY": points[:, :, 1, 1]}
+
+
+def anova_icc(y):
+    """y (n, k) の ICC(1,1) と ICC(2,1) (Shrout & Fleiss 1979 の平均平方から)。"""
+    n, k = y.shape
+    grand = y.mean()
+    rows = y.mean(axis=1, keepdims=True)
+    cols = y.mean(axis=0, keepdims=True)
+    msr = k * ((rows - grand) ** 2).sum() / (n - 1)
+    msc = n * ((cols - grand) ** 2).sum() / (k - 1)
+    msw = ((y - rows) ** 2).sum() / (n * (k - 1))
+    mse = ((y - rows - cols + grand) ** 2).sum() / ((n - 1) * (k - 1))
+    icc1 = (msr - msw) / (msr + (k - 1) * msw)
+    icc2 = (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n)
+    return icc1, icc2
+
+
+def stats_for(values):
+    """values (C, k) を AX に入れた統計量 (BY は全症例欠測)。"""
+    count, k = values.shape
+    points = np.full((count, k, len(POINT_IDS), 2), np.nan)
+    points[:, :, 0, 0] = values
+    points[:, :, 0, 1] = 0.0
+    return ReliabilityStats.from_arrays(points, np.ones(count), MEASURES, POINT_IDS, measure)
+
+
+def test_icc_shrout_fleiss_example():
+    y = np.array([[9, 2, 5, 8], [6, 1, 3, 2], [8, 4, 6, 8], [7, 1, 2, 6], [10, 5, 6, 9], [6, 2, 4, 7]], dtype=float)
+    icc1, icc2 = stats_for(y).icc()
+    assert icc1[0] == pytest.approx(0.17, abs=0.005)
+    assert icc2[0] == pytest.approx(0.29, abs=0.005)
+    assert np.isnan(icc1[1]) and np.isnan(icc2[1])
+
+
+@pytest.mark.parametrize("k", [2, 3, 5])
+def test_icc_matches_anova(k):
+    rng = np.random.default_rng(k)
+    truth = rng.normal(80.0, 4.0, size=(60, 1))
+    y = truth + rng.normal(0.0, 1.5, size=(60, k)) + rng.normal(0.0, 1.0, size=(1, k))
+    # 欠測を含む症例は ICC から除く
+    y[rng.random(60) < 0.15, rng.integers(k)] = np.nan
+    complete = np.isfinite(y).all(axis=1)
+    icc1, icc2 = stats_for(y).icc()
+    expected1, expected2 = anova_icc(y[complete])
+    assert icc1[0] == pytest.approx(expected1, rel=1e-9)
+    assert icc2[0] == pytest.approx(expected2, rel=1e-9)
+
+
+def test_icc_sums_of_chunks():
+    y = np.random.default_rng(7).normal(size=(40, 3)) + np.arange(40)[:, None] * 0.1
+    total = stats_for(y[:13])
+    total += stats_for(y[13:])
+    np.testing.assert_allclose(total.icc(), stats_for(y).icc(), rtol=1e-12)
+    total -= stats_for(y[30:])
+    np.testing.assert_allclose(total.icc(), stats_for(y[:30]).icc(), rtol=1e-12)
+
+
+def test_bland_altman_and_radial_error():
+    rng = np.random.default_rng(8)
+    points = rng.normal(100.0, 5.0, size=(30, 3, len(POINT_IDS), 2))
+    points[4, 1, 1] = np.nan
+    scale = rng.uniform(0.08, 0.12, size=30)
+    stats = ReliabilityStats.from_arrays(points, scale, MEASURES, POINT_IDS, measure)
+    bias, sd = stats.bland_altman()
+    values = measure(points)
+    for m, name in enumerate(MEASURES):
+        for p, (a, b) in enumerate([(0, 1), (0, 2), (1, 2)]):
+            diff = values[name][:, b] - values[name][:, a]
+            diff = diff[np.isfinite(diff)]
+            assert bias[m, p] == pytest.approx(diff.mean(), rel=1e-9)
+            assert sd[m, p] == pytest.approx(diff.std(ddof=1), rel=1e-9)
+    mre, mre_sd = stats.radial_error()
+    for landmark in range(len(POINT_IDS)):
+        errors = np.concatenate(
+            [np.hypot(*(points[:, b, landmark] - points[:, a, landmark]).T) * scale for a, b in [(0, 1), (0, 2), (1, 2)]]
+        )
+        errors = errors[np.isfinite(errors)]
+        assert mre[landmark] == pytest.approx(errors.mean(), rel=1e-9)
+        assert mre_sd[landmark] == pytest.approx(errors.std(ddof=1), rel=1e-9)
+
+
+def test_store_fold_matches_rebuild(tmp_path):
+    rng = np.random.default_rng(9)
+    archive = CaseArchive(tmp_path)
+    store = ReliabilityStore(archive, POINT_IDS, MEASURES, measure)
+
+    def save(case_id, rater):
+        points = {pid: tuple(rng.normal(100.0, 5.0, size=2)) for pid in POINT_IDS}
+        archive.save(CaseRecord(case_id, points, {}, mm_per_px=0.1, rater=rater), on_tracing=store.fold)
+
+    for i in range(40):
+        for rater in ["R1", "R2", "R3"][: 1 + i % 3]:
+            save(f"C{i:02d}", rater)
+    for i in rng.choice(40, size=15, replace=False):  # 既存トレースの修正
+        save(f"C{i:02d}", "R2")
+    folded = {k: store.stats(k) for k in RATER_COUNTS}
+    assert folded[2].cases > folded[3].cases > 0
+    store.rebuild()
+    for k in RATER_COUNTS:
+        rebuilt = store.stats(k)
+        assert folded[k].cases == rebuilt.cases
+        for name in ReliabilityStats.FIELDS:
+            np.testing.assert_allclose(getattr(folded[k], name), getattr(rebuilt, name), rtol=1e-9, atol=1e-6)
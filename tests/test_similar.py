@@ -0,0 +1,79 @@
+"""kd 木と行列積の k 近傍を、全件の距離行列の argsort と突き合わせる。"""
+
+import numpy as np
+import pytest
+
+import ceph_similar
+from ceph_cases import CaseArchive, CaseRecord
+from ceph_similar import KDTree, SimilarityIndex
+
+MEASURES = [f"M{i}" for i in range(6)]
+REFERENCE = {name: (0.0, 1.0) for name in MEASURES}
+
+
+def brute_force(points, alive, query, k):
+    distances = ((points - query) ** 2).sum(axis=1)
+    order = [slot for slot in np.argsort(distances, kind="stable") if alive[slot]]
+    return distances[order[:k]], np.array(order[:k], dtype=np.int64)
+
+
+@pytest.mark.parametrize("leaf_size", [1, 7, 64])
+def test_kdtree_matches_brute_force(leaf_size):
+    rng = np.random.default_rng(leaf_size)
+    points = rng.normal(size=(1500, 6)).astype(np.float32)
+    slots = np.arange(len(points), dtype=np.int64)
+    tree = KDTree(points, slots, leaf_size)
+    for alive_ratio in (1.0, 0.5, 0.02):
+        alive = rng.random(len(points)) < alive_ratio
+        for k in (1, 5, 40):
+            for query in rng.normal(size=(20, 6)).astype(np.float32):
+                distances, found = tree.query(query, k, alive)
+                expected_d, expected_s = brute_force(points, alive, query, k)
+                np.testing.assert_array_equal(found, expected_s)
+                np.testing.assert_allclose(distances, expected_d, rtol=1e-5, atol=1e-6)
+
+
+def test_kdtree_empty_and_all_dead():
+    points = np.zeros((0, 3), dtype=np.float32)
+    distances, found = KDTree(points, np.empty(0, dtype=np.int64)).query(np.zeros(3), 3, np.empty(0, dtype=bool))
+    assert len(distances) == len(found) == 0
+    points = np.ones((10, 3), dtype=np.float32)
+    tree = KDTree(points, np.arange(10, dtype=np.int64), 4)
+    assert len(tree.query(np.zeros(3), 3, np.zeros(10, dtype=bool))[1]) == 0
+
+
+def record(case_id, values):
+    return CaseRecord(case_id, {}, dict(zip(MEASURES, map(float, values))))
+
+
+def test_index_paths_match_brute_force(tmp_path, monkeypatch):
+    # 木・追記用の配列・行列積のすべてを通るように小さくする
+    monkeypatch.setattr(ceph_similar, "REBUILD_MIN", 64)
+    monkeypatch.setattr(ceph_similar, "LEAF_SIZE", 8)
+    rng = np.random.default_rng(0)
+    archive = CaseArchive(tmp_path)
+    index = SimilarityIndex(archive, REFERENCE, MEASURES)
+    latest = {}
+    for batch in range(6):
+        with archive.transaction() as conn:
+            for _ in range(150):
+                # 既存症例の置き換え (古いスロットは無効になる) も混ぜる
+                if latest and rng.random() < 0.2:
+                    case_id = sorted(latest)[rng.integers(len(latest))]
+                else:
+                    case_id = f"C{len(latest):05d}"
+                latest[case_id] = rng.normal(size=len(MEASURES)).astype(np.float32)
+                index.fold(conn, record(case_id, latest[case_id]))
+        assert len(index) == len(latest)
+    ids = sorted(latest)
+    points = np.stack([latest[case_id] for case_id in ids])
+    alive = np.ones(len(ids), dtype=bool)
+    queries = rng.normal(size=(40, len(MEASURES))).astype(np.float32)
+    exclude = [ids[i] for i in rng.integers(len(ids), size=len(queries))]
+    for count in (5, len(queries)):  # 5 件は木、40 件は行列積
+        results = index.query_vectors(queries[:count], 7, exclude[:count])
+        for query, skip, hits in zip(queries, exclude, results):
+            distances, order = brute_force(points, alive, query, 8)
+            expected = [(ids[slot], d) for slot, d in zip(order, distances) if ids[slot] != skip][:7]
+            assert [case_id for case_id, _ in hits] == [case_id for case_id, _ in expected]
+            np.testing.assert_allclose([d for _, d in hits], np.sqrt([d for _, d in expected]), rtol=1e-4, atol=1e-4)